@@ -0,0 +1,225 @@
+"""Replay a captured query log against a running search service.
+
+Sends the requests of a query log written with QUERY_LOG_FILE to a search
+service, preserving the original request spacing divided by a speed-up
+factor, with a bounded number of concurrent requests. Reports latency
+percentiles, error rates and throughput per endpoint.
+
+Usage:
+
+    python benchmarks/replay_query_log.py query_log.jsonl \
+        --url http://localhost:5000 --concurrency 8 --speedup 4
+
+Use --speedup 0 to send the requests as fast as possible.
+"""
+
+import argparse
+import json
+import threading
+import time
+from collections import defaultdict
+from concurrent.futures import ThreadPoolExecutor
+from urllib.parse import quote
+
+import requests
+
+ENDPOINTS = ["fts", "geom", "suggest"]
+
+
+def percentile(values, p):
+    values = sorted(values)
+    return values[min(int(len(values) * p / 100), len(values) - 1)]
+
+
+def load_log(path, endpoints):
+    entries = []
+    with open(path, encoding="utf-8") as fh:
+        for line in fh:
+            if not line.strip():
+                continue
+            entry = json.loads(line)
+            if entry["endpoint"] in endpoints:
+                entries.append(entry)
+    entries.sort(key=lambda entry: entry["ts"])
+    return entries
+
+
+def request_url(base_url, entry, tenant_path):
+    """Return URL path and query params for a log entry."""
+    url = base_url.rstrip("/")
+    if tenant_path:
+        url += "/" + entry["tenant"]
+    params = entry["params"]
+    if entry["endpoint"] == "geom":
+        url += "/geom/%s/" % quote(params["dataset"], safe="")
+        query = {
+            "filter": params.get("filter"),
+            "bbox": params.get("bbox"),
+            "crs": params.get("crs"),
+            "limit": params.get("limit"),
+        }
+    elif entry["endpoint"] == "suggest":
+        url += "/suggest/"
+        query = {
+            "searchtext": params.get("searchtext"),
+            "filter": params.get("filter"),
+            "limit": params.get("limit"),
+        }
+    else:
+        url += "/fts/"
+        query = {
+            "searchtext": params.get("searchtext"),
+            "filter": params.get("filter"),
+            "limit": params.get("limit"),
+            "cursor": params.get("cursor"),
+            "center": params.get("center"),
+            "extent": params.get("extent"),
+            "crs": params.get("crs"),
+        }
+    return url, {key: value for key, value in query.items() if value is not None}
+
+
+class Replay:
+    def __init__(self, args):
+        self.args = args
+        self.session = requests.Session()
+        adapter = requests.adapters.HTTPAdapter(pool_maxsize=args.concurrency)
+        self.session.mount("http://", adapter)
+        self.session.mount("https://", adapter)
+        self.lock = threading.Lock()
+        self.latencies = defaultdict(list)
+        self.statuses = defaultdict(lambda: defaultdict(int))
+        self.errors = defaultdict(int)
+
+    def send(self, entry):
+        url, params = request_url(self.args.url, entry, self.args.tenant_path)
+        headers = {}
+        if self.args.tenant_header:
+            headers[self.args.tenant_header] = entry["tenant"]
+        start = time.perf_counter()
+        try:
+            response = self.session.get(
+                url, params=params, headers=headers, timeout=self.args.timeout
+            )
+            status = response.status_code
+        except requests.exceptions.RequestException:
+            status = None
+        duration = time.perf_counter() - start
+
+        endpoint = entry["endpoint"]
+        with self.lock:
+            self.latencies[endpoint].append(duration)
+            self.statuses[endpoint][status or "error"] += 1
+            if status is None or status >= 500:
+                self.errors[endpoint] += 1
+
+    def run(self, entries):
+        speedup = self.args.speedup
+        start = time.perf_counter()
+        log_start = entries[0]["ts"] if entries else 0
+        with ThreadPoolExecutor(max_workers=self.args.concurrency) as executor:
+            futures = []
+            for entry in entries:
+                if speedup > 0:
+                    delay = (entry["ts"] - log_start) / speedup
+                    wait = start + delay - time.perf_counter()
+                    if wait > 0:
+                        time.sleep(wait)
+                futures.append(executor.submit(self.send, entry))
+                # Bound queue to keep request timing close to the log
+                if len(futures) >= self.args.concurrency * 4:
+                    futures.pop(0).result()
+            for future in futures:
+                future.result()
+        return time.perf_counter() - start
+
+    def report(self, duration):
+        print("Replay duration: %.1f s" % duration)
+        print(
+            "%-8s %8s %10s %10s %10s %10s %8s %9s"
+            % (
+                "endpoint",
+                "requests",
+                "req/s",
+                "p50 [ms]",
+                "p95 [ms]",
+                "p99 [ms]",
+                "errors",
+                "error %",
+            )
+        )
+        for endpoint, latencies in sorted(self.latencies.items()):
+            print(
+                "%-8s %8d %10.1f %10.1f %10.1f %10.1f %8d %8.2f%%"
+                % (
+                    endpoint,
+                    len(latencies),
+                    len(latencies) / duration,
+                    percentile(latencies, 50) * 1000,
+                    percentile(latencies, 95) * 1000,
+                    percentile(latencies, 99) * 1000,
+                    self.errors[endpoint],
+                    self.errors[endpoint] * 100 / len(latencies),
+                )
+            )
+        for endpoint, statuses in sorted(self.statuses.items()):
+            print(
+                "%s status codes: %s"
+                % (
+                    endpoint,
+                    ", ".join(
+                        "%s: %d" % (status, count)
+                        for status, count in sorted(
+                            statuses.items(), key=lambda item: str(item[0])
+                        )
+                    ),
+                )
+            )
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split("\n")[0])
+    parser.add_argument("log", help="Query log file (JSON lines)")
+    parser.add_argument(
+        "--url", default="http://localhost:5000", help="Search service base URL"
+    )
+    parser.add_argument(
+        "--concurrency", type=int, default=8, help="Max concurrent requests"
+    )
+    parser.add_argument(
+        "--speedup",
+        type=float,
+        default=1.0,
+        help="Speed-up factor of the request spacing, 0 for max speed",
+    )
+    parser.add_argument(
+        "--endpoint",
+        action="append",
+        choices=ENDPOINTS,
+        help="Replay only these endpoints (default: all)",
+    )
+    parser.add_argument(
+        "--tenant-header", help="Send tenant of log entries in this HTTP header"
+    )
+    parser.add_argument(
+        "--tenant-path",
+        action="store_true",
+        help="Prefix request paths with tenant of log entries",
+    )
+    parser.add_argument(
+        "--timeout", type=float, default=30, help="Request timeout in seconds"
+    )
+    args = parser.parse_args()
+
+    entries = load_log(args.log, args.endpoint or ENDPOINTS)
+    if not entries:
+        print("No requests to replay")
+        return
+    print("Replaying %d requests" % len(entries))
+    replay = Replay(args)
+    duration = replay.run(entries)
+    replay.report(duration)
+
+
+if __name__ == "__main__":
+    main()
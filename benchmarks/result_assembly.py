@@ -0,0 +1,407 @@
+"""Offline micro-benchmarks for result assembly and query building.
+
+Feeds synthetic Postgres rows and Solr responses of increasing size through
+the result building code of the search backends, the geometry feature
+conversion and the tokenizers, without any Postgres or Solr instance.
+Reports throughput and memory allocations, and compares them with a stored
+baseline to detect regressions. Timings depend on the machine, so the
+baseline is not part of the repository: the first run saves it.
+
+Usage:
+
+    PYTHONPATH=$PWD/src python benchmarks/result_assembly.py
+    PYTHONPATH=$PWD/src python benchmarks/result_assembly.py --save
+    PYTHONPATH=$PWD/src python benchmarks/result_assembly.py --sizes 10,1000 --filter solr
+
+The exit code is 1 if a benchmark regressed compared to the baseline.
+"""
+
+import argparse
+import logging
+import os
+import sys
+import time
+import tracemalloc
+
+from flask import json
+
+BENCHMARK_DIR = os.path.dirname(os.path.abspath(__file__))
+BASELINE_FILE = os.path.join(BENCHMARK_DIR, "baseline.json")
+# Use the test config, the benchmarks need no config of their own
+os.environ.setdefault(
+    "CONFIG_PATH", os.path.join(BENCHMARK_DIR, "..", "tests", "config")
+)
+
+from pg_search_service import PgClient  # noqa: E402
+from search_geom_service import SearchGeomService  # noqa: E402
+from solr_search_service import SolrClient  # noqa: E402
+
+SIZES = [10, 100, 1000, 10000, 100000]
+NUM_FACETS = 50
+NUM_SUBLAYERS = 200
+LAYER_FACETS = ["foreground", "background"]
+# Min. total run time per benchmark and size in seconds
+MIN_TIME = 0.5
+
+
+def facet_name(i):
+    return "dataset_%d" % (i % NUM_FACETS)
+
+
+def sublayers(n):
+    return [
+        {
+            "display": "Sublayer %d" % i,
+            "subclass": "singleactor",
+            "ident": "sublayer_%d" % i,
+            "dset_info": True,
+        }
+        for i in range(n)
+    ]
+
+
+def bbox(i):
+    return [2600000 + i, 1200000 + i, 2600100 + i, 1200100 + i]
+
+
+def pg_rows(size):
+    """Return synthetic layer and feature query results."""
+    num_layers = max(1, size // 10)
+    layer_results = [
+        {
+            "display": "Layer %d" % i,
+            "dataproduct_id": "layer_%d" % i,
+            "dset_info": True,
+            "stacktype": LAYER_FACETS[i % 2],
+            "sublayers": json.dumps(sublayers(NUM_SUBLAYERS)) if i % 10 == 0 else None,
+        }
+        for i in range(num_layers)
+    ]
+    feature_results = [
+        {
+            "display": "Feature %d" % i,
+            "facet_id": facet_name(i),
+            "feature_id": i,
+            "id_field_name": "ogc_fid",
+            "id_in_quotes": False,
+            "bbox": json.dumps(bbox(i)),
+            "srid": 2056,
+        }
+        for i in range(size)
+    ]
+    return layer_results, feature_results
+
+
+def solr_response(size):
+    """Return a synthetic Solr response and the permitted Solr facets."""
+    docs = []
+    for i in range(size):
+        if i % 10 == 0:
+            doc = {
+                "id": json.dumps(["layergroup", "layer_%d" % i]),
+                "display": "Layer %d" % i,
+                "facet": LAYER_FACETS[i % 20 // 10],
+                "dset_info": True,
+            }
+            if i % 100 == 0:
+                doc["dset_children"] = json.dumps(sublayers(NUM_SUBLAYERS))
+        else:
+            facet = facet_name(i)
+            doc = {
+                "id": json.dumps([facet, str(i)]),
+                "display": "Feature %d" % i,
+                "facet": facet,
+                "idfield_meta": json.dumps(["ogc_fid", "ogc_fid:n"]),
+                "bbox": json.dumps(bbox(i)),
+                "srid": 2056,
+            }
+        docs.append(doc)
+
+    facet_counts = []
+    for facet in LAYER_FACETS + [facet_name(i) for i in range(NUM_FACETS)]:
+        facet_counts += [facet, size]
+    response = {
+        "response": {"docs": docs},
+        "facet_counts": {"facet_fields": {"facet": facet_counts}},
+    }
+    solr_facets = {
+        facet: [{"filter_word": facet.capitalize()}]
+        for facet in LAYER_FACETS + [facet_name(i) for i in range(NUM_FACETS)]
+    }
+    return response, solr_facets
+
+
+def geom_rows(size):
+    return [
+        {
+            "ogc_fid": i,
+            "json_geom": json.dumps({"type": "Point", "coordinates": bbox(i)[:2]}),
+            "srid": 2056,
+            "bbox_": None,
+        }
+        for i in range(size)
+    ]
+
+
+def searchtexts(size):
+    """Return search texts with a total of size words."""
+    words = ["Bahnhofstrasse", "12", "Solothurn", "4500", "Gemeinde", "Grenze"]
+    texts = []
+    for i in range(max(1, size // 10)):
+        text = " ".join(words[(i + j) % len(words)] for j in range(10))
+        texts.append(text if i % 2 else "Country: " + text)
+    return texts
+
+
+class Benchmarks:
+    """Benchmarks with setup returning the input and run processing it.
+
+    The run methods return their results, so that the allocations include
+    the assembled output.
+    """
+
+    def __init__(self, logger):
+        self.pg_client = PgClient("default", logger)
+        self.pg_client.facet_search_limit = 100000
+        self.pg_client.facets = {
+            facet_name(i): {"filter_word": "Dataset%d" % i} for i in range(NUM_FACETS)
+        }
+        self.solr_client = SolrClient("default", logger)
+        self.geom_service = SearchGeomService("default", logger)
+        self.permitted_dataproducts = ["layer_%d" % i for i in range(0, 100000, 2)] + [
+            "sublayer_%d" % i for i in range(0, NUM_SUBLAYERS, 2)
+        ]
+        self.permitted_dataproducts = set(self.permitted_dataproducts)
+
+    def setup_pg_build_results(self, size):
+        return pg_rows(size)
+
+    def run_pg_build_results(self, data):
+        layer_results, feature_results = data
+        search_ds = [facet_name(i) for i in range(NUM_FACETS)]
+        return self.pg_client.build_results(
+            layer_results, feature_results, self.permitted_dataproducts, search_ds, 50
+        )
+
+    def setup_solr_build_results(self, size):
+        return solr_response(size)
+
+    def run_solr_build_results(self, data):
+        response, solr_facets = data
+        return self.solr_client.build_results(
+            response, None, 50, solr_facets, self.permitted_dataproducts
+        )
+
+    def setup_solr_result_counts(self, size):
+        # One facet count per facet
+        facets = ["dataset_%d" % i for i in range(size)]
+        facet_counts = []
+        for facet in facets:
+            facet_counts += [facet, 10]
+        response = {"facet_counts": {"facet_fields": {"facet": facet_counts}}}
+        solr_facets = {facet: [{"filter_word": facet.capitalize()}] for facet in facets}
+        return response, solr_facets
+
+    def run_solr_result_counts(self, data):
+        response, solr_facets = data
+        return self.solr_client.result_counts(response, None, 0, solr_facets)
+
+    def setup_solr_layer_result(self, size):
+        # Layer groups with deep sublayer lists and single layers
+        children = json.dumps(sublayers(NUM_SUBLAYERS))
+        docs = []
+        for i in range(size):
+            doc = {
+                "id": json.dumps(["layergroup", "layer_%d" % i]),
+                "display": "Layer %d" % i,
+                "facet": "foreground",
+                "dset_info": True,
+            }
+            if i % 10 == 0:
+                doc["dset_children"] = children
+            docs.append(doc)
+        return docs
+
+    def run_solr_layer_result(self, docs):
+        return [
+            self.solr_client.layer_result(doc, self.permitted_dataproducts)
+            for doc in docs
+        ]
+
+    def setup_geom_features(self, size):
+        return geom_rows(size)
+
+    def run_geom_features(self, rows):
+        return [self.geom_service._feature_from_query(row, "ogc_fid") for row in rows]
+
+    def setup_pg_tokenize(self, size):
+        return searchtexts(size)
+
+    def run_pg_tokenize(self, texts):
+        return [self.pg_client.tokenize(text) for text in texts]
+
+    def setup_solr_tokenize(self, size):
+        return searchtexts(size)
+
+    def run_solr_tokenize(self, texts):
+        results = []
+        for text in texts:
+            (filterword, tokens) = self.solr_client.tokenize(text)
+            results.append(self.solr_client.query_str(tokens))
+        return results
+
+    def names(self):
+        return [name[4:] for name in dir(self) if name.startswith("run_")]
+
+
+def measure(benchmarks, name, size):
+    """Run benchmark and return its throughput and allocations."""
+    data = getattr(benchmarks, "setup_" + name)(size)
+    run = getattr(benchmarks, "run_" + name)
+
+    # Warm up caches, e.g. compiled regexes
+    run(data)
+
+    # Allocations of a single run, retained includes the returned results
+    tracemalloc.start()
+    result = run(data)
+    retained, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    del result
+
+    # Repeat until min. time is reached, report best run
+    runs = 0
+    best = None
+    total = 0
+    while total < MIN_TIME or runs < 3:
+        start = time.perf_counter()
+        run(data)
+        duration = time.perf_counter() - start
+        best = duration if best is None else min(best, duration)
+        total += duration
+        runs += 1
+
+    return {
+        "size": size,
+        "runs": runs,
+        "best_ms": round(best * 1000, 4),
+        "items_per_s": round(size / best),
+        "retained_kb": round(retained / 1024, 1),
+        "peak_kb": round(peak / 1024, 1),
+    }
+
+
+def compare(results, baseline, time_tolerance, memory_tolerance):
+    """Return list of regressions compared to the baseline."""
+    regressions = []
+    for key, result in results.items():
+        base = baseline.get(key)
+        if not base:
+            continue
+        if result["best_ms"] > base["best_ms"] * (1 + time_tolerance):
+            regressions.append(
+                "%s: %.3f ms, baseline %.3f ms"
+                % (key, result["best_ms"], base["best_ms"])
+            )
+        if result["peak_kb"] > base["peak_kb"] * (1 + memory_tolerance) + 1:
+            regressions.append(
+                "%s: %.1f KiB peak, baseline %.1f KiB"
+                % (key, result["peak_kb"], base["peak_kb"])
+            )
+    return regressions
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split("\n")[0])
+    parser.add_argument(
+        "--sizes",
+        default=",".join(map(str, SIZES)),
+        help="Comma separated input sizes (number of rows/docs/words)",
+    )
+    parser.add_argument("--filter", default="", help="Run benchmarks containing this")
+    parser.add_argument("--baseline", default=BASELINE_FILE, help="Baseline file")
+    parser.add_argument(
+        "--save", action="store_true", help="Store results as new baseline"
+    )
+    parser.add_argument(
+        "--time-tolerance",
+        type=float,
+        default=0.25,
+        help="Allowed slowdown compared to baseline (default: 0.25)",
+    )
+    parser.add_argument(
+        "--memory-tolerance",
+        type=float,
+        default=0.1,
+        help="Allowed increase of peak memory compared to baseline (default: 0.1)",
+    )
+    args = parser.parse_args()
+
+    logger = logging.getLogger("benchmark")
+    benchmarks = Benchmarks(logger)
+    sizes = [int(size) for size in args.sizes.split(",")]
+
+    results = {}
+    print(
+        "%-20s %7s %6s %11s %12s %14s %11s"
+        % (
+            "benchmark",
+            "size",
+            "runs",
+            "best [ms]",
+            "items/s",
+            "retained [KiB]",
+            "peak [KiB]",
+        )
+    )
+    for name in benchmarks.names():
+        if args.filter not in name:
+            continue
+        for size in sizes:
+            result = measure(benchmarks, name, size)
+            results["%s/%d" % (name, size)] = result
+            print(
+                "%-20s %7d %6d %11.3f %12d %14.1f %11.1f"
+                % (
+                    name,
+                    size,
+                    result["runs"],
+                    result["best_ms"],
+                    result["items_per_s"],
+                    result["retained_kb"],
+                    result["peak_kb"],
+                )
+            )
+
+    baseline = {}
+    if os.path.exists(args.baseline):
+        with open(args.baseline, encoding="utf-8") as fh:
+            baseline = json.load(fh)
+    # Save all results with --save, otherwise only those not in the baseline
+    # (all on the first run on this machine)
+    new_results = {
+        key: result
+        for key, result in results.items()
+        if args.save or key not in baseline
+    }
+    if new_results:
+        baseline.update(new_results)
+        with open(args.baseline, "w", encoding="utf-8") as fh:
+            json.dump(baseline, fh, indent=2, sort_keys=True)
+            fh.write("\n")
+        print("%d results saved to baseline %s" % (len(new_results), args.baseline))
+    if args.save:
+        return 0
+
+    regressions = compare(results, baseline, args.time_tolerance, args.memory_tolerance)
+    if regressions:
+        print("Regressions compared to baseline:")
+        for regression in regressions:
+            print("  %s" % regression)
+        return 1
+    print("No regressions compared to baseline")
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
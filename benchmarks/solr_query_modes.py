@@ -0,0 +1,97 @@
+"""Compare the standard and eDisMax Solr query modes.
+
+Runs every search text of a file against the configured Solr backend with
+both query builders and reports latency percentiles and the overlap of the
+returned documents.
+
+Usage:
+
+    PYTHONPATH=$PWD/src CONFIG_PATH=<CONFIG_PATH> \
+        python benchmarks/solr_query_modes.py searchtexts.txt --repeat 5
+"""
+
+import argparse
+import logging
+import statistics
+import time
+
+from solr_search_service import SolrClient
+
+MODES = ["standard", "edismax"]
+
+
+def percentile(values, p):
+    values = sorted(values)
+    return values[min(int(len(values) * p / 100), len(values) - 1)]
+
+
+def run_query(client, mode, searchtext, limit, solr_facets):
+    """Run a single query and return duration and result document IDs."""
+    client.query_mode = mode
+    (filterword, tokens) = client.tokenize(searchtext)
+    start = time.perf_counter()
+    response = client.query(
+        tokens, filterword, list(solr_facets.keys()), limit, solr_facets
+    )
+    duration = time.perf_counter() - start
+    if type(response) is tuple:
+        raise Exception("Solr error for '%s': %s" % (searchtext, response[0]))
+    if client.group_by_facet:
+        response = client.ungroup_response(response, limit)
+    return duration, [doc["id"] for doc in response["response"]["docs"]]
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split("\n")[0])
+    parser.add_argument("searchtexts", help="File with one search text per line")
+    parser.add_argument("--tenant", default="default", help="Tenant name")
+    parser.add_argument("--limit", type=int, default=50, help="Result limit")
+    parser.add_argument("--repeat", type=int, default=3, help="Runs per query")
+    args = parser.parse_args()
+
+    logger = logging.getLogger("benchmark")
+    client = SolrClient(args.tenant, logger)
+    solr_facets = client.resources.solr_facets(None)
+    with open(args.searchtexts, encoding="utf-8") as fh:
+        searchtexts = [line.strip() for line in fh if line.strip()]
+
+    durations = {mode: [] for mode in MODES}
+    overlaps = []
+    top10_overlaps = []
+    for searchtext in searchtexts:
+        ids = {}
+        # alternate modes to spread caching effects evenly
+        for i in range(args.repeat):
+            for mode in MODES:
+                duration, ids[mode] = run_query(
+                    client, mode, searchtext, args.limit, solr_facets
+                )
+                durations[mode].append(duration)
+
+        standard, edismax = set(ids["standard"]), set(ids["edismax"])
+        if standard or edismax:
+            overlaps.append(len(standard & edismax) / len(standard | edismax))
+        top10 = set(ids["standard"][:10])
+        if top10:
+            top10_overlaps.append(len(top10 & set(ids["edismax"][:10])) / len(top10))
+
+    print("%d search texts, %d runs each" % (len(searchtexts), args.repeat))
+    print("%-10s %10s %10s %10s" % ("mode", "p50 [ms]", "p95 [ms]", "p99 [ms]"))
+    for mode in MODES:
+        print(
+            "%-10s %10.1f %10.1f %10.1f"
+            % (
+                mode,
+                percentile(durations[mode], 50) * 1000,
+                percentile(durations[mode], 95) * 1000,
+                percentile(durations[mode], 99) * 1000,
+            )
+        )
+    if overlaps:
+        print("Mean result overlap (Jaccard): %.3f" % statistics.mean(overlaps))
+    if top10_overlaps:
+        print("Mean top 10 recall vs. standard: %.3f" % statistics.mean(top10_overlaps))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,281 @@
+"""Run the search service against stub Solr and Postgres stand-ins.
+
+Starts a stub Solr HTTP server returning synthetic results and uses an
+SQLite database with synthetic features instead of Postgres, then runs the
+search service with a generated config, e.g. as target for
+benchmarks/replay_query_log.py without any production backends.
+
+Usage:
+
+    PYTHONPATH=$PWD/src python benchmarks/stub_backends.py --backend solr
+    PYTHONPATH=$PWD/src python benchmarks/stub_backends.py --backend pg \
+        --features 100000 --port 5000
+
+The stubs only mimic the backend response formats, latencies are controlled
+with --solr-latency and by the number of features.
+"""
+
+import argparse
+import json
+import os
+import itertools
+import random
+import re
+import sqlite3
+import tempfile
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs, urlparse
+
+from sqlalchemy import event
+from sqlalchemy.engine import Engine
+
+DATASETS = ["stub_addresses", "stub_parcels", "stub_buildings"]
+DATAPRODUCTS = ["stub_layer_%d" % i for i in range(20)]
+
+FEATURE_QUERY = """
+    SELECT display, facet_id, feature_id, 'id' AS id_field_name, 0 AS id_in_quotes,
+        bbox, 2056 AS srid, sort_key
+    FROM (
+        SELECT display, facet AS facet_id, id AS feature_id, bbox, display AS sort_key,
+            row_number() OVER (PARTITION BY facet ORDER BY display, id) AS rn
+        FROM search_v
+        WHERE display LIKE '%' || :term || '%'
+            AND (:cursor_sort IS NULL OR (display, id) > (:cursor_sort, :cursor_id))
+    ) AS results
+    WHERE rn <= :facetlimit
+    ORDER BY sort_key, feature_id
+"""
+
+LAYER_QUERY = """
+    SELECT display, dataproduct_id, 1 AS dset_info, stacktype, NULL AS sublayers
+    FROM layers
+    WHERE display LIKE '%' || :term || '%'
+    ORDER BY display
+"""
+
+
+def bbox(i):
+    x = 2600000 + i % 1000 * 10
+    y = 1200000 + i // 1000 * 10
+    return [x, y, x + 10, y + 10]
+
+
+class StubSolrHandler(BaseHTTPRequestHandler):
+    """Return synthetic Solr responses for select requests."""
+
+    latency = 0
+    # Number of matching documents per search
+    num_docs = 1000
+
+    def do_GET(self):
+        if self.latency:
+            time.sleep(random.expovariate(1 / self.latency))
+        params = parse_qs(urlparse(self.path).query)
+        rows = int(params.get("rows", [10])[0])
+        # Stub cursor marks are document offsets
+        cursor_mark = params.get("cursorMark", [None])[0]
+        offset = int(cursor_mark) if cursor_mark not in [None, "*"] else 0
+        # Only return documents of the facets in the filter query
+        facets = re.findall(r"facet:(\w+)", params.get("fq", [""])[0])
+        docs = []
+        matches = (
+            i
+            for i in range(self.num_docs)
+            if DATASETS[i % len(DATASETS)] in facets or not facets
+        )
+        for i in itertools.islice(matches, offset, offset + rows):
+            dataset = DATASETS[i % len(DATASETS)]
+            docs.append(
+                {
+                    "id": json.dumps([dataset, str(i)]),
+                    "display": "%s %d" % (dataset, i),
+                    "facet": dataset,
+                    "idfield_meta": json.dumps(["id", "id:n"]),
+                    "bbox": json.dumps(bbox(i)),
+                    "srid": 2056,
+                }
+            )
+        facet_counts = []
+        for dataset in DATASETS:
+            facet_counts += [dataset, self.num_docs]
+        response = {
+            "response": {"numFound": self.num_docs, "docs": docs},
+            "facet_counts": {"facet_fields": {"facet": facet_counts}},
+        }
+        if cursor_mark is not None:
+            response["nextCursorMark"] = str(offset + len(docs))
+        body = json.dumps(response).encode()
+        self.send_response(200)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass
+
+
+class Extent:
+    """ST_Extent stand-in as SQLite window aggregate over bbox JSON columns."""
+
+    def __init__(self):
+        self.boxes = []
+
+    def step(self, value):
+        self.boxes.append(json.loads(value))
+
+    def inverse(self, value):
+        self.boxes.remove(json.loads(value))
+
+    def value(self):
+        if not self.boxes:
+            return None
+        return "BOX(%f %f,%f %f)" % (
+            min(b[0] for b in self.boxes),
+            min(b[1] for b in self.boxes),
+            max(b[2] for b in self.boxes),
+            max(b[3] for b in self.boxes),
+        )
+
+    def finalize(self):
+        return self.value()
+
+
+def register_postgis_stubs(dbapi_connection, connection_record):
+    """Register PostGIS functions used by the geometry query on SQLite."""
+    if not isinstance(dbapi_connection, sqlite3.Connection):
+        return
+    dbapi_connection.create_function("ST_CurveToLine", 1, lambda geom: geom)
+    dbapi_connection.create_function(
+        "ST_AsGeoJSON",
+        1,
+        lambda geom: json.dumps({"type": "Polygon", "coordinates": [bbox_ring(geom)]}),
+    )
+    dbapi_connection.create_function("ST_Srid", 1, lambda geom: 2056)
+    dbapi_connection.create_window_function("ST_Extent", 1, Extent)
+
+
+def bbox_ring(geom):
+    xmin, ymin, xmax, ymax = json.loads(geom)
+    return [[xmin, ymin], [xmax, ymin], [xmax, ymax], [xmin, ymax], [xmin, ymin]]
+
+
+def create_db(path, num_features):
+    conn = sqlite3.connect(path)
+    conn.execute(
+        "CREATE TABLE search_v (id INTEGER PRIMARY KEY, display TEXT, facet TEXT, bbox TEXT, geom TEXT)"
+    )
+    conn.executemany(
+        "INSERT INTO search_v VALUES (?, ?, ?, ?, ?)",
+        (
+            (
+                i,
+                "Street %d, %d Town" % (i % 200, 1000 + i % 5000),
+                DATASETS[i % len(DATASETS)],
+                json.dumps(bbox(i)),
+                json.dumps(bbox(i)),
+            )
+            for i in range(num_features)
+        ),
+    )
+    conn.execute("CREATE INDEX search_v_facet_idx ON search_v (facet)")
+    conn.execute(
+        "CREATE TABLE layers (display TEXT, dataproduct_id TEXT, stacktype TEXT)"
+    )
+    conn.executemany(
+        "INSERT INTO layers VALUES (?, ?, ?)",
+        (("Layer %s" % name, name, "foreground") for name in DATAPRODUCTS),
+    )
+    conn.commit()
+    conn.close()
+
+
+def write_config(config_path, backend, db_url, solr_url):
+    tenant_path = os.path.join(config_path, "default")
+    os.makedirs(tenant_path)
+    config = {
+        "service": "search",
+        "config": {
+            "search_backend": backend,
+            "solr_service_url": solr_url,
+            "db_url": db_url,
+            "pg_feature_query": FEATURE_QUERY,
+            "pg_layer_query": LAYER_QUERY,
+            "suggest_query": "SELECT display, facet AS facet_id FROM search_v",
+            "solr_suggest": True,
+        },
+        "resources": {
+            "facets": [
+                {
+                    "name": dataset,
+                    "filter_word": dataset.split("_")[1].capitalize(),
+                    "table_name": "search_v",
+                    "geometry_column": "geom",
+                    "search_id_col": "id",
+                    "facet_column": "facet",
+                }
+                for dataset in DATASETS
+            ]
+            + [{"name": "foreground", "filter_word": "Map"}]
+        },
+    }
+    permissions = {
+        "users": [],
+        "groups": [],
+        "roles": [
+            {
+                "role": "public",
+                "permissions": {"solr_facets": ["*"], "dataproducts": ["*"]},
+            }
+        ],
+    }
+    with open(os.path.join(tenant_path, "searchConfig.json"), "w") as fh:
+        json.dump(config, fh, indent=2)
+    with open(os.path.join(tenant_path, "permissions.json"), "w") as fh:
+        json.dump(permissions, fh, indent=2)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split("\n")[0])
+    parser.add_argument("--backend", choices=["solr", "pg"], default="solr")
+    parser.add_argument("--port", type=int, default=5000, help="Service port")
+    parser.add_argument("--solr-port", type=int, default=8999, help="Stub Solr port")
+    parser.add_argument(
+        "--solr-latency",
+        type=float,
+        default=0.02,
+        help="Mean stub Solr latency in seconds (exponentially distributed)",
+    )
+    parser.add_argument(
+        "--features", type=int, default=10000, help="Number of stub DB features"
+    )
+    args = parser.parse_args()
+
+    tmpdir = tempfile.mkdtemp(prefix="search-stubs-")
+    db_path = os.path.join(tmpdir, "stub.sqlite")
+    create_db(db_path, args.features)
+    event.listen(Engine, "connect", register_postgis_stubs)
+
+    StubSolrHandler.latency = args.solr_latency
+    solr = ThreadingHTTPServer(("127.0.0.1", args.solr_port), StubSolrHandler)
+    threading.Thread(target=solr.serve_forever, daemon=True).start()
+
+    config_path = os.path.join(tmpdir, "config")
+    write_config(
+        config_path,
+        args.backend,
+        "sqlite:///%s" % db_path,
+        "http://127.0.0.1:%d/solr/gdi/select" % args.solr_port,
+    )
+    os.environ["CONFIG_PATH"] = config_path
+    print("Stub config and database in %s" % tmpdir)
+
+    import server
+
+    server.app.run(host="localhost", port=args.port, threaded=True)
+
+
+if __name__ == "__main__":
+    main()
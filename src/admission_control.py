@@ -0,0 +1,274 @@
+import math
+import threading
+import time
+from contextlib import contextmanager
+
+# Weight of the latest request latency in the moving average
+LATENCY_EWMA_WEIGHT = 0.1
+
+# Concurrency limiters per tenant, shared by all handlers of the tenant
+tenant_limiters = {}
+# Concurrency limiters per backend, shared by all tenants of the process
+backend_limiters = {}
+limiters_lock = threading.Lock()
+
+
+def strictest_settings(settings):
+    """Return strictest of limit settings tuples.
+
+    :param iterable settings: Tuples of ConcurrencyLimiter settings
+    """
+    (max_limits, queue_sizes, queue_timeouts, target_latencies) = zip(*settings)
+    target_latencies = [latency for latency in target_latencies if latency > 0]
+    return (
+        min(max_limits),
+        min(queue_sizes),
+        min(queue_timeouts),
+        min(target_latencies) if target_latencies else 0.0,
+    )
+
+
+class AdmissionRejected(Exception):
+    """Request rejected by admission control"""
+
+    def __init__(self, status, retry_after):
+        """Constructor
+
+        :param int status: HTTP status code (429 or 503)
+        :param int retry_after: Retry-After in seconds
+        """
+        if status == 429:
+            error = "Too many search requests"
+        else:
+            error = "Search backend overloaded"
+        Exception.__init__(self, error)
+        self.error = error
+        self.status = status
+        self.retry_after = retry_after
+
+    def response(self):
+        """Return error response tuple."""
+        return (
+            {"error": self.error},
+            self.status,
+            {"Retry-After": str(self.retry_after)},
+        )
+
+
+class ConcurrencyLimiter:
+    """ConcurrencyLimiter class
+
+    Limits the number of concurrent requests, with a bounded queue of waiting
+    requests. If a target latency is set, the limit adapts to the observed
+    request latency: it decreases multiplicatively while the moving average
+    latency exceeds the target, and increases additively up to the max limit
+    otherwise.
+    """
+
+    def __init__(self, max_limit, queue_size, queue_timeout, target_latency):
+        """Constructor
+
+        :param int max_limit: Max number of concurrent requests
+        :param int queue_size: Max number of waiting requests
+        :param float queue_timeout: Max seconds a request waits in the queue
+        :param float target_latency: Target latency in seconds, 0 for a fixed limit
+        """
+        self.max_limit = max_limit
+        self.queue_size = queue_size
+        self.queue_timeout = queue_timeout
+        self.target_latency = target_latency
+
+        self.limit = float(max_limit)
+        self.latency = None
+        self.active = 0
+        self.waiting = 0
+        self.cond = threading.Condition()
+        # Settings of the AdmissionControls sharing this limiter
+        self.users = {}
+
+    def settings(self):
+        """Return tuple of limit settings."""
+        return (
+            self.max_limit,
+            self.queue_size,
+            self.queue_timeout,
+            self.target_latency,
+        )
+
+    def configure(self, max_limit, queue_size, queue_timeout, target_latency):
+        """Change limit settings.
+
+        :param int max_limit: Max number of concurrent requests
+        :param int queue_size: Max number of waiting requests
+        :param float queue_timeout: Max seconds a request waits in the queue
+        :param float target_latency: Target latency in seconds, 0 for a fixed limit
+        """
+        with self.cond:
+            self.max_limit = max_limit
+            self.queue_size = queue_size
+            self.queue_timeout = queue_timeout
+            self.target_latency = target_latency
+            if target_latency > 0:
+                # adaptive limit is raised again up to the new max limit
+                self.limit = min(self.limit, float(max_limit))
+            else:
+                self.limit = float(max_limit)
+            self.cond.notify_all()
+
+    def current_limit(self):
+        """Return current concurrency limit."""
+        return max(1, int(self.limit))
+
+    def acquire(self):
+        """Wait for a free slot and return whether it was acquired."""
+        with self.cond:
+            if self.active < self.current_limit():
+                self.active += 1
+                return True
+            if self.waiting >= self.queue_size:
+                return False
+            self.waiting += 1
+            try:
+                deadline = time.monotonic() + self.queue_timeout
+                while self.active >= self.current_limit():
+                    timeout = deadline - time.monotonic()
+                    if timeout <= 0:
+                        return False
+                    self.cond.wait(timeout)
+                self.active += 1
+                return True
+            finally:
+                self.waiting -= 1
+
+    def release(self, duration=None):
+        """Release slot and adapt limit to the request latency.
+
+        :param float duration: Request duration in seconds, None if not run
+        """
+        with self.cond:
+            self.active -= 1
+            if self.target_latency > 0 and duration is not None:
+                if self.latency is None:
+                    self.latency = duration
+                else:
+                    self.latency += LATENCY_EWMA_WEIGHT * (duration - self.latency)
+                if self.latency > self.target_latency:
+                    self.limit = max(1.0, self.limit * 0.9)
+                else:
+                    self.limit = min(self.max_limit, self.limit + 1 / self.limit)
+            self.cond.notify_all()
+
+    def retry_after(self):
+        """Return suggested Retry-After in seconds."""
+        return max(1, math.ceil(self.latency or self.queue_timeout))
+
+
+class AdmissionControl:
+    """AdmissionControl class
+
+    Limits the concurrent requests of a tenant, shared by the search and
+    geometry handlers of the tenant, and the concurrent requests of all
+    tenants to a shared backend. Requests over the tenant limit are rejected
+    with 429, requests over the backend limit with 503, after waiting at most
+    the queue timeout.
+
+    If tenants configure different settings for a shared backend, the
+    strictest settings of the currently registered handlers apply to all of
+    them. Handlers call close() when they are evicted or replaced.
+    """
+
+    def __init__(self, config, tenant, backend, metrics, logger):
+        """Constructor
+
+        :param RuntimeConfig config: Config handler
+        :param str tenant: Tenant name
+        :param str backend: Backend key, e.g. DB URL or Solr URL
+        :param SearchMetrics metrics: Metrics counting rejected requests
+        :param Logger logger: Application logger
+        """
+        self.metrics = metrics
+        self.logger = logger
+
+        queue_size = config.get("admission_queue_size", 10)
+        queue_timeout = config.get("admission_queue_timeout", 0.5)
+        target_latency = config.get("admission_target_latency", 0.0)
+
+        # Concurrent requests of this tenant, 0 for no limit
+        self.tenant_limiter = None
+        tenant_limit = config.get("admission_tenant_max_concurrent", 0)
+        if tenant_limit > 0:
+            settings = (tenant_limit, queue_size, queue_timeout, target_latency)
+            with limiters_lock:
+                limiter = tenant_limiters.get(tenant)
+                if limiter is None or limiter.settings() != settings:
+                    # new tenant or changed tenant config
+                    limiter = ConcurrencyLimiter(*settings)
+                    tenant_limiters[tenant] = limiter
+                self.tenant_limiter = limiter
+
+        # Concurrent requests of all tenants to the backend, 0 for no limit
+        self.backend = backend
+        self.backend_limiter = None
+        backend_limit = config.get("admission_backend_max_concurrent", 0)
+        if backend_limit > 0 and backend:
+            settings = (backend_limit, queue_size, queue_timeout, target_latency)
+            with limiters_lock:
+                limiter = backend_limiters.get(backend)
+                if limiter is None:
+                    limiter = ConcurrencyLimiter(*settings)
+                    backend_limiters[backend] = limiter
+                elif limiter.settings() != settings:
+                    logger.warning(
+                        "Admission settings of tenant %s differ from other "
+                        "tenants of the same backend, using the strictest settings"
+                        % tenant
+                    )
+                limiter.users[self] = settings
+                limiter.configure(*strictest_settings(limiter.users.values()))
+                self.backend_limiter = limiter
+
+    def close(self):
+        """Remove settings of a closed handler from the backend limiter."""
+        if self.backend_limiter is None:
+            return
+        with limiters_lock:
+            users = self.backend_limiter.users
+            users.pop(self, None)
+            if users:
+                # settings of the remaining handlers
+                self.backend_limiter.configure(*strictest_settings(users.values()))
+            elif backend_limiters.get(self.backend) is self.backend_limiter:
+                del backend_limiters[self.backend]
+
+    @contextmanager
+    def admit(self):
+        """Context manager admitting a request.
+
+        Raises AdmissionRejected if the request is over the limits.
+        """
+        acquired = []
+        for limiter, status in [
+            (self.tenant_limiter, 429),
+            (self.backend_limiter, 503),
+        ]:
+            if limiter is None:
+                continue
+            if not limiter.acquire():
+                for acquired_limiter in acquired:
+                    acquired_limiter.release()
+                event = "tenant" if status == 429 else "backend"
+                self.metrics.inc("admission_rejected_%s" % event)
+                self.logger.warning(
+                    "Search request rejected, %s concurrency limit %d reached"
+                    % (event, limiter.current_limit())
+                )
+                raise AdmissionRejected(status, limiter.retry_after())
+            acquired.append(limiter)
+
+        start = time.monotonic()
+        try:
+            yield
+        finally:
+            duration = time.monotonic() - start
+            for limiter in acquired:
+                limiter.release(duration)
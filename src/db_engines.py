@@ -0,0 +1,75 @@
+import os
+import threading
+
+from qwc_services_core.database import DatabaseEngine
+
+# Engines shared by all handlers of the process, as [engine, number of users]
+# keyed by DB URL and pool settings
+shared_engines = {}
+shared_engines_lock = threading.Lock()
+
+# Delay in seconds before releasing engines acquired after release(), for
+# requests still using a released handler
+RELEASE_DELAY = 60
+
+# Environment variables with the pool settings of DatabaseEngine
+POOL_SETTINGS = [
+    "ENABLE_POOLING",
+    "POOL_SIZE",
+    "MAX_OVERFLOW",
+    "POOL_TIMEOUT",
+    "POOL_RECYCLE",
+]
+
+
+class SharedDatabaseEngine(DatabaseEngine):
+    """SharedDatabaseEngine class
+
+    DatabaseEngine returning engines shared with all other handlers of the
+    process, so that tenants with the same DB URL use a single connection
+    pool. An engine is disposed once all handlers using it are released.
+    Engines acquired by requests still using a released handler are released
+    again after a delay.
+    """
+
+    def __init__(self):
+        """Constructor"""
+        DatabaseEngine.__init__(self)
+        # Keys of the shared engines used by this handler
+        self.keys = set()
+        self.released = False
+        # Pending release of engines acquired after release()
+        self.release_timer = None
+
+    def db_engine(self, conn_str):
+        """Return shared engine.
+
+        :param str conn_str: DB connection string for SQLAlchemy engine
+        """
+        key = (conn_str,) + tuple(os.environ.get(name) for name in POOL_SETTINGS)
+        with shared_engines_lock:
+            if key not in shared_engines:
+                shared_engines[key] = [DatabaseEngine().db_engine(conn_str), 0]
+            entry = shared_engines[key]
+            if key not in self.keys:
+                entry[1] += 1
+                self.keys.add(key)
+                if self.released and self.release_timer is None:
+                    # acquired by a request still using a released handler
+                    self.release_timer = threading.Timer(RELEASE_DELAY, self.release)
+                    self.release_timer.daemon = True
+                    self.release_timer.start()
+            return entry[0]
+
+    def release(self):
+        """Release used engines and dispose engines without other users."""
+        with shared_engines_lock:
+            for key in self.keys:
+                entry = shared_engines[key]
+                entry[1] -= 1
+                if entry[1] <= 0:
+                    del shared_engines[key]
+                    entry[0].dispose()
+            self.keys = set()
+            self.released = True
+            self.release_timer = None
@@ -0,0 +1,142 @@
+import itertools
+import threading
+import time
+
+from sqlalchemy.exc import DBAPIError, TimeoutError
+from sqlalchemy.sql import text as sql_text
+
+# Replication lag in seconds, 0 on a primary, if all received WAL was
+# replayed (the last replay time is outdated without writes on the primary)
+# or if nothing was replayed yet
+REPLICATION_LAG_SQL = """
+    SELECT CASE
+        WHEN NOT pg_is_in_recovery() THEN 0
+        WHEN pg_last_wal_receive_lsn() = pg_last_wal_replay_lsn() THEN 0
+        ELSE COALESCE(
+            EXTRACT(EPOCH FROM now() - pg_last_xact_replay_timestamp()), 0
+        )
+        END AS lag
+"""
+
+
+class ReplicaRouter:
+    """ReplicaRouter class
+
+    Routes read-only queries of a database to its read replicas, configured
+    in `db_replicas` as a list of replica URLs per primary DB URL.
+
+    Connections are distributed round-robin across the healthy replicas of
+    a database. A replica is healthy if its last health check succeeded and
+    its replication lag was below `db_replica_max_lag`. Health checks run in
+    a background thread every `db_replica_check_interval` seconds. Queries
+    fall back to the primary if no replica is healthy, or if connecting to
+    the selected replica fails.
+    """
+
+    def __init__(self, db_engine, config, metrics, logger):
+        """Constructor
+
+        :param DatabaseEngine db_engine: Database engine with DB connections
+        :param RuntimeConfig config: Config handler
+        :param SearchMetrics metrics: Metrics counting replica fallbacks
+        :param Logger logger: Application logger
+        """
+        self.db_engine = db_engine
+        self.metrics = metrics
+        self.logger = logger
+
+        # Lists of replica URLs per primary DB URL
+        self.replicas = config.get("db_replicas", {})
+        self.max_lag = config.get("db_replica_max_lag", 30.0)
+        self.check_interval = config.get("db_replica_check_interval", 10.0)
+
+        # Replicas which passed the last health check
+        self.healthy = set()
+        self.round_robin = {
+            db_url: itertools.cycle(replicas)
+            for db_url, replicas in self.replicas.items()
+        }
+        # Time of next health check
+        self.next_check = 0
+        self.checking = False
+        self.lock = threading.Lock()
+
+    def route(self, db_url):
+        """Return URL of a healthy replica of a DB, or the DB URL itself.
+
+        :param str db_url: Primary DB URL
+        """
+        replicas = self.replicas.get(db_url)
+        if not replicas:
+            return db_url
+        self.check_if_stale()
+        with self.lock:
+            for i in range(len(replicas)):
+                replica_url = next(self.round_robin[db_url])
+                if replica_url in self.healthy:
+                    return replica_url
+        return db_url
+
+    def urls(self, db_url):
+        """Return DB URL and the URLs of its healthy replicas.
+
+        :param str db_url: Primary DB URL
+        """
+        with self.lock:
+            return [db_url] + [
+                replica_url
+                for replica_url in self.replicas.get(db_url, [])
+                if replica_url in self.healthy
+            ]
+
+    def connect(self, db_url):
+        """Return new connection to a replica of a DB, or to the DB itself.
+
+        :param str db_url: Primary DB URL
+        """
+        url = self.route(db_url)
+        if url == db_url:
+            return self.db_engine.db_engine(db_url).connect()
+        try:
+            return self.db_engine.db_engine(url).connect()
+        except (DBAPIError, TimeoutError) as e:
+            # connection failed or replica pool exhausted
+            self.logger.warning("Could not connect to replica, using primary: %s" % e)
+            self.metrics.inc("replica_fallback")
+            with self.lock:
+                self.healthy.discard(url)
+            return self.db_engine.db_engine(db_url).connect()
+
+    def check_if_stale(self):
+        """Start a background health check if the last check is outdated."""
+        if time.time() < self.next_check:
+            return
+        with self.lock:
+            if self.checking:
+                return
+            self.checking = True
+        threading.Thread(target=self.check, daemon=True).start()
+
+    def check(self):
+        """Check health and replication lag of all replicas."""
+        try:
+            healthy = set()
+            for replica_url in set(itertools.chain(*self.replicas.values())):
+                try:
+                    engine = self.db_engine.db_engine(replica_url)
+                    with engine.connect() as conn:
+                        lag = conn.execute(sql_text(REPLICATION_LAG_SQL)).scalar()
+                except Exception as e:
+                    self.logger.warning("Replica health check failed: %s" % e)
+                    continue
+                if lag > self.max_lag:
+                    self.logger.warning(
+                        "Replica lag of %.1fs exceeds %.1fs" % (lag, self.max_lag)
+                    )
+                    continue
+                healthy.add(replica_url)
+            with self.lock:
+                self.healthy = healthy
+        finally:
+            self.next_check = time.time() + self.check_interval
+            self.checking = False
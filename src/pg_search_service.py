@@ -1,20 +1,36 @@
+import heapq
 import json
 import os
 import re
 import time
+from collections import Counter
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import ExitStack, contextmanager, nullcontext
 
-from flask import json
+from flask import copy_current_request_context, has_request_context, json
 from jinja2 import Template
-from qwc_services_core.database import DatabaseEngine
 from qwc_services_core.permissions_reader import PermissionsReader
 from qwc_services_core.runtime_config import RuntimeConfig
+from sqlalchemy.exc import DBAPIError
 from sqlalchemy.sql import literal
 from sqlalchemy.sql import text as sql_text
 
+from admission_control import AdmissionControl, AdmissionRejected
+from db_engines import SharedDatabaseEngine
+from db_replicas import ReplicaRouter
+from search_cursor import decode_cursor, encode_cursor
+from search_deadline import DeadlineExceeded, is_query_canceled, request_deadline
+from search_metrics import SearchMetrics
 from search_resources import SearchResources
+from search_spatial import spatial_params
+from search_tokens import TokenPipeline
+from slow_query_log import SlowQueryLog
+from suggest_index import SuggestIndex
 
 FILTERWORD_CHARS = os.environ.get("FILTERWORD_CHARS", r"\w.")
 FILTERWORD_RE = re.compile(f"^([{FILTERWORD_CHARS}]+):\b*")
+# sort_key column of feature queries supporting cursors
+SORT_KEY_RE = re.compile(r'\bAS\s+"?sort_key"?(?!\w)', re.IGNORECASE)
 
 
 class PgClient:
@@ -53,7 +69,8 @@ class PgClient:
         permissions = PermissionsReader(tenant, logger)
         self.resources = SearchResources(config, permissions)
 
-        self.db_engine = DatabaseEngine()
+        # DB engines shared with other tenants using the same DB
+        self.db_engine = SharedDatabaseEngine()
         self.db_url = config.get("db_url")
         self.filter_word_query = config.get(
             "pg_filter_word_query", config.get("trgm_filter_word_query")
@@ -68,7 +85,43 @@ class PgClient:
         self.layer_query_template = config.get(
             "pg_layer_query_template", config.get("trgm_layer_query_template")
         )
+        # Compile query templates once
+        if self.feature_query_template:
+            self.feature_query_template = Template(self.feature_query_template)
+        if self.layer_query_template:
+            self.layer_query_template = Template(self.layer_query_template)
         self.similarity_threshold = config.get("trgm_similarity_threshold", 0.3)
+        # Counts of facets with more than facet_search_limit results:
+        # none (-1), estimate (planner row estimate) or capped (count up to count cap)
+        self.count_strategy = config.get("pg_count_strategy", "none")
+        self.count_cap = config.get("pg_count_cap", 10000)
+        self.count_timeout = config.get("pg_count_timeout", 0.5)
+        # Truncate feature results and count results per facet in SQL
+        self.sql_facet_counts = config.get("pg_sql_facet_counts", False)
+        # Share of the request deadline for the layer query if features are also searched
+        self.layer_timeout_share = config.get("pg_layer_query_timeout_share", 0.3)
+
+        self.metrics = SearchMetrics(tenant, "pg")
+        self.token_pipeline = TokenPipeline(config, self.metrics, logger)
+        self.slow_query_log = SlowQueryLog(config, logger)
+        self.admission = AdmissionControl(
+            config, tenant, self.db_url, self.metrics, logger
+        )
+        self.replicas = ReplicaRouter(self.db_engine, config, self.metrics, logger)
+        # Concurrent feature queries if facets are in different DBs (facet db_url)
+        self.fanout_executor = None
+        if len(self.db_facets(self.facets)) > 1:
+            self.fanout_executor = ThreadPoolExecutor(
+                max_workers=config.get("pg_fanout_workers", 8),
+                thread_name_prefix="pg_fanout",
+            )
+        # In-memory prefix index for suggestions, if a suggest query is configured
+        self.suggest_query = config.get("suggest_query")
+        self.suggest_index = None
+        if self.suggest_query:
+            self.suggest_index = SuggestIndex(
+                self.resources, self.suggest_entries, config, logger
+            )
 
     def sql_escape(self, string):
         return str(
@@ -78,16 +131,137 @@ class PgClient:
             )
         )[1:-1]
 
-    def search(self, identity, searchtext, searchfilter, limit):
-        (filterword, tokens) = self.tokenize(searchtext)
+    def setup_statements(self, engine):
+        """Return list of (sql, params) statements to run on new connections.
+
+        :param Engine engine: DB engine
+        """
+        if engine.dialect.name != "postgresql":
+            # e.g. SQLite stand-in for load tests
+            return []
+        return [
+            (
+                "SET pg_trgm.similarity_threshold = :value",
+                {"value": self.similarity_threshold},
+            )
+        ]
+
+    @contextmanager
+    def connect(self, db_url=None):
+        """Context manager returning a DB connection for searches.
+
+        The connection is to a healthy read replica of the DB, if configured.
+
+        :param str db_url: DB URL, None for the default DB
+        """
+        with self.replicas.connect(db_url or self.db_url) as conn:
+            for sql, params in self.setup_statements(conn.engine):
+                conn.execute(sql_text(sql), params)
+            # Keep settings if a later transaction on this connection is rolled back
+            conn.commit()
+            yield conn
+
+    def warmup(self):
+        """Open and validate the connections of the DB and replica pools."""
+        self.replicas.check()
+        db_urls = set([self.db_url] + list(self.db_facets(self.facets).keys()))
+        for db_url in db_urls:
+            for url in self.replicas.urls(db_url):
+                engine = self.db_engine.db_engine(url)
+                # QueuePool keeps up to pool size idle connections
+                pool_size = getattr(engine.pool, "size", lambda: 1)()
+                with ExitStack() as stack:
+                    for i in range(pool_size):
+                        conn = stack.enter_context(engine.connect())
+                        conn.execute(sql_text("SELECT 1"))
+        if self.suggest_index:
+            self.suggest_index.warmup()
+
+    def close(self):
+        """Release the DB pools and threads of an evicted handler."""
+        if self.fanout_executor is not None:
+            self.fanout_executor.shutdown(wait=False)
+        self.slow_query_log.close()
+        self.admission.close()
+        self.db_engine.release()
+
+    def suggest_entries(self):
+        """Return (display, facet) tuples for the suggest index."""
+        with self.connect() as conn:
+            result = conn.execute(sql_text(self.suggest_query)).mappings()
+            return [(row["display"], row["facet_id"]) for row in result]
+
+    def search(
+        self,
+        identity,
+        searchtext,
+        searchfilter,
+        limit,
+        cursor=None,
+        permissions=None,
+        conn=None,
+        spatial=None,
+    ):
+        """Search for searchtext and return the results.
+
+        :param obj identity: User identity
+        :param str searchtext: Search string with optional filter word
+        :param list(str) searchfilter: Facets to search in, all if empty
+        :param int limit: Max number of results
+        :param str cursor: Continuation token for next results of a facet
+        :param tuple permissions: Permitted (solr_facets, dataproducts) if already resolved
+        :param Connection conn: DB connection from connect(), or None for a new connection
+        :param obj spatial: Map center and extent from parse_spatial(), or None
+        """
+        try:
+            with self.admission.admit():
+                return self.run_search(
+                    identity,
+                    searchtext,
+                    searchfilter,
+                    limit,
+                    cursor,
+                    permissions,
+                    conn,
+                    spatial,
+                )
+        except AdmissionRejected as e:
+            return e.response()
+
+    def run_search(
+        self,
+        identity,
+        searchtext,
+        searchfilter,
+        limit,
+        cursor,
+        permissions,
+        conn,
+        spatial=None,
+    ):
+        """Search for searchtext after admission, see search()."""
+        with self.metrics.phase("tokenize"):
+            (filterword, tokens) = self.tokenize(searchtext)
         if not tokens:
             return {"results": [], "result_counts": []}
         if filterword:
             searchfilter = [self.filterwords.get(filterword)]
 
+        # Continue search in a single facet after the cursor position
+        cursor_position = None
+        if cursor:
+            try:
+                (cursor_facet, cursor_position) = decode_cursor(cursor)
+            except ValueError as e:
+                self.logger.info(str(e))
+                return ({"error": "Invalid cursor"}, 400)
+            searchfilter = [cursor_facet]
+
         # Determine permitted facets and dataproducts
-        search_facets = self.resources.solr_facets(identity)
-        permitted_dataproducts = self.resources.dataproducts(identity)
+        if permissions is None:
+            with self.metrics.phase("perm"):
+                permissions = self.resources.permitted(identity)
+        (search_facets, permitted_dataproducts) = permissions
         if not searchfilter:
             # use all permitted facets if filter is empty
             search_facets = list(search_facets.keys())
@@ -102,6 +276,9 @@ class PgClient:
         search_dp = list(
             filter(lambda facet: facet in ["foreground", "background"], search_facets)
         )
+        if cursor:
+            # Layer results are not paginated
+            search_dp = []
         self.logger.debug("Searching in datasets: %s" % ",".join(search_ds))
         self.logger.debug("Search for dataproducts: %s" % ",".join(search_dp))
 
@@ -109,80 +286,456 @@ class PgClient:
             limit = self.default_search_limit
 
         # Prepare query
-        layer_query = self.layer_query
-        if self.layer_query_template:
-            layer_query = Template(self.layer_query_template).render(
-                searchtext=self.sql_escape(searchtext),
-                words=list(map(self.sql_escape, tokens)),
-                facets=search_dp,
+        with self.metrics.phase("tpl"):
+            (layer_query, feature_query) = self.render_queries(
+                searchtext, tokens, search_dp, search_ds, cursor is not None, spatial
             )
-            self.logger.debug("Generated layer query from template")
-
-        feature_query = self.feature_query
-        if self.feature_query_template:
-            # NOTE: facet_search_limit + 1: we limit results to facet_search_limit below, but pass + 1 here to
-            # be able to detect whether there were actually more results than facet_search_limit
-            feature_query = Template(self.feature_query_template).render(
-                searchtext=self.sql_escape(searchtext),
-                words=list(map(self.sql_escape, tokens)),
-                facets=search_ds,
-                facetlimit=self.facet_search_limit + 1,
-            )
-            self.logger.debug("Generated feature query from template")
 
         # Perform search
         layer_results = []
         feature_results = []
-        with self.db_engine.db_engine(self.db_url).connect() as conn:
-            conn.execute(
-                sql_text("SET pg_trgm.similarity_threshold = :value"),
-                {"value": self.similarity_threshold},
-            )
-
+        facet_counts = {}
+        # Time budget of the request, split between layer and feature queries
+        deadline = request_deadline()
+        partial = False
+        with self.connect() if conn is None else nullcontext(conn) as conn:
             # Search for layers
             if search_dp and layer_query:
-                start = time.time()
-                self.logger.debug("Searching for layers: %s" % layer_query)
-                layer_results = (
-                    conn.execute(
-                        sql_text(layer_query),
-                        {
-                            "term": " ".join(tokens),
-                            "terms": tokens,
-                            "thres": self.similarity_threshold,
-                            "facets": search_dp,
-                        },
+                params = {
+                    "term": " ".join(tokens),
+                    "terms": tokens,
+                    "thres": self.similarity_threshold,
+                    "facets": search_dp,
+                    **spatial_params(spatial),
+                }
+                timeout = None
+                if deadline is not None:
+                    timeout = deadline.remaining()
+                    if search_ds and feature_query:
+                        timeout *= self.layer_timeout_share
+                try:
+                    with self.metrics.phase("db_layer"):
+                        layer_results = self.execute_query(
+                            conn, "layer_query", layer_query, params, timeout
+                        )
+                except DeadlineExceeded:
+                    self.logger.info("Layer query exceeded request deadline")
+                    partial = True
+
+            # Search for features in the DBs of the facets
+            if search_ds and feature_query:
+                db_facets = self.db_facets(search_ds)
+                if list(db_facets.keys()) == [self.db_url]:
+                    (
+                        feature_results,
+                        facet_counts,
+                        features_partial,
+                    ) = self.search_features(
+                        conn,
+                        searchtext,
+                        tokens,
+                        search_ds,
+                        feature_query,
+                        cursor_position,
+                        deadline,
+                        spatial,
+                        limit,
+                    )
+                else:
+                    (
+                        feature_results,
+                        facet_counts,
+                        features_partial,
+                    ) = self.search_features_fanout(
+                        conn,
+                        searchtext,
+                        tokens,
+                        db_facets,
+                        cursor_position,
+                        deadline,
+                        spatial,
+                        limit,
                     )
-                    .mappings()
-                    .all()
+                partial = partial or features_partial
+
+        with self.metrics.phase("build"):
+            result = self.build_results(
+                layer_results,
+                feature_results,
+                permitted_dataproducts,
+                search_ds,
+                limit,
+                facet_counts,
+            )
+        if partial:
+            result["partial"] = True
+        return result
+
+    def db_facets(self, facets):
+        """Return facets grouped by the DB URL of their search view.
+
+        :param list(str) facets: Facet names
+        """
+        db_facets = {}
+        for facet in facets:
+            db_url = self.facets.get(facet, {}).get("db_url", self.db_url)
+            db_facets.setdefault(db_url, []).append(facet)
+        return db_facets
+
+    def search_features(
+        self,
+        conn,
+        searchtext,
+        tokens,
+        facets,
+        feature_query,
+        cursor_position,
+        deadline,
+        spatial=None,
+        limit=None,
+    ):
+        """Run feature query and count truncated facets on a single DB.
+
+        Returns tuple (feature results, facet counts, partial).
+
+        :param Connection conn: DB connection
+        :param str searchtext: Search string
+        :param list(str) tokens: Search words
+        :param list(str) facets: Facets in this DB
+        :param str feature_query: Rendered feature query
+        :param list cursor_position: Keyset of last returned result, or None
+        :param Deadline deadline: Request deadline, or None
+        :param obj spatial: Map center and extent, or None
+        :param int limit: Max number of results, for pg_sql_facet_counts
+        """
+        feature_results = []
+        facet_counts = {}
+        partial = False
+        # NOTE: facet_search_limit + 1: we limit results to facet_search_limit below, but pass + 1 here to
+        # be able to detect whether there were actually more results than facet_search_limit
+        params = {
+            "term": " ".join(tokens),
+            "terms": tokens,
+            "thres": self.similarity_threshold,
+            "facets": facets,
+            "facetlimit": self.facet_search_limit + 1,
+            # Keyset of last returned result, see build_results()
+            "cursor_sort": cursor_position[0] if cursor_position else None,
+            "cursor_id": cursor_position[1] if cursor_position else None,
+            # Map center and extent
+            **spatial_params(spatial),
+        }
+        if self.sql_facet_counts and limit:
+            feature_query = self.truncated_query(feature_query)
+            params["result_limit"] = limit
+            params["facet_result_limit"] = self.facet_search_limit
+        timeout = deadline.remaining() if deadline is not None else None
+        try:
+            with self.metrics.phase("db_feature"):
+                feature_results = self.execute_query(
+                    conn, "feature_query", feature_query, params, timeout
                 )
-                self.logger.debug("Done in %f s" % (time.time() - start))
+        except DeadlineExceeded:
+            self.logger.info("Feature query exceeded request deadline")
+            partial = True
 
-            # Search for features
-            if search_ds and feature_query:
-                start = time.time()
-                self.logger.debug("Searching for features: %s" % feature_query)
-                # NOTE: facet_search_limit + 1: we limit results to facet_search_limit below, but pass + 1 here to
-                # be able to detect whether there were actually more results than facet_search_limit
-                feature_results = (
-                    conn.execute(
-                        sql_text(feature_query),
-                        {
-                            "term": " ".join(tokens),
-                            "terms": tokens,
-                            "thres": self.similarity_threshold,
-                            "facets": search_ds,
-                            "facetlimit": self.facet_search_limit + 1,
-                        },
+        # Count facets truncated by the facet search limit
+        count_timeout = self.count_timeout
+        if deadline is not None:
+            count_timeout = min(count_timeout, deadline.remaining())
+        if self.count_strategy != "none" and count_timeout > 0:
+            truncated_facets = [
+                facet
+                for facet, count in self.facet_result_counts(feature_results).items()
+                if count >= self.facet_search_limit and facet in facets
+            ]
+            if truncated_facets:
+                with self.metrics.phase("db_count"):
+                    facet_counts = self.count_facets(
+                        conn,
+                        searchtext,
+                        tokens,
+                        truncated_facets,
+                        params,
+                        count_timeout,
+                        spatial,
+                    )
+
+        return (feature_results, facet_counts, partial)
+
+    def search_features_fanout(
+        self,
+        conn,
+        searchtext,
+        tokens,
+        db_facets,
+        cursor_position,
+        deadline,
+        spatial=None,
+        limit=None,
+    ):
+        """Run feature queries on the DBs of the facets concurrently.
+
+        Returns tuple (merged feature results, facet counts, partial).
+
+        :param Connection conn: DB connection for the default DB
+        :param str searchtext: Search string
+        :param list(str) tokens: Search words
+        :param obj db_facets: Facets grouped by DB URL
+        :param list cursor_position: Keyset of last returned result, or None
+        :param Deadline deadline: Request deadline, or None
+        :param obj spatial: Map center and extent, or None
+        :param int limit: Max number of results, for pg_sql_facet_counts
+        """
+
+        def search_db(db_url, facets):
+            with self.metrics.phase("tpl"):
+                (_, feature_query) = self.render_queries(
+                    searchtext, tokens, [], facets, cursor_position is not None, spatial
+                )
+            with (
+                nullcontext(conn) if db_url == self.db_url else self.connect(db_url)
+            ) as db_conn:
+                return self.search_features(
+                    db_conn,
+                    searchtext,
+                    tokens,
+                    facets,
+                    feature_query,
+                    cursor_position,
+                    deadline,
+                    spatial,
+                    limit,
+                )
+
+        if len(db_facets) == 1:
+            # Facets in a single DB other than the default DB
+            ((db_url, facets),) = db_facets.items()
+            return search_db(db_url, facets)
+
+        futures = []
+        for db_url, facets in db_facets.items():
+            search_fn = search_db
+            if has_request_context():
+                # Record phase durations for the Server-Timing header
+                # (a request context copy can only be pushed by one thread)
+                search_fn = copy_current_request_context(search_db)
+            futures.append(self.fanout_executor.submit(search_fn, db_url, facets))
+
+        results = []
+        facet_counts = {}
+        partial = False
+        for future in futures:
+            (feature_results, db_facet_counts, db_partial) = future.result()
+            results.append(feature_results)
+            facet_counts.update(db_facet_counts)
+            partial = partial or db_partial
+
+        if any(results) and all("sort_key" in rows[0] for rows in results if rows):
+            # Merge ordered results as if from a single query
+            feature_results = list(
+                heapq.merge(
+                    *results, key=lambda row: (row["sort_key"], row["feature_id"])
+                )
+            )
+        else:
+            feature_results = [row for rows in results for row in rows]
+        return (feature_results, facet_counts, partial)
+
+    def truncated_query(self, feature_query):
+        """Return feature query limited to the returned results.
+
+        Wraps the feature query to add the number of results of each facet
+        as `facet_count_` and to return only results within the result
+        limit and the facet search limit. The first result of each facet is
+        always returned for its count. The results are numbered in
+        `result_row_` and `facet_row_` in the order of (sort_key, feature_id)
+        if the feature query returns a sort_key column, and in the order of
+        the feature query otherwise.
+
+        :param str feature_query: Rendered feature query
+        """
+        result_order = ""
+        if SORT_KEY_RE.search(feature_query):
+            # NOTE: row order of a subquery is not guaranteed to be kept
+            result_order = "ORDER BY sort_key, feature_id"
+        return """
+            SELECT * FROM (
+                SELECT results.*,
+                    count(*) OVER (PARTITION BY facet_id) AS facet_count_,
+                    row_number() OVER (
+                        PARTITION BY facet_id ORDER BY result_row_
+                    ) AS facet_row_
+                FROM (
+                    SELECT results.*, row_number() OVER (%s) AS result_row_
+                    FROM (%s) AS results
+                ) AS results
+            ) AS results
+            WHERE (result_row_ <= :result_limit AND facet_row_ <= :facet_result_limit)
+                OR facet_row_ = 1
+            ORDER BY result_row_
+        """ % (
+            result_order,
+            feature_query.strip().rstrip(";"),
+        )
+
+    def facet_result_counts(self, feature_results):
+        """Return number of feature query results per facet.
+
+        :param list feature_results: Feature query results
+        """
+        if feature_results and "facet_count_" in feature_results[0]:
+            # Counted by truncated_query()
+            return {row["facet_id"]: row["facet_count_"] for row in feature_results}
+        return Counter(row["facet_id"] for row in feature_results)
+
+    def execute_query(self, conn, source, query, params, timeout=None):
+        """Run search query and return the result rows.
+
+        Raises DeadlineExceeded if the query did not finish within the timeout.
+
+        :param Connection conn: DB connection
+        :param str source: Query source for the slow query log, e.g. feature_query
+        :param str query: Rendered query SQL
+        :param obj params: Query bind parameters
+        :param float timeout: Statement timeout in seconds, None for no timeout
+        """
+        if timeout is not None and timeout < 0.001:
+            raise DeadlineExceeded("No time left for %s" % source)
+        # Statement timeout is only supported by Postgres
+        set_timeout = timeout is not None and conn.dialect.name == "postgresql"
+
+        start = time.time()
+        self.logger.debug("Running %s: %s" % (source, query))
+        try:
+            if set_timeout:
+                conn.execute(
+                    sql_text("SET LOCAL statement_timeout = :timeout"),
+                    {"timeout": max(1, int(timeout * 1000))},
+                )
+            rows = conn.execute(sql_text(query), params).mappings().all()
+        except DBAPIError as e:
+            if set_timeout and is_query_canceled(e):
+                raise DeadlineExceeded("%s cancelled by statement timeout" % source)
+            raise
+        finally:
+            if set_timeout:
+                # End transaction to reset statement timeout
+                conn.rollback()
+        duration = time.time() - start
+        self.logger.debug("Done in %f s" % duration)
+        self.slow_query_log.record(
+            conn.engine,
+            source,
+            query,
+            params,
+            len(rows),
+            duration,
+            self.setup_statements(conn.engine),
+        )
+        return rows
+
+    def count_facets(
+        self, conn, searchtext, tokens, facets, params, timeout, spatial=None
+    ):
+        """Return dict with (count, exact) of facets with truncated results.
+
+        :param Connection conn: DB connection
+        :param str searchtext: Search string
+        :param list(str) tokens: Search words
+        :param list(str) facets: Facets to count
+        :param obj params: Feature query bind parameters
+        :param float timeout: Time budget in seconds
+        :param obj spatial: Map center and extent, or None
+        """
+        postgres = conn.dialect.name == "postgresql"
+        # Count all results, also on pages after a cursor
+        params = dict(params, cursor_sort=None, cursor_id=None)
+        facet_counts = {}
+        try:
+            if postgres:
+                # Limit time spent for counts, until end of transaction
+                conn.execute(
+                    sql_text("SET LOCAL statement_timeout = :timeout"),
+                    {"timeout": max(1, int(timeout * 1000))},
+                )
+
+            if self.count_strategy == "estimate" and postgres:
+                # Planner row estimate of unlimited feature query
+                facetlimit = 2147483647
+                for facet in facets:
+                    (_, query) = self.render_queries(
+                        searchtext,
+                        tokens,
+                        [],
+                        [facet],
+                        spatial=spatial,
+                        facetlimit=facetlimit,
                     )
-                    .mappings()
-                    .all()
+                    plan = conn.execute(
+                        sql_text("EXPLAIN (FORMAT JSON) " + query),
+                        dict(params, facets=[facet], facetlimit=facetlimit),
+                    ).scalar()
+                    if isinstance(plan, str):
+                        plan = json.loads(plan)
+                    count = int(plan[0]["Plan"]["Plan Rows"])
+                    facet_counts[facet] = (count, False)
+            elif self.count_strategy == "capped":
+                # Count feature query results up to count cap
+                facetlimit = self.count_cap + 1
+                (_, query) = self.render_queries(
+                    searchtext,
+                    tokens,
+                    [],
+                    facets,
+                    spatial=spatial,
+                    facetlimit=facetlimit,
                 )
-                self.logger.debug("Done in %f s" % (time.time() - start))
+                count_query = "SELECT facet_id, count(*) AS count FROM (%s) AS results GROUP BY facet_id" % query.strip().rstrip(
+                    ";"
+                )
+                counts = conn.execute(
+                    sql_text(count_query),
+                    dict(params, facets=facets, facetlimit=facetlimit),
+                ).all()
+                for facet, count in counts:
+                    if facet in facets:
+                        facet_counts[facet] = (
+                            min(count, self.count_cap),
+                            count <= self.count_cap,
+                        )
+        except Exception as e:
+            # e.g. statement timeout, return counts determined so far
+            self.logger.warning("Could not count facet results: %s" % e)
+        finally:
+            # End transaction to reset statement timeout
+            conn.rollback()
+
+        return facet_counts
+
+    def build_results(
+        self,
+        layer_results,
+        feature_results,
+        permitted_dataproducts,
+        search_ds,
+        limit,
+        facet_counts=None,
+    ):
+        """Build search response from layer and feature query results.
+
+        If the feature query returns a sort_key column, a continuation cursor
+        with the keyset (sort_key, feature_id) of the last returned result is
+        added to the result counts of facets with further results.
 
-        # Build results
+        Counts of facets truncated by the facet search limit are replaced by
+        facet_counts, or -1 if unknown, and flagged as not exact.
+        """
         results = []
         result_counts = {}
+        # Feature results returned per facet and last returned result
+        returned_counts = {}
+        last_results = {}
         self.logger.debug("Number of layer results: %d" % len(layer_results))
         self.logger.debug("Number of feature results: %d" % len(feature_results))
         for layer_result in layer_results:
@@ -220,6 +773,8 @@ class PgClient:
                         }
                     result_counts[stacktype]["count"] += 1
 
+        # Feature results truncated and counted by truncated_query()
+        sql_counts = bool(feature_results) and "facet_count_" in feature_results[0]
         feature_result_count = 0
         for feature_result in feature_results:
             if feature_result["facet_id"] in search_ds:
@@ -231,13 +786,27 @@ class PgClient:
                         ).get("filter_word", feature_result["facet_id"]),
                         "count": 0,
                     }
-                feature_result_count += 1
-                result_counts[feature_result["facet_id"]]["count"] += 1
-                if (
-                    feature_result_count <= limit
-                    and result_counts[feature_result["facet_id"]]["count"]
-                    <= self.facet_search_limit
-                ):
+                if sql_counts:
+                    result_counts[feature_result["facet_id"]]["count"] = feature_result[
+                        "facet_count_"
+                    ]
+                    returned = (
+                        feature_result["result_row_"] <= limit
+                        and feature_result["facet_row_"] <= self.facet_search_limit
+                        and sum(returned_counts.values()) < limit
+                    )
+                else:
+                    feature_result_count += 1
+                    result_counts[feature_result["facet_id"]]["count"] += 1
+                    returned = (
+                        feature_result_count <= limit
+                        and result_counts[feature_result["facet_id"]]["count"]
+                        <= self.facet_search_limit
+                    )
+                if returned:
+                    facet_id = feature_result["facet_id"]
+                    returned_counts[facet_id] = returned_counts.get(facet_id, 0) + 1
+                    last_results[facet_id] = feature_result
                     results.append(
                         {
                             "feature": {
@@ -257,12 +826,75 @@ class PgClient:
                     )
 
         for facet in result_counts:
+            if (
+                facet in search_ds
+                and result_counts[facet]["count"] > returned_counts.get(facet, 0)
+                and "sort_key" in feature_results[0]
+            ):
+                # Continue after last returned result, or from the start
+                last_result = last_results.get(facet)
+                position = None
+                if last_result is not None:
+                    position = [last_result["sort_key"], last_result["feature_id"]]
+                result_counts[facet]["cursor"] = encode_cursor(facet, position)
+
             # Search query limited results, the true result count is not known
             if result_counts[facet]["count"] >= self.facet_search_limit:
-                result_counts[facet]["count"] = -1
+                (count, exact) = (facet_counts or {}).get(facet, (-1, False))
+                result_counts[facet]["count"] = count
+                result_counts[facet]["exact"] = exact
+            else:
+                result_counts[facet]["exact"] = True
 
         return {"results": results, "result_counts": list(result_counts.values())}
 
+    def render_queries(
+        self,
+        searchtext,
+        tokens,
+        search_dp,
+        search_ds,
+        cursor=False,
+        spatial=None,
+        facetlimit=None,
+    ):
+        """Return layer and feature query SQL, rendered from the templates if configured.
+
+        :param bool cursor: Whether search continues after a cursor position
+        :param obj spatial: Map center and extent, or None
+        :param int facetlimit: Max results per facet, default facet_search_limit + 1
+        """
+        spatial = spatial or {}
+        layer_query = self.layer_query
+        if self.layer_query_template:
+            layer_query = self.layer_query_template.render(
+                searchtext=self.sql_escape(searchtext),
+                words=list(map(self.sql_escape, tokens)),
+                facets=search_dp,
+                center=spatial.get("center"),
+                extent=spatial.get("extent"),
+                srid=spatial.get("srid"),
+            )
+            self.logger.debug("Generated layer query from template")
+
+        feature_query = self.feature_query
+        if self.feature_query_template:
+            # NOTE: facet_search_limit + 1: we limit results to facet_search_limit in build_results(), but pass + 1 here to
+            # be able to detect whether there were actually more results than facet_search_limit
+            feature_query = self.feature_query_template.render(
+                searchtext=self.sql_escape(searchtext),
+                words=list(map(self.sql_escape, tokens)),
+                facets=search_ds,
+                facetlimit=facetlimit or self.facet_search_limit + 1,
+                cursor=cursor,
+                center=spatial.get("center"),
+                extent=spatial.get("extent"),
+                srid=spatial.get("srid"),
+            )
+            self.logger.debug("Generated feature query from template")
+
+        return (layer_query, feature_query)
+
     def tokenize(self, searchtext):
         match = FILTERWORD_RE.match(searchtext)
         if match:
@@ -272,4 +904,5 @@ class PgClient:
             return (None, self.split_words(searchtext))
 
     def split_words(self, searchtext):
-        return list(filter(None, re.split(self.word_split_re, searchtext)))
+        words = filter(None, re.split(self.word_split_re, searchtext))
+        return self.token_pipeline.process(words)[0]
@@ -0,0 +1,135 @@
+import hashlib
+import hmac
+import os
+import random
+import re
+import threading
+import time
+
+from flask import json
+
+DIGITS_RE = re.compile(r"\d")
+# Request parameters per endpoint which may contain personal data: free text
+# is hashed per word, values of filter expressions are hashed and locations
+# and cursors (with the sort key of a result) are dropped
+PRIVATE_PARAMS = {
+    "fts": {
+        "searchtext": "text",
+        "cursor": "drop",
+        "center": "drop",
+        "extent": "drop",
+    },
+    "suggest": {"searchtext": "text"},
+    "geom": {"filter": "filter", "bbox": "drop"},
+}
+
+
+class QueryLog:
+    """QueryLog class
+
+    Opt-in capture of search requests as JSON lines for replaying them with
+    benchmarks/replay_query_log.py. User identities and client addresses are
+    never logged. By default, search texts are replaced by hashes of their
+    words, values of filter expressions are hashed, and map locations and
+    cursors are dropped. The hashes are keyed with a random key per process,
+    so that they cannot be reversed by hashing candidate texts.
+
+    Configured by environment variables:
+
+    * QUERY_LOG_FILE: Path of log file, capture is disabled if unset
+    * QUERY_LOG_SAMPLE_RATE: Fraction (0-1) of requests to capture (default: 1)
+    * QUERY_LOG_RAW: Capture the request parameters unmodified (default: 0)
+    * QUERY_LOG_MASK_DIGITS: Replace digits in raw search texts with 0 (default: 1)
+    """
+
+    def __init__(self):
+        self.path = os.environ.get("QUERY_LOG_FILE")
+        self.sample_rate = float(os.environ.get("QUERY_LOG_SAMPLE_RATE", 1))
+        self.raw = os.environ.get("QUERY_LOG_RAW", "0").lower() in ["1", "true"]
+        self.mask_digits = os.environ.get("QUERY_LOG_MASK_DIGITS", "1").lower() in [
+            "1",
+            "true",
+        ]
+        self.hash_key = os.urandom(16)
+        self.lock = threading.Lock()
+
+    def record(self, endpoint, tenant, params, status, duration):
+        """Append a request to the query log.
+
+        :param str endpoint: Endpoint name (fts, geom)
+        :param str tenant: Tenant name
+        :param obj params: Request parameters
+        :param int status: HTTP status code
+        :param float duration: Request duration in seconds
+        """
+        if not self.path or random.random() >= self.sample_rate:
+            return
+
+        entry = {
+            "ts": round(time.time(), 3),
+            "endpoint": endpoint,
+            "tenant": tenant,
+            "params": self.anonymize(endpoint, params),
+            "status": status,
+            "duration_ms": round(duration * 1000, 2),
+        }
+        line = json.dumps(entry) + "\n"
+        # NOTE: single appending write per line, to avoid interleaved lines
+        #       with multiple worker processes
+        with self.lock:
+            with open(self.path, "a", encoding="utf-8") as fh:
+                fh.write(line)
+
+    def anonymize(self, endpoint, params):
+        """Return request parameters without personal data.
+
+        :param str endpoint: Endpoint name (fts, geom)
+        :param obj params: Request parameters
+        """
+        private_params = PRIVATE_PARAMS.get(endpoint, {})
+        if self.raw:
+            if not self.mask_digits:
+                return params
+            return {
+                key: DIGITS_RE.sub("0", value)
+                if private_params.get(key) == "text" and value
+                else value
+                for key, value in params.items()
+            }
+
+        result = {}
+        for key, value in params.items():
+            mode = private_params.get(key)
+            if mode == "drop":
+                continue
+            elif mode is None or value is None:
+                result[key] = value
+            elif mode == "text":
+                result[key] = " ".join(self.hash(word) for word in value.split())
+            elif mode == "filter":
+                result[key] = self.hash_filter(value)
+        return result
+
+    def hash(self, value):
+        """Return short keyed hash of a value.
+
+        :param obj value: Value
+        """
+        digest = hmac.new(self.hash_key, str(value).encode(), hashlib.sha256)
+        return digest.hexdigest()[:12]
+
+    def hash_filter(self, filterstr):
+        """Return filter expression with hashed values, or None if invalid.
+
+        :param str filterstr: JSON serialized array of filter expressions
+        """
+        try:
+            filterarray = json.loads(filterstr)
+        except ValueError:
+            return None
+        if not isinstance(filterarray, list):
+            return None
+        for expr in filterarray:
+            if isinstance(expr, list) and len(expr) == 3:
+                expr[2] = self.hash(expr[2])
+        return json.dumps(filterarray)
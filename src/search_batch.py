@@ -0,0 +1,108 @@
+import queue
+import threading
+
+
+class SearchBatch:
+    """SearchBatch class
+
+    Runs many searches of a single request with bounded parallelism. Each
+    worker thread uses a single connection of the search handler for all of
+    its searches, and permissions are resolved once for the whole batch.
+    """
+
+    def __init__(self, handler, concurrency, logger):
+        """Constructor
+
+        :param obj handler: Search handler (SolrClient or PgClient)
+        :param int concurrency: Number of parallel searches
+        :param Logger logger: Application logger
+        """
+        self.handler = handler
+        self.concurrency = max(1, concurrency)
+        self.logger = logger
+
+    def run(self, identity, searches):
+        """Run searches and yield their results in order.
+
+        :param obj identity: User identity
+        :param list(obj) searches: Searches as dicts with searchtext, filter, limit and cursor
+        """
+        permissions = self.handler.resources.permitted(identity)
+
+        tasks = queue.Queue()
+        for index, search in enumerate(searches):
+            tasks.put((index, search))
+        results = {}
+        done = threading.Condition()
+
+        def worker():
+            with self.handler.connect() as conn:
+                while True:
+                    try:
+                        (index, search) = tasks.get_nowait()
+                    except queue.Empty:
+                        return
+                    result = self.search(identity, search, permissions, conn)
+                    with done:
+                        results[index] = result
+                        done.notify()
+
+        workers = [
+            threading.Thread(target=worker, daemon=True)
+            for i in range(min(self.concurrency, len(searches)))
+        ]
+        for thread in workers:
+            thread.start()
+
+        try:
+            for index in range(len(searches)):
+                with done:
+                    while index not in results:
+                        if not any(thread.is_alive() for thread in workers):
+                            # worker failed, e.g. DB connection error
+                            results[index] = {"error": "Search failed", "status": 500}
+                            break
+                        done.wait(timeout=1)
+                    result = results.pop(index)
+                result["index"] = index
+                result["searchtext"] = searches[index]["searchtext"]
+                yield result
+        finally:
+            # Skip remaining searches if the client disconnected
+            while not tasks.empty():
+                try:
+                    tasks.get_nowait()
+                except queue.Empty:
+                    break
+
+    def search(self, identity, search, permissions, conn):
+        """Run a single search and return its result or error.
+
+        :param obj identity: User identity
+        :param obj search: Search as dict with searchtext, filter, limit and cursor
+        :param tuple permissions: Permitted (solr_facets, dataproducts)
+        :param conn: Handler connection
+        """
+        try:
+            result = self.handler.search(
+                identity,
+                search["searchtext"],
+                search["filter"],
+                search["limit"],
+                search.get("cursor"),
+                permissions=permissions,
+                conn=conn,
+            )
+        except Exception as e:
+            self.logger.error("Batch search failed: %s" % e)
+            if conn is not None:
+                conn.rollback()
+            return {"error": "Search failed", "status": 500}
+
+        if type(result) is tuple:
+            # Backend error response
+            error = result[0]
+            if isinstance(error, dict):
+                error = error.get("error")
+            return {"error": error, "status": result[1]}
+        return dict(result, status=200)
@@ -0,0 +1,37 @@
+import base64
+import binascii
+import json
+
+# Compact JSON encoder for cursors, faster than flask.json in an app context
+CURSOR_ENCODER = json.JSONEncoder(separators=(",", ":"), default=str)
+
+
+def encode_cursor(facet, position):
+    """Return opaque continuation token for the next results of a facet.
+
+    :param str facet: Facet name
+    :param obj position: Backend specific position after the last returned result
+    """
+    data = CURSOR_ENCODER.encode({"f": facet, "p": position})
+    return base64.urlsafe_b64encode(data.encode()).decode().rstrip("=")
+
+
+def decode_cursor(token):
+    """Return facet and position of a continuation token.
+
+    Raises ValueError for invalid tokens.
+
+    :param str token: Continuation token
+    """
+    try:
+        data = base64.urlsafe_b64decode(token + "=" * (-len(token) % 4))
+        cursor = json.loads(data)
+        (facet, position) = (cursor["f"], cursor["p"])
+    except (binascii.Error, ValueError, TypeError, KeyError) as e:
+        raise ValueError("Invalid cursor: %s" % e)
+    if not isinstance(facet, str):
+        raise ValueError("Invalid cursor: facet is not a string")
+    # Positions of all backends are pairs, e.g. (sort_key, feature_id)
+    if position is not None and not (isinstance(position, list) and len(position) == 2):
+        raise ValueError("Invalid cursor: position is not a pair")
+    return facet, position
@@ -0,0 +1,76 @@
+import math
+import time
+
+from flask import g, has_request_context, request
+
+# Request header with the client timeout in seconds
+DEADLINE_HEADER = "X-Request-Timeout"
+# Max client timeout in seconds, if no request timeout is configured
+MAX_CLIENT_TIMEOUT = 300
+
+# SQLSTATE of queries cancelled by the statement timeout
+QUERY_CANCELED = "57014"
+
+
+class DeadlineExceeded(Exception):
+    """Search deadline exceeded before a backend query finished"""
+
+
+class Deadline:
+    """Deadline class
+
+    Time budget of a search request, passed down to the backend queries.
+    """
+
+    def __init__(self, timeout):
+        """Constructor
+
+        :param float timeout: Timeout in seconds from now
+        """
+        self.timeout = timeout
+        self.expires = time.monotonic() + timeout
+
+    def remaining(self):
+        """Return remaining time in seconds."""
+        return max(0.0, self.expires - time.monotonic())
+
+    def expired(self):
+        """Return whether the deadline has passed."""
+        return self.remaining() <= 0
+
+
+def create_deadline(default_timeout):
+    """Return deadline for the current request, or None if there is none.
+
+    The timeout of the request header can only shorten the configured timeout,
+    and is limited to MAX_CLIENT_TIMEOUT. Non-finite values are ignored.
+
+    :param float default_timeout: Configured request timeout, 0 for none
+    """
+    timeout = default_timeout if default_timeout > 0 else None
+    try:
+        client_timeout = float(request.headers.get(DEADLINE_HEADER, ""))
+        if client_timeout > 0 and math.isfinite(client_timeout):
+            client_timeout = min(client_timeout, MAX_CLIENT_TIMEOUT)
+            if timeout is None or client_timeout < timeout:
+                timeout = client_timeout
+    except ValueError:
+        pass
+    if timeout is None:
+        return None
+    return Deadline(timeout)
+
+
+def request_deadline():
+    """Return deadline of the current request, or None if there is none."""
+    if has_request_context():
+        return g.get("deadline")
+    return None
+
+
+def is_query_canceled(e):
+    """Return whether a DB error was caused by a statement timeout.
+
+    :param Exception e: SQLAlchemy DBAPIError
+    """
+    return getattr(getattr(e, "orig", None), "pgcode", None) == QUERY_CANCELED
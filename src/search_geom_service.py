@@ -1,13 +1,21 @@
 import re
+import time
 from uuid import UUID
 
 from flask import json
-from qwc_services_core.database import DatabaseEngine
 from qwc_services_core.permissions_reader import PermissionsReader
 from qwc_services_core.runtime_config import RuntimeConfig
+from sqlalchemy.exc import DBAPIError
 from sqlalchemy.sql import text as sql_text
 
+from admission_control import AdmissionControl, AdmissionRejected
+from db_engines import SharedDatabaseEngine
+from db_replicas import ReplicaRouter
+from search_deadline import DeadlineExceeded, is_query_canceled, request_deadline
+from search_metrics import SearchMetrics
 from search_resources import SearchResources
+from search_spatial import parse_coords, parse_srid
+from slow_query_log import SlowQueryLog
 
 # Extract coords from bbox string like
 # BOX(2644230.6300308 1246806.79350726,2644465.86084414 1246867.82022007)
@@ -34,24 +42,70 @@ class SearchGeomService:
         permissions = PermissionsReader(tenant, logger)
         self.resources = SearchResources(config, permissions)
 
-        self.db_engine = DatabaseEngine()
+        # DB engines shared with other tenants using the same DB
+        self.db_engine = SharedDatabaseEngine()
         self.dbs = {}  # db connections with db_url as key
         self.default_db_url = config.get("db_url")
 
+        self.metrics = SearchMetrics(tenant, "pg")
+        self.slow_query_log = SlowQueryLog(config, logger)
+        self.admission = AdmissionControl(
+            config, tenant, self.default_db_url, self.metrics, logger
+        )
+        self.replicas = ReplicaRouter(self.db_engine, config, self.metrics, logger)
+
     def _get_db(self, cfg):
         db_url = cfg.get("db_url", self.default_db_url)
         if db_url not in self.dbs:
             self.dbs[db_url] = self.db_engine.db_engine(db_url)
         return self.dbs[db_url]
 
-    def query(self, identity, dataset, filterexpr):
+    def warmup(self):
+        """Open and validate DB connections of all configured facets."""
+        db_urls = set(
+            facet.get("db_url", self.default_db_url)
+            for facets in self.resources.resources["facets"].values()
+            for facet in facets
+        )
+        self.replicas.check()
+        for db_url in db_urls:
+            if db_url is None:
+                continue
+            for url in self.replicas.urls(db_url):
+                with self._get_db({"db_url": url}).connect() as conn:
+                    conn.execute(sql_text("SELECT 1"))
+
+    def close(self):
+        """Release the DB pools of an evicted handler."""
+        self.slow_query_log.close()
+        self.admission.close()
+        self.db_engine.release()
+        self.dbs = {}
+
+    def query(self, identity, dataset, filterexpr, bbox=None, crs=None, limit=None):
         """Find dataset features inside bounding box.
 
         :param str identity: User name or Identity dict
         :param str dataset: Dataset ID
         :param str filterexpr: JSON serialized array of filter expressions: [["<attr>", "=", "<value>"]]
+        :param str bbox: Optional extent as '<xmin>,<ymin>,<xmax>,<ymax>'
+        :param str crs: CRS of bbox as 'EPSG:<srid>', default CRS of geometries
+        :param int limit: Optional max number of features
         """
-        solr_facets = self.resources.solr_facets(identity)
+        try:
+            with self.admission.admit():
+                return self.run_query(identity, dataset, filterexpr, bbox, crs, limit)
+        except AdmissionRejected as e:
+            return {
+                "error": e.error,
+                "error_code": e.status,
+                "retry_after": e.retry_after,
+            }
+
+    def run_query(self, identity, dataset, filterexpr, bbox=None, crs=None, limit=None):
+        """Query dataset features after admission, see query()."""
+        with self.metrics.phase("perm"):
+            solr_facets = self.resources.solr_facets(identity)
         resource_cfg = solr_facets.get(dataset)
 
         if (
@@ -59,8 +113,6 @@ class SearchGeomService:
             and len(resource_cfg) == 1
             and filterexpr is not None
         ):
-            # Column for feature ID. If unset, field from filterexpr is used
-            self.primary_key = resource_cfg[0].get("search_id_col")
             # parse and validate input filter
             filterexpr = self._parse_filter(filterexpr)
             if filterexpr[0] is None:
@@ -68,6 +120,15 @@ class SearchGeomService:
                     "error": "Invalid filter expression: " + filterexpr[1],
                     "error_code": 400,
                 }
+            # Column for feature ID. If unset, field from filterexpr is used
+            primary_key = resource_cfg[0].get("search_id_col") or filterexpr[2]
+            # parse and validate extent
+            if bbox is not None:
+                bbox = self._parse_bbox(bbox, crs)
+                if bbox[0] is None:
+                    return {"error": bbox[1], "error_code": 400}
+            if limit is not None and limit < 1:
+                return {"error": "Invalid limit", "error_code": 400}
             facet_column = resource_cfg[0].get("facet_column")
             # Append dataset where clause for search view
             if facet_column:
@@ -75,24 +136,32 @@ class SearchGeomService:
                 filterexpr[1]["vs"] = dataset
                 filterexpr = (sql, filterexpr[1])
 
-            feature_collection = self._index(filterexpr, resource_cfg[0])
+            try:
+                feature_collection = self._index(
+                    filterexpr, resource_cfg[0], primary_key, bbox, limit
+                )
+            except DeadlineExceeded as e:
+                self.logger.info(str(e))
+                return {"error": "Search deadline exceeded", "error_code": 504}
             return {"feature_collection": feature_collection}
         else:
             return {"error": "Dataset not found or permission error"}
 
-    def _index(self, filterexpr, cfg):
+    def _index(self, filterexpr, cfg, primary_key, bbox=None, limit=None):
         """Find features by filter query.
 
         :param (sql, params) filterexpr: A filter expression as a tuple (sql_expr, bind_params)
+        :param str primary_key: Column for feature ID
+        :param (sql, params) bbox: An extent expression as a tuple (sql_expr, bind_params)
+        :param int limit: Optional max number of features
         """
-        db = self._get_db(cfg)
         table_name = cfg.get("table_name", "search_v")
         geometry_column = cfg.get("geometry_column", "geom")
 
         # build query SQL
 
         # select id
-        columns = ", ".join(['"%s"' % self.primary_key])
+        columns = ", ".join(['"%s"' % primary_key])
         quoted_table = ".".join(map(lambda s: '"%s"' % s, table_name.split(".")))
 
         where_clauses = []
@@ -102,8 +171,32 @@ class SearchGeomService:
             where_clauses.append(filterexpr[0])
             params.update(filterexpr[1])
 
+        if bbox is not None:
+            # Bounding box filter using the spatial index of the geometry column
+            if cfg.get("srid"):
+                geom_srid = ":geom_srid"
+                params["geom_srid"] = cfg["srid"]
+            else:
+                # SRID of the geometry column registered in geometry_columns
+                geom_srid = (
+                    "Find_SRID(COALESCE(:geom_schema, current_schema()), "
+                    ":geom_table, :geom_column)"
+                )
+                (schema, _, table) = table_name.rpartition(".")
+                params["geom_schema"] = schema or None
+                params["geom_table"] = table
+                params["geom_column"] = geometry_column
+            envelope = bbox[0].format(srid=geom_srid)
+            where_clauses.append('"%s" && %s' % (geometry_column, envelope))
+            params.update(bbox[1])
+
         where_clause = "WHERE " + " AND ".join(where_clauses) if where_clauses else ""
 
+        limit_clause = ""
+        if limit is not None:
+            limit_clause = "LIMIT :limit"
+            params["limit"] = limit
+
         sql = sql_text(
             """
             SELECT {columns},
@@ -112,29 +205,61 @@ class SearchGeomService:
                 ST_Extent("{geom}") OVER () AS bbox_
             FROM {table}
             {where_clause}
+            {limit_clause}
         """.format(
                 columns=columns,
                 geom=geometry_column,
                 table=quoted_table,
                 where_clause=where_clause,
+                limit_clause=limit_clause,
             )
         )
 
-        # connect to database and start transaction (for read-only access)
-        conn = db.connect()
+        deadline = request_deadline()
+        if deadline is not None and deadline.remaining() < 0.001:
+            raise DeadlineExceeded("No time left for geometry query")
+
+        # connect to database or a read replica and start transaction (for read-only access)
+        conn = self.replicas.connect(cfg.get("db_url", self.default_db_url))
         trans = conn.begin()
 
+        # Cancel query at the request deadline (only supported by Postgres)
+        set_timeout = deadline is not None and conn.dialect.name == "postgresql"
+        if set_timeout:
+            # valid until end of transaction
+            conn.execute(
+                sql_text("SET LOCAL statement_timeout = :timeout"),
+                {"timeout": max(1, int(deadline.remaining() * 1000))},
+            )
+
         # execute query
         features = []
-        result = conn.execute(sql, params).mappings()
-
         srid = 4326
         bbox = None
-        for row in result:
-            # NOTE: feature CRS removed by marshalling
-            features.append(self._feature_from_query(row))
-            srid = row["srid"]
-            bbox = row["bbox_"]
+        start = time.time()
+        try:
+            with self.metrics.phase("geom"):
+                result = conn.execute(sql, params).mappings()
+
+                for row in result:
+                    # NOTE: feature CRS removed by marshalling
+                    features.append(self._feature_from_query(row, primary_key))
+                    srid = row["srid"]
+                    bbox = row["bbox_"]
+        except DBAPIError as e:
+            trans.rollback()
+            conn.close()
+            if set_timeout and is_query_canceled(e):
+                raise DeadlineExceeded("Geometry query cancelled by statement timeout")
+            raise
+        self.slow_query_log.record(
+            conn.engine,
+            "geom_query",
+            sql.text,
+            params,
+            len(features),
+            time.time() - start,
+        )
 
         if bbox:
             m = BBOX_RE.match(bbox)
@@ -166,7 +291,7 @@ class SearchGeomService:
         }
 
     def _parse_filter(self, filterstr):
-        """Parse and validate a filter expression and return a tuple (sql_expr, bind_params).
+        """Parse and validate a filter expression and return a tuple (sql_expr, bind_params, column_name).
 
         :param str filterstr: JSON serialized array of filter expressions: [["<attr>", "=", "<value>"]]
         """
@@ -184,9 +309,6 @@ class SearchGeomService:
         column_name = expr[0]
         if type(column_name) is not str:
             return (None, "Invalid column name")
-        if self.primary_key is None:
-            self.primary_key = column_name
-
         op = expr[1].upper().strip()
         if type(expr[1]) is not str or not op in ["="]:
             return (None, "Invalid operator")
@@ -202,14 +324,47 @@ class SearchGeomService:
         if not sql:
             return (None, "Empty expression")
         else:
-            return ("(%s)" % " ".join(sql), params)
+            return ("(%s)" % " ".join(sql), params, column_name)
+
+    def _parse_bbox(self, bboxstr, crs):
+        """Parse and validate an extent and return a tuple (sql_expr, bind_params).
+
+        The SQL expression contains a `{srid}` placeholder for the SRID of the
+        geometry column.
 
-    def _feature_from_query(self, row):
+        :param str bboxstr: Extent as '<xmin>,<ymin>,<xmax>,<ymax>'
+        :param str crs: CRS of extent as 'EPSG:<srid>', or None for the CRS of the geometries
+        """
+        try:
+            coords = parse_coords(bboxstr, 4)
+        except ValueError:
+            return (None, "Invalid bbox")
+        if coords[0] > coords[2] or coords[1] > coords[3]:
+            return (None, "Invalid bbox")
+        params = {
+            "bbox_xmin": coords[0],
+            "bbox_ymin": coords[1],
+            "bbox_xmax": coords[2],
+            "bbox_ymax": coords[3],
+        }
+
+        if crs is None:
+            sql = "ST_MakeEnvelope(:bbox_xmin, :bbox_ymin, :bbox_xmax, :bbox_ymax, {srid})"
+        else:
+            try:
+                params["bbox_srid"] = parse_srid(crs)
+            except ValueError:
+                return (None, "Invalid crs")
+            sql = "ST_Transform(ST_MakeEnvelope(:bbox_xmin, :bbox_ymin, :bbox_xmax, :bbox_ymax, :bbox_srid), {srid})"
+        return (sql, params)
+
+    def _feature_from_query(self, row, primary_key):
         """Build GeoJSON Feature from query result row.
 
         :param obj row: Row result from query
+        :param str primary_key: Column for feature ID
         """
-        pk = row[self.primary_key]
+        pk = row[primary_key]
         # Ensure UUID primary key is JSON serializable
         if isinstance(pk, UUID):
             pk = str(pk)
@@ -0,0 +1,152 @@
+import os
+import threading
+import time
+from collections import Counter as LocalCounter
+from contextlib import contextmanager
+
+from flask import g, has_request_context
+from prometheus_client import (
+    CONTENT_TYPE_LATEST,
+    REGISTRY,
+    CollectorRegistry,
+    Counter,
+    Histogram,
+    generate_latest,
+    multiprocess,
+)
+
+# NOTE: for multi-process servers (e.g. uWSGI with multiple workers) set
+#       PROMETHEUS_MULTIPROC_DIR to an empty directory writable by all workers.
+#       Metrics are then written to this directory and aggregated on export.
+
+PHASE_DURATION = Histogram(
+    "search_phase_duration_seconds",
+    "Duration of search request phases",
+    ["tenant", "backend", "phase"],
+    buckets=(0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10),
+)
+REQUESTS = Counter(
+    "search_requests_total",
+    "Number of search requests",
+    ["tenant", "backend", "endpoint", "status"],
+)
+ERRORS = Counter(
+    "search_errors_total",
+    "Number of failed search requests",
+    ["tenant", "backend", "endpoint"],
+)
+RESULTS = Histogram(
+    "search_results",
+    "Number of results per search request",
+    ["tenant", "backend", "endpoint"],
+    buckets=(0, 1, 5, 10, 25, 50, 100, 250, 500, 1000, 5000),
+)
+EVENTS = Counter(
+    "search_backend_events_total",
+    "Backend events, e.g. hedged requests and circuit breaker state changes",
+    ["tenant", "backend", "event"],
+)
+
+
+class SearchMetrics:
+    """SearchMetrics class
+
+    Records Prometheus metrics for a tenant and search backend.
+    """
+
+    def __init__(self, tenant, backend):
+        """Constructor
+
+        :param str tenant: Tenant name
+        :param str backend: Search backend (solr, pg)
+        """
+        self.tenant = tenant
+        self.backend = backend
+        # Process local event counts
+        self.events = LocalCounter()
+        self.lock = threading.Lock()
+
+    @contextmanager
+    def phase(self, name):
+        """Context manager recording the duration of a request phase.
+
+        :param str name: Phase name
+        """
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            duration = time.perf_counter() - start
+            PHASE_DURATION.labels(self.tenant, self.backend, name).observe(duration)
+            timer = request_timer()
+            if timer is not None:
+                timer.add(name, duration)
+
+    def inc(self, event, amount=1):
+        """Count a backend event.
+
+        :param str event: Event name
+        :param int amount: Number of events
+        """
+        with self.lock:
+            self.events[event] += amount
+        EVENTS.labels(self.tenant, self.backend, event).inc(amount)
+
+    def request(self, endpoint, status, num_results=None):
+        """Record a finished request.
+
+        :param str endpoint: Endpoint name
+        :param int status: HTTP status code
+        :param int num_results: Number of returned results
+        """
+        REQUESTS.labels(self.tenant, self.backend, endpoint, status).inc()
+        if status >= 400:
+            ERRORS.labels(self.tenant, self.backend, endpoint).inc()
+        if num_results is not None:
+            RESULTS.labels(self.tenant, self.backend, endpoint).observe(num_results)
+
+
+class RequestTimer:
+    """RequestTimer class
+
+    Collects the phase durations of the current request for the
+    Server-Timing response header.
+    """
+
+    def __init__(self):
+        self.phases = {}
+        # phases of concurrent backend queries of a request
+        self.lock = threading.Lock()
+
+    def add(self, name, duration):
+        """Add duration of a phase.
+
+        :param str name: Phase name
+        :param float duration: Duration in seconds
+        """
+        with self.lock:
+            self.phases[name] = self.phases.get(name, 0) + duration
+
+    def header(self):
+        """Return Server-Timing header value."""
+        return ", ".join(
+            "%s;dur=%.2f" % (name, duration * 1000)
+            for name, duration in self.phases.items()
+        )
+
+
+def request_timer():
+    """Return timer of the current request, or None if there is none."""
+    if has_request_context():
+        return g.get("request_timer")
+    return None
+
+
+def export_metrics():
+    """Return metrics of all processes in Prometheus text format and the content type."""
+    if os.environ.get("PROMETHEUS_MULTIPROC_DIR"):
+        registry = CollectorRegistry()
+        multiprocess.MultiProcessCollector(registry)
+    else:
+        registry = REGISTRY
+    return generate_latest(registry), CONTENT_TYPE_LATEST
@@ -9,6 +9,14 @@ class SearchResources:
     def __init__(self, config, permissions):
         self.resources = self._load_resources(config)
         self.permissions = permissions
+        # Server-Timing response header: none, all, authenticated or admin
+        self.server_timing = config.get("server_timing", "none")
+        self.server_timing_admin_role = config.get("server_timing_admin_role", "admin")
+        # Default time budget of search and geometry requests in seconds, 0 for none
+        self.request_timeout = config.get("request_timeout", 0.0)
+        # Batch search: max searches per request and number of parallel searches
+        self.batch_max_searches = config.get("batch_max_searches", 1000)
+        self.batch_concurrency = config.get("batch_concurrency", 4)
 
     def _load_resources(self, config):
         """Load service resources from config.
@@ -43,6 +51,13 @@ class SearchResources:
 
         return facets
 
+    def permitted(self, identity):
+        """Return permitted search facets and dataproducts.
+
+        :param str identity: User identity
+        """
+        return (self.solr_facets(identity), self.dataproducts(identity))
+
     def dataproducts(self, identity):
         """Return permitted dataproducts.
 
@@ -55,3 +70,18 @@ class SearchResources:
 
         # return unique sorted dataproducts
         return sorted(list(set(permitted_dataproducts)))
+
+    def server_timing_permitted(self, identity):
+        """Return whether the Server-Timing header is returned to the identity.
+
+        :param str identity: User identity
+        """
+        if self.server_timing == "all":
+            return True
+        elif self.server_timing == "authenticated":
+            return bool(identity)
+        elif self.server_timing == "admin":
+            return self.server_timing_admin_role in self.permissions.identity_roles(
+                identity
+            )
+        return False
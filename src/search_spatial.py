@@ -0,0 +1,95 @@
+import re
+
+# Extract SRID from CRS string like EPSG:2056
+CRS_RE = re.compile(r"^EPSG:(\d+)$", re.IGNORECASE)
+
+# Default CRS of center and extent of search requests
+DEFAULT_SRID = 4326
+
+
+def parse_coords(value, count):
+    """Return list of coordinates from a comma separated string.
+
+    Raises ValueError if the value is not a list of count numbers.
+
+    :param str value: Comma separated coordinates
+    :param int count: Number of coordinates
+    """
+    coords = [float(coord) for coord in value.split(",")]
+    if len(coords) != count:
+        raise ValueError("Expected %d coordinates" % count)
+    return coords
+
+
+def parse_srid(crs):
+    """Return SRID of a CRS string like EPSG:2056.
+
+    Raises ValueError for an invalid CRS.
+
+    :param str crs: CRS string
+    """
+    match = CRS_RE.match(crs)
+    if match is None:
+        raise ValueError("Invalid crs")
+    return int(match.group(1))
+
+
+def parse_spatial(center, extent, crs):
+    """Return spatial bias of a search request, or None if there is none.
+
+    Returns a dict with `center` as [x, y], `extent` as
+    [xmin, ymin, xmax, ymax] (each None if not set) and `srid`.
+    Raises ValueError for invalid parameters.
+
+    :param str center: Map center as '<x>,<y>', or None
+    :param str extent: Map extent as '<xmin>,<ymin>,<xmax>,<ymax>', or None
+    :param str crs: CRS of center and extent as 'EPSG:<srid>', or None for WGS 84
+    """
+    if not center and not extent:
+        return None
+    spatial = {
+        "center": None,
+        "extent": None,
+        "srid": parse_srid(crs) if crs else DEFAULT_SRID,
+    }
+    if center:
+        try:
+            spatial["center"] = parse_coords(center, 2)
+        except ValueError:
+            raise ValueError("Invalid center")
+    if extent:
+        try:
+            spatial["extent"] = parse_coords(extent, 4)
+        except ValueError:
+            raise ValueError("Invalid extent")
+        (xmin, ymin, xmax, ymax) = spatial["extent"]
+        if xmin > xmax or ymin > ymax:
+            raise ValueError("Invalid extent")
+    return spatial
+
+
+def spatial_params(spatial):
+    """Return SQL bind parameters for a spatial bias.
+
+    Parameters of an unset center or extent are None.
+
+    :param obj spatial: Spatial bias from parse_spatial(), or None
+    """
+    (center, extent, srid) = (None, None, None)
+    if spatial is not None:
+        (center, extent, srid) = (
+            spatial["center"],
+            spatial["extent"],
+            spatial["srid"],
+        )
+    center = center or [None] * 2
+    extent = extent or [None] * 4
+    return {
+        "center_x": center[0],
+        "center_y": center[1],
+        "extent_xmin": extent[0],
+        "extent_ymin": extent[1],
+        "extent_xmax": extent[2],
+        "extent_ymax": extent[3],
+        "srid": srid,
+    }
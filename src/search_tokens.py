@@ -0,0 +1,98 @@
+import unicodedata
+
+
+class TokenPipeline:
+    """TokenPipeline class
+
+    Normalizes the search words of a search text before they are passed to a
+    search backend, and bounds the number of tokens, so that long pasted
+    inputs do not result in huge backend queries.
+
+    Stages, in order:
+
+    * fold: Unicode NFKC normalization, and removal of diacritics if enabled
+    * min_length: drop tokens shorter than the minimum token length
+    * stopword: drop stopwords (case insensitive)
+    * duplicate: drop repeated tokens (case insensitive)
+    * max_count: drop words after the maximum token count has been reached
+    """
+
+    def __init__(self, config, metrics, logger):
+        """Constructor
+
+        :param RuntimeConfig config: Config handler
+        :param SearchMetrics metrics: Metrics for dropped token counts
+        :param Logger logger: Application logger
+        """
+        self.metrics = metrics
+        self.logger = logger
+
+        self.fold_diacritics = config.get("token_fold_diacritics", False)
+        self.min_length = config.get("token_min_length", 1)
+        self.stopwords = set(
+            self.fold(word).casefold() for word in config.get("token_stopwords", [])
+        )
+        self.dedupe = config.get("token_dedupe", True)
+        # 0 for no limit
+        self.max_count = config.get("token_max_count", 20)
+
+    def fold(self, token):
+        """Return normalized token.
+
+        :param str token: Token
+        """
+        if token.isascii():
+            return token
+        token = unicodedata.normalize("NFKC", token)
+        if self.fold_diacritics:
+            token = "".join(
+                c
+                for c in unicodedata.normalize("NFKD", token)
+                if not unicodedata.combining(c)
+            )
+            token = unicodedata.normalize("NFKC", token)
+        return token
+
+    def process(self, words):
+        """Return normalized tokens and the dropped tokens per stage.
+
+        :param list(str) words: Search words
+        """
+        dropped = {}
+
+        def drop(stage, token):
+            dropped.setdefault(stage, []).append(token)
+
+        tokens = []
+        seen = set()
+        words = iter(words)
+        for word in words:
+            if self.max_count and len(tokens) >= self.max_count:
+                # skip processing of remaining words
+                dropped["max_count"] = [word] + list(words)
+                break
+            token = self.fold(word)
+            if len(token) < self.min_length:
+                drop("min_length", word)
+                continue
+            key = token.casefold()
+            if key in self.stopwords:
+                drop("stopword", word)
+                continue
+            if self.dedupe:
+                if key in seen:
+                    drop("duplicate", word)
+                    continue
+                seen.add(key)
+            tokens.append(token)
+
+        if dropped:
+            for stage, stage_tokens in dropped.items():
+                self.metrics.inc("tokens_dropped_%s" % stage, len(stage_tokens))
+            if "max_count" in dropped:
+                self.logger.info(
+                    "Search text exceeds %d tokens, dropped %d tokens"
+                    % (self.max_count, len(dropped["max_count"]))
+                )
+            self.logger.debug("Dropped search tokens: %s" % dropped)
+        return tokens, dropped
@@ -0,0 +1,145 @@
+import os
+import threading
+import time
+
+from qwc_services_core.runtime_config import RuntimeConfig
+
+# Max seconds between retries of failed tenants
+MAX_RETRY_INTERVAL = 300
+
+
+class TenantWarmup:
+    """TenantWarmup class
+
+    Creates the search handlers of configured tenants in a background thread
+    at startup, opens their DB pools and Solr sessions and optionally runs
+    canary searches, so that the first requests of a tenant do not pay for
+    loading its config and opening backend connections.
+
+    Configured with environment variables:
+
+    * WARMUP_TENANTS: Comma separated list of tenants, or `*` for all tenants
+      in the config directory. Warm-up is disabled if unset.
+    * WARMUP_CANARY_QUERIES: Comma separated search texts run as anonymous
+      user for each tenant after opening the connections.
+    * WARMUP_RETRY_INTERVAL: Seconds before retrying failed tenants, doubled
+      after each failed retry (default: 5, 0 to disable retries).
+    """
+
+    def __init__(self, handler_factories, logger):
+        """Constructor
+
+        :param list(func) handler_factories: Functions returning the registered
+                                             handler for a tenant
+        :param Logger logger: Application logger
+        """
+        self.handler_factories = handler_factories
+        self.logger = logger
+
+        self.tenants = self.configured_tenants(os.environ.get("WARMUP_TENANTS", ""))
+        self.canary_queries = [
+            query.strip()
+            for query in os.environ.get("WARMUP_CANARY_QUERIES", "").split(",")
+            if query.strip()
+        ]
+        self.retry_interval = float(os.environ.get("WARMUP_RETRY_INTERVAL", 5))
+
+        self.lock = threading.Lock()
+        # Process which started the warm-up thread
+        self.pid = None
+        self.finished = not self.tenants
+        # Warm-up result per tenant: pending, ok or error message
+        self.results = {tenant: "pending" for tenant in self.tenants}
+
+    def configured_tenants(self, value):
+        """Return list of tenants to warm up.
+
+        :param str value: Comma separated tenants or `*` for all tenants
+        """
+        tenants = [tenant.strip() for tenant in value.split(",") if tenant.strip()]
+        if tenants != ["*"]:
+            return tenants
+
+        # all tenant subdirectories with a search service config
+        config_path = os.environ.get("CONFIG_PATH", "config")
+        try:
+            return sorted(
+                tenant
+                for tenant in os.listdir(config_path)
+                if os.path.isfile(RuntimeConfig.config_file_path("search", tenant))
+            )
+        except OSError as e:
+            self.logger.warning("Could not list tenants in %s: %s" % (config_path, e))
+            return []
+
+    def start(self):
+        """Start warm-up thread, once per process."""
+        if self.finished:
+            return
+        with self.lock:
+            # restart in forked worker processes
+            if self.pid == os.getpid():
+                return
+            self.pid = os.getpid()
+        threading.Thread(target=self.run, daemon=True).start()
+
+    def ready(self):
+        """Return whether warm-up has finished."""
+        return self.finished
+
+    def failed_tenants(self):
+        """Return warm-up errors of failed tenants."""
+        return {
+            tenant: result
+            for tenant, result in self.results.items()
+            if result.startswith("error")
+        }
+
+    def run(self):
+        """Warm up all tenants, then retry failed tenants with backoff."""
+        start = time.time()
+        self.warm_up_tenants(self.tenants)
+        self.logger.info(
+            "Warm-up of %d tenants finished in %.1fs"
+            % (len(self.tenants), time.time() - start)
+        )
+        self.finished = True
+
+        # NOTE: a failed readiness probe does not restart the pod, so retry
+        #       tenants which failed e.g. during a DB outage at startup
+        interval = self.retry_interval
+        while interval > 0 and self.failed_tenants():
+            time.sleep(interval)
+            self.warm_up_tenants(list(self.failed_tenants()))
+            interval = min(interval * 2, MAX_RETRY_INTERVAL)
+
+    def warm_up_tenants(self, tenants):
+        """Warm up tenants and record their results.
+
+        :param list(str) tenants: Tenant names
+        """
+        for tenant in tenants:
+            try:
+                self.warm_up(tenant)
+                self.results[tenant] = "ok"
+            except Exception as e:
+                self.logger.error("Warm-up of tenant %s failed: %s" % (tenant, e))
+                self.results[tenant] = "error: %s" % e
+
+    def warm_up(self, tenant):
+        """Create and warm up handlers of a tenant.
+
+        :param str tenant: Tenant name
+        """
+        for factory in self.handler_factories:
+            handler = factory(tenant)
+            handler.warmup()
+            if not hasattr(handler, "search"):
+                continue
+            for searchtext in self.canary_queries:
+                result = handler.search(None, searchtext, [], None)
+                if type(result) is tuple:
+                    raise Exception(
+                        "Canary search '%s' failed with status %s"
+                        % (searchtext, result[1])
+                    )
@@ -1,19 +1,28 @@
 import logging
 import os
+import threading
+import time
 
-from flask import Flask, jsonify, request
+from flask import Flask, Response, g, json, jsonify, request, stream_with_context
 from flask_restx import Api, Resource
+from flask_restx.representations import output_json
 from qwc_services_core.auth import auth_manager, get_identity, optional_auth
 from qwc_services_core.runtime_config import RuntimeConfig
 from qwc_services_core.tenant_handler import (
-    TenantHandler,
     TenantPrefixMiddleware,
     TenantSessionInterface,
 )
 
 from pg_search_service import PgClient  # noqa: E402
+from query_log import QueryLog  # noqa: E402
+from search_batch import SearchBatch  # noqa: E402
+from search_deadline import DEADLINE_HEADER, create_deadline  # noqa: E402
 from search_geom_service import SearchGeomService  # noqa: E402
+from search_metrics import RequestTimer, export_metrics  # noqa: E402
+from search_spatial import parse_spatial  # noqa: E402
+from search_warmup import TenantWarmup  # noqa: E402
 from solr_search_service import SolrClient  # noqa: E402
+from tenant_handlers import EvictingTenantHandler  # noqa: E402
 
 # Flask application
 app = Flask(__name__)
@@ -71,7 +80,9 @@ Faceted fulltext search API.
         {
           "dataproduct_id": "<string>",         /* Dataproduct identifier, e.g. ch.so.agi.grundbuchplan */
           "filterword": "<string>",             /* Filter prefix keyword */
-          "count": <int>                        /* Number of features */
+          "count": <int>,                       /* Number of features */
+          "exact": <bool>,                      /* Postgres backend: False if count is approximate or unknown (-1) */
+          "cursor": "<string>"                  /* Optional: Token for next results of this facet (cursor param) */
         },
         {
           "dataproduct_id": "dataproduct",      /* Special key for dataproducts (layers) */
@@ -79,7 +90,8 @@ Faceted fulltext search API.
           "count": <int>                        /* Number of features */
         },
         {...}
-      ]
+      ],
+      "partial": <bool>                         /* Optional: True if the request deadline was exceeded */
     }
           """,
     default_label="Search operations",
@@ -91,15 +103,116 @@ app.config["ERROR_404_HELP"] = False
 
 auth = auth_manager(app, api)
 
-tenant_handler = TenantHandler(app.logger)
+
+@api.representation("application/json")
+def output_json_timed(data, code, headers=None):
+    """Serialize JSON response and record serialization time of search requests"""
+    metrics = g.get("metrics")
+    if metrics is None:
+        return output_json(data, code, headers)
+    with metrics.phase("serialize"):
+        return output_json(data, code, headers)
+
+
+tenant_handler = EvictingTenantHandler(app.logger)
+query_log = QueryLog()
 app.wsgi_app = TenantPrefixMiddleware(app.wsgi_app)
 app.session_interface = TenantSessionInterface()
 
 
-def search_handler():
-    tenant = tenant_handler.tenant()
+def with_server_timing(result, handler, identity):
+    """Add Server-Timing header to a resource result if permitted for identity.
+
+    :param obj result: Response data or tuple (data, code[, headers])
+    :param obj handler: Search handler
+    :param obj identity: User identity
+    """
+    if not handler.resources.server_timing_permitted(identity):
+        return result
+    headers = {"Server-Timing": g.request_timer.header()}
+    if type(result) is tuple:
+        data, code, *extra_headers = result
+        if extra_headers:
+            headers.update(extra_headers[0])
+        return (data, code, headers)
+    return (result, 200, headers)
+
+
+def record_request(handler, endpoint, params, status, num_results=None):
+    """Record metrics of a finished request and append it to the query log.
+
+    :param obj handler: Search handler
+    :param str endpoint: Endpoint name (fts, geom)
+    :param obj params: Request parameters for the query log
+    :param int status: HTTP status code
+    :param int num_results: Number of returned results
+    """
+    handler.metrics.request(endpoint, status, num_results)
+    query_log.record(
+        endpoint,
+        tenant_handler.tenant(),
+        params,
+        status,
+        time.time() - g.request_start,
+    )
+
+
+def parse_filter(filter_param):
+    """Return list of facets from comma separated filter param.
+
+    :param str filter_param: Filter param
+    """
+    # split filter and trim whitespace
+    filter = [s.strip() for s in (filter_param or "").split(",")]
+    # remove empty strings
+    return [s for s in filter if len(s) > 0]
+
+
+def batch_params_error(params):
+    """Return error message for invalid params of a batch search, or None.
+
+    :param obj params: Search or default params of a batch request
+    """
+    if not isinstance(params.get("filter"), (str, type(None))):
+        return "Invalid filter"
+    limit = params.get("limit")
+    if isinstance(limit, bool) or not isinstance(limit, (int, str, type(None))):
+        return "Invalid limit"
+    if not isinstance(params.get("cursor"), (str, type(None))):
+        return "Invalid cursor"
+    return None
+
+
+def parse_limit(limit):
+    """Return positive limit or None.
+
+    :param str limit: Limit param
+    """
+    try:
+        if limit:
+            limit = int(limit)
+            if limit > 0:
+                return limit
+    except ValueError:
+        pass
+    return None
+
+
+# Lock for creating tenant handlers in threaded workers
+handler_lock = threading.Lock()
+
+
+def search_handler(tenant=None):
+    if tenant is None:
+        tenant = tenant_handler.tenant()
     handler = tenant_handler.handler("search", "fts", tenant)
-    if handler is None:
+    if handler is not None:
+        return handler
+    with handler_lock:
+        # handler may have been registered by another thread meanwhile
+        handler = tenant_handler.handler("search", "fts", tenant)
+        if handler is not None:
+            return handler
         config_handler = RuntimeConfig("search", app.logger)
         config = config_handler.tenant_config(tenant)
         search_backend = config.get("search_backend")
@@ -121,14 +234,37 @@ def search_handler():
     return handler
 
 
-def search_geom_handler():
-    tenant = tenant_handler.tenant()
+def search_geom_handler(tenant=None):
+    if tenant is None:
+        tenant = tenant_handler.tenant()
     handler = tenant_handler.handler("search", "geom", tenant)
-    if handler is None:
-        handler = tenant_handler.register_handler(
-            "geom", tenant, SearchGeomService(tenant, app.logger)
-        )
-    return handler
+    if handler is not None:
+        return handler
+    with handler_lock:
+        handler = tenant_handler.handler("search", "geom", tenant)
+        if handler is None:
+            handler = tenant_handler.register_handler(
+                "geom", tenant, SearchGeomService(tenant, app.logger)
+            )
+        return handler
+
+
+warmup = TenantWarmup([search_handler, search_geom_handler], app.logger)
+
+try:
+    # Start warm-up in uWSGI workers after fork, not in the master process,
+    # so that workers do not share inherited DB connections and sessions
+    from uwsgidecorators import postfork
+
+    postfork(warmup.start)
+except ImportError:
+    pass
+
+
+@app.before_request
+def start_warmup():
+    # start warm-up on first request if not started after fork
+    warmup.start()
 
 
 @api.route("/fts/", "/")
@@ -140,6 +276,22 @@ class SearchResult(Resource):
         'Comma separated list of dataproduct identifiers and keyword "dataproduct"',
     )
     @api.param("limit", "Max number of results")
+    @api.param(
+        "cursor",
+        "Continuation token from `result_counts` to get the next results of a facet",
+    )
+    @api.param("center", "Optional map center `<x>,<y>` to rank nearby results first")
+    @api.param(
+        "extent",
+        "Optional map extent `<xmin>,<ymin>,<xmax>,<ymax>` to search in",
+    )
+    @api.param(
+        "crs", "CRS of `center` and `extent`, e.g. `EPSG:2056`. Default: `EPSG:4326`"
+    )
+    @api.header(
+        DEADLINE_HEADER,
+        "Optional: Timeout in seconds, returns partial results when exceeded",
+    )
     @optional_auth
     def get(self):
         """Search for searchtext and return the results"""
@@ -147,29 +299,178 @@ class SearchResult(Resource):
         if not searchtext:
             return {"error": "Missing search string"}
         filter_param = request.args.get("filter", "")
-        limit = request.args.get("limit", None)
+        limit = parse_limit(request.args.get("limit", None))
+        cursor = request.args.get("cursor", None)
+        filter = parse_filter(filter_param)
+        center = request.args.get("center") or None
+        extent = request.args.get("extent") or None
+        crs = request.args.get("crs") or None
+        try:
+            spatial = parse_spatial(center, extent, crs)
+        except ValueError as e:
+            return ({"error": str(e)}, 400)
+
+        g.request_start = time.time()
+        g.request_timer = RequestTimer()
+        handler = search_handler()
+        g.metrics = handler.metrics
+        g.deadline = create_deadline(handler.resources.request_timeout)
+        identity = get_identity()
+        params = {
+            "searchtext": searchtext,
+            "filter": filter_param,
+            "limit": limit,
+            "cursor": cursor,
+            "center": center,
+            "extent": extent,
+            "crs": crs,
+        }
         try:
-            if limit:
-                limit = int(limit)
-                if limit <= 0:
-                    limit = None
-        except ValueError:
-            limit = None
-
-        # split filter and trim whitespace
-        filter = [s.strip() for s in filter_param.split(",")]
-        # remove empty strings
-        filter = [s for s in filter if len(s) > 0]
+            result = handler.search(
+                identity, searchtext, filter, limit, cursor, spatial=spatial
+            )
+        except Exception:
+            record_request(handler, "fts", params, 500)
+            raise
+
+        if type(result) is tuple:
+            # Backend error response
+            record_request(handler, "fts", params, result[1])
+        else:
+            record_request(handler, "fts", params, 200, len(result["results"]))
+
+        return with_server_timing(result, handler, identity)
+
+
+@api.route("/suggest/")
+@api.response(404, "Suggestions not configured")
+@api.response(503, "Suggest index not yet available")
+class SuggestResult(Resource):
+    @api.doc("suggest")
+    @api.param("searchtext", "Prefix of a word in the display strings")
+    @api.param("filter", "Comma separated list of dataproduct identifiers")
+    @api.param("limit", "Max number of suggestions")
+    @optional_auth
+    def get(self):
+        """Return display strings of features for autocomplete
+
+        Returns display strings containing a word starting with searchtext,
+        from an in-memory index of the configured facets:
+
+            {
+              "suggestions": [
+                {
+                  "display": "<string>",         /* Text to display in search result list */
+                  "dataproduct_id": "<string>"   /* Facet of the feature */
+                }
+              ]
+            }
+        """
+        searchtext = request.args.get("searchtext", "")
+        filter_param = request.args.get("filter", "")
+        limit = parse_limit(request.args.get("limit", None))
 
+        g.request_start = time.time()
         handler = search_handler()
-        result = handler.search(get_identity(), searchtext, filter, limit)
+        params = {"searchtext": searchtext, "filter": filter_param, "limit": limit}
+        if handler.suggest_index is None:
+            record_request(handler, "suggest", params, 404)
+            api.abort(404, "Suggestions not configured")
 
-        return result
+        identity = get_identity()
+        suggestions = handler.suggest_index.suggest(
+            identity, searchtext, parse_filter(filter_param), limit
+        )
+        if suggestions is None:
+            record_request(handler, "suggest", params, 503)
+            return (
+                {"message": "Suggest index not yet available"},
+                503,
+                {"Retry-After": "1"},
+            )
+        record_request(handler, "suggest", params, 200, len(suggestions))
+        return {"suggestions": suggestions}
+
+
+@api.route("/fts/batch/")
+@api.response(400, "Bad request")
+class SearchBatchResult(Resource):
+    @api.doc("search_batch")
+    @optional_auth
+    def post(self):
+        """Run multiple searches and stream the results as NDJSON
+
+        Request body:
+
+            {
+              "searches": [                     /* Search texts or search objects */
+                "<searchtext>",
+                {"searchtext": "<searchtext>", "filter": "<filter>", "limit": <int>, "cursor": "<cursor>"}
+              ],
+              "filter": "<filter>",             /* Optional: Default filter */
+              "limit": <int>                    /* Optional: Default limit */
+            }
+
+        Returns one line per search in request order, with the search response
+        and `index`, `searchtext` and `status`, or `error` and `status` if the
+        search failed.
+        """
+        body = request.get_json(silent=True)
+        if not isinstance(body, dict) or not isinstance(body.get("searches"), list):
+            api.abort(400, "Missing searches")
+
+        error = batch_params_error(body)
+        if error:
+            api.abort(400, error)
+
+        handler = search_handler()
+        default_filter = body.get("filter")
+        default_limit = body.get("limit")
+        searches = []
+        for search in body["searches"]:
+            if not isinstance(search, dict):
+                search = {"searchtext": search}
+            if not isinstance(search.get("searchtext"), str):
+                api.abort(400, "Missing search string")
+            error = batch_params_error(search)
+            if error:
+                api.abort(400, error)
+            searches.append(
+                {
+                    "searchtext": search["searchtext"],
+                    "filter": parse_filter(search.get("filter", default_filter)),
+                    "limit": parse_limit(search.get("limit", default_limit)),
+                    "cursor": search.get("cursor"),
+                }
+            )
+        if len(searches) > handler.resources.batch_max_searches:
+            api.abort(
+                400,
+                "Too many searches, max. %d" % handler.resources.batch_max_searches,
+            )
+
+        batch = SearchBatch(handler, handler.resources.batch_concurrency, app.logger)
+        identity = get_identity()
+
+        def ndjson():
+            for result in batch.run(identity, searches):
+                # record each search once it has finished
+                num_results = None
+                if result["status"] == 200:
+                    num_results = len(result["results"])
+                handler.metrics.request("batch", result["status"], num_results)
+                yield json.dumps(result) + "\n"
+
+        return Response(
+            stream_with_context(ndjson()), content_type="application/x-ndjson"
+        )
 
 
 @api.route("/geom/<dataset>/")
 @api.response(400, "Bad request")
 @api.response(404, "Dataset not found or permission error")
+@api.response(429, "Too many requests of tenant")
+@api.response(503, "Search backend overloaded")
 @api.param("dataset", 'Identifier of dataset. Example: `"ne_10m_admin_0_countries"`')
 class GeomResult(Resource):
     @api.doc("geom")
@@ -177,6 +478,15 @@ class GeomResult(Resource):
         "filter",
         'JSON serialized array of filter expressions: `[["attr", "op", "value"], "and/or", ["attr", "op", "value"]]`',
     )
+    @api.param(
+        "bbox",
+        "Optional extent `<xmin>,<ymin>,<xmax>,<ymax>`, e.g. of the map view. Only features intersecting the extent are returned.",
+    )
+    @api.param(
+        "crs",
+        "CRS of `bbox`, e.g. `EPSG:2056`. Default: CRS of the dataset geometries",
+    )
+    @api.param("limit", "Max number of returned features")
     @optional_auth
     def get(self, dataset):
         """Get dataset geometries
@@ -186,18 +496,61 @@ class GeomResult(Resource):
         The matching features are returned as GeoJSON FeatureCollection.
         """
         filterexpr = request.args.get("filter")
+        bbox = request.args.get("bbox") or None
+        crs = request.args.get("crs") or None
+        limit = request.args.get("limit") or None
+        if limit is not None:
+            limit = parse_limit(limit)
+            if limit is None:
+                return ({"message": "Invalid limit"}, 400)
+        g.request_start = time.time()
+        g.request_timer = RequestTimer()
         handler = search_geom_handler()
-        result = handler.query(get_identity(), dataset, filterexpr)
+        g.metrics = handler.metrics
+        g.deadline = create_deadline(handler.resources.request_timeout)
+        identity = get_identity()
+        params = {
+            "dataset": dataset,
+            "filter": filterexpr,
+            "bbox": bbox,
+            "crs": crs,
+            "limit": limit,
+        }
+        try:
+            result = handler.query(identity, dataset, filterexpr, bbox, crs, limit)
+        except Exception:
+            record_request(handler, "geom", params, 500)
+            raise
+
         if "error" not in result:
-            return result["feature_collection"]
+            feature_collection = result["feature_collection"]
+            record_request(
+                handler, "geom", params, 200, len(feature_collection["features"])
+            )
+            return with_server_timing(feature_collection, handler, identity)
         else:
             error_code = result.get("error_code") or 404
-            api.abort(error_code, result["error"])
+            record_request(handler, "geom", params, error_code)
+            headers = {}
+            if "retry_after" in result:
+                headers["Retry-After"] = str(result["retry_after"])
+            return with_server_timing(
+                ({"message": result["error"]}, error_code, headers), handler, identity
+            )
 
 
 @app.route("/ready", methods=["GET"])
 def ready():
     """readyness probe endpoint"""
+    if not warmup.ready():
+        response = jsonify({"status": "WARMING_UP", "tenants": warmup.results})
+        response.status_code = 503
+        return response
+    failed_tenants = warmup.failed_tenants()
+    if failed_tenants:
+        response = jsonify({"status": "WARMUP_FAILED", "tenants": failed_tenants})
+        response.status_code = 503
+        return response
     return jsonify({"status": "OK"})
 
 
@@ -207,6 +560,13 @@ def healthz():
     return jsonify({"status": "OK"})
 
 
+@app.route("/metrics", methods=["GET"])
+def metrics():
+    """Prometheus metrics endpoint"""
+    data, content_type = export_metrics()
+    return Response(data, content_type=content_type)
+
+
 # local webserver
 if __name__ == "__main__":
     print("Starting Search service...")
@@ -0,0 +1,112 @@
+import random
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+from flask import json
+from sqlalchemy.sql import text as sql_text
+
+
+class SlowQueryLog:
+    """SlowQueryLog class
+
+    Logs Postgres queries exceeding a duration threshold as structured log
+    records and optionally runs a sampled EXPLAIN (ANALYZE, BUFFERS) of the
+    query in a background thread on a separate connection.
+    """
+
+    def __init__(self, config, logger):
+        """Constructor
+
+        :param RuntimeConfig config: Config handler
+        :param Logger logger: Application logger
+        """
+        self.logger = logger
+        # Duration threshold in seconds, 0 to disable
+        self.threshold = config.get("slow_query_threshold", 0.0)
+        self.explain_sample_rate = config.get("slow_query_explain_sample_rate", 0.0)
+        self.explain_timeout = config.get("slow_query_explain_timeout", 30.0)
+
+        self.executor = None
+        # Only run a single EXPLAIN at a time, skip further samples meanwhile
+        self.explain_lock = threading.Lock()
+
+    def record(self, engine, source, sql, params, row_count, duration, setup=None):
+        """Log query if it exceeds the slow query threshold.
+
+        :param Engine engine: DB engine the query was run on
+        :param str source: Query source, e.g. feature_query
+        :param str sql: Rendered query SQL
+        :param obj params: Query bind parameters
+        :param int row_count: Number of returned rows
+        :param float duration: Query duration in seconds
+        :param list setup: List of (sql, params) statements to run before EXPLAIN
+        """
+        if self.threshold <= 0 or duration < self.threshold:
+            return
+
+        record = {
+            "event": "slow_query",
+            "source": source,
+            "duration": round(duration, 4),
+            "rows": row_count,
+            "sql": sql,
+            "params": params,
+        }
+        self.logger.warning("Slow query: %s" % json.dumps(record, default=str))
+
+        if (
+            self.explain_sample_rate > 0
+            and random.random() < self.explain_sample_rate
+            and self.explain_lock.acquire(blocking=False)
+        ):
+            if self.executor is None:
+                self.executor = ThreadPoolExecutor(
+                    max_workers=1, thread_name_prefix="explain"
+                )
+            self.executor.submit(self._explain, engine, record, setup or [])
+
+    def _explain(self, engine, record, setup):
+        """Run EXPLAIN (ANALYZE, BUFFERS) for a slow query and log the plan.
+
+        :param Engine engine: DB engine
+        :param obj record: Slow query log record
+        :param list setup: List of (sql, params) statements to run before EXPLAIN
+        """
+        try:
+            with engine.connect() as conn:
+                conn.execute(
+                    sql_text("SET LOCAL statement_timeout = :timeout"),
+                    {"timeout": int(self.explain_timeout * 1000)},
+                )
+                for sql, params in setup:
+                    conn.execute(sql_text(sql), params)
+                plan = conn.execute(
+                    sql_text(
+                        "EXPLAIN (ANALYZE, BUFFERS, FORMAT JSON) " + record["sql"]
+                    ),
+                    record["params"],
+                ).scalar()
+                # read-only, discard any changes
+                conn.rollback()
+
+            self.logger.warning(
+                "Slow query plan: %s"
+                % json.dumps(
+                    {
+                        "event": "slow_query_plan",
+                        "source": record["source"],
+                        "sql": record["sql"],
+                        "plan": plan,
+                    },
+                    default=str,
+                )
+            )
+        except Exception as e:
+            self.logger.warning("Could not explain slow query: %s" % e)
+        finally:
+            self.explain_lock.release()
+
+    def close(self):
+        """Stop the EXPLAIN thread after a running EXPLAIN."""
+        if self.executor is not None:
+            self.executor.shutdown(wait=False)
@@ -0,0 +1,241 @@
+import threading
+import time
+from collections import deque
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+
+import requests
+
+# Minimum number of latency samples before hedged requests are sent
+HEDGE_MIN_SAMPLES = 20
+
+
+class CircuitBreaker:
+    """CircuitBreaker class
+
+    Tracks the outcome of the last requests to a backend. The breaker opens
+    once the error rate over a full window crosses the threshold, rejects all
+    requests while open, and lets a single probe request through after the
+    reset timeout (half-open). A successful probe closes the breaker again.
+    """
+
+    CLOSED = "closed"
+    OPEN = "open"
+    HALF_OPEN = "half_open"
+
+    def __init__(self, error_threshold, window, reset_timeout, metrics, logger):
+        """Constructor
+
+        :param float error_threshold: Error rate (0-1) opening the breaker, 0 to disable
+        :param int window: Number of recent requests the error rate is computed over
+        :param float reset_timeout: Seconds before an open breaker lets a probe through
+        :param SearchMetrics metrics: Metrics counting breaker and hedging events
+        :param Logger logger: Application logger
+        """
+        self.error_threshold = error_threshold
+        self.window = max(1, window)
+        self.reset_timeout = reset_timeout
+        self.metrics = metrics
+        self.logger = logger
+
+        self.state = self.CLOSED
+        self.outcomes = deque(maxlen=self.window)
+        self.opened_at = 0
+        self.probe_started = 0
+        self.lock = threading.Lock()
+
+    def allow_request(self):
+        """Return whether a request may be sent to the backend."""
+        if self.error_threshold <= 0:
+            return True
+        with self.lock:
+            now = time.time()
+            if self.state == self.OPEN:
+                if now - self.opened_at < self.reset_timeout:
+                    return False
+                self._set_state(self.HALF_OPEN)
+                self.probe_started = now
+                return True
+            if self.state == self.HALF_OPEN:
+                # Only one probe at a time, unless the last probe got lost
+                if now - self.probe_started < self.reset_timeout:
+                    return False
+                self.probe_started = now
+            return True
+
+    def record_success(self):
+        with self.lock:
+            if self.state == self.HALF_OPEN:
+                self.outcomes.clear()
+                self._set_state(self.CLOSED)
+            self.outcomes.append(True)
+
+    def record_failure(self):
+        with self.lock:
+            if self.state == self.HALF_OPEN:
+                self._open()
+                return
+            self.outcomes.append(False)
+            if self.state == self.CLOSED and len(self.outcomes) == self.window:
+                errors = self.outcomes.count(False)
+                if errors / self.window >= self.error_threshold:
+                    self._open()
+
+    def retry_after(self):
+        """Return seconds until the breaker lets the next probe through."""
+        return max(1, int(round(self.opened_at + self.reset_timeout - time.time())))
+
+    def _open(self):
+        self.opened_at = time.time()
+        self.outcomes.clear()
+        self._set_state(self.OPEN)
+
+    def _set_state(self, state):
+        self.logger.warning(
+            "Circuit breaker state change: %s -> %s" % (self.state, state)
+        )
+        self.state = state
+        self.metrics.inc("breaker_%s" % state)
+
+
+class HedgedRequester:
+    """HedgedRequester class
+
+    Sends GET requests to a primary URL and, if there is no answer after the
+    configured percentile of recent latencies, a second copy to a replica.
+    The first successful response wins; the slower request is cancelled if it
+    has not started yet, or abandoned. Hedging is disabled without replicas,
+    and at most a quarter of the request threads are used for hedged requests,
+    so that abandoned requests do not block the requests of other searches.
+    """
+
+    def __init__(
+        self, session, urls, timeout, hedge_percentile, max_workers, metrics, logger
+    ):
+        """Constructor
+
+        :param Session session: HTTP session
+        :param list(str) urls: Primary URL followed by replica URLs
+        :param float timeout: Request timeout in seconds
+        :param float hedge_percentile: Latency percentile after which a hedge is sent, 0 to disable
+        :param int max_workers: Max number of concurrent backend requests
+        :param SearchMetrics metrics: Metrics counting breaker and hedging events
+        :param Logger logger: Application logger
+        """
+        self.session = session
+        self.urls = urls
+        self.timeout = timeout
+        self.hedge_percentile = hedge_percentile
+        self.metrics = metrics
+        self.logger = logger
+
+        self.latencies = deque(maxlen=100)
+        self.next_replica = 0
+        self.lock = threading.Lock()
+        self.executor = ThreadPoolExecutor(
+            max_workers=max_workers, thread_name_prefix="solr"
+        )
+        # Slots for hedged requests in flight
+        self.hedge_slots = threading.BoundedSemaphore(max(1, max_workers // 4))
+
+    def get(self, params, auth, request_timeout=None):
+        """Send request and return the first successful response.
+
+        Raises the last requests exception if no request succeeded.
+
+        :param str params: Query string
+        :param tuple auth: Basic auth credentials
+        :param float request_timeout: Timeout in seconds if shorter than the configured timeout
+        """
+        if request_timeout is None or request_timeout > self.timeout:
+            request_timeout = self.timeout
+        start = time.time()
+        hedge_delay = self.hedge_delay()
+        if hedge_delay is not None and hedge_delay >= request_timeout:
+            hedge_delay = None
+        hedge = None
+        error = None
+        pending = {
+            self.executor.submit(self._get, self.urls[0], params, auth, request_timeout)
+        }
+        while pending:
+            if hedge is None and hedge_delay is not None:
+                timeout = start + hedge_delay - time.time()
+            else:
+                timeout = start + request_timeout - time.time()
+            done, pending = wait(
+                pending, timeout=max(0, timeout), return_when=FIRST_COMPLETED
+            )
+            for future in done:
+                try:
+                    response = future.result()
+                except requests.exceptions.RequestException as e:
+                    error = e
+                    continue
+                with self.lock:
+                    self.latencies.append(time.time() - start)
+                if future is hedge:
+                    self.metrics.inc("hedge_wins")
+                for loser in pending:
+                    # only possible if the request has not started yet
+                    loser.cancel()
+                return response
+
+            if not done:
+                if hedge is None and hedge_delay is not None:
+                    hedge_delay = None
+                    if not self.hedge_slots.acquire(blocking=False):
+                        # too many hedged requests in flight
+                        continue
+                    url = self.replica_url()
+                    self.logger.debug(
+                        "No Solr response after %f s, sending hedged request to %s"
+                        % (time.time() - start, url)
+                    )
+                    self.metrics.inc("hedged")
+                    # hedged request ends at the timeout of the primary request
+                    hedge = self.executor.submit(
+                        self._get,
+                        url,
+                        params,
+                        auth,
+                        max(0.001, start + request_timeout - time.time()),
+                    )
+                    hedge.add_done_callback(lambda f: self.hedge_slots.release())
+                    pending.add(hedge)
+                else:
+                    break
+
+        raise error or requests.exceptions.Timeout(
+            "No Solr response within %s s" % request_timeout
+        )
+
+    def hedge_delay(self):
+        """Return delay before sending a hedged request, or None if disabled."""
+        if (
+            len(self.urls) < 2
+            or self.hedge_percentile <= 0
+            or len(self.latencies) < HEDGE_MIN_SAMPLES
+        ):
+            return None
+        with self.lock:
+            latencies = sorted(self.latencies)
+        index = int(len(latencies) * self.hedge_percentile / 100)
+        delay = latencies[min(index, len(latencies) - 1)]
+        if delay >= self.timeout:
+            return None
+        return delay
+
+    def replica_url(self):
+        """Return next replica URL (round robin)."""
+        replicas = self.urls[1:]
+        with self.lock:
+            self.next_replica = (self.next_replica + 1) % len(replicas)
+            return replicas[self.next_replica]
+
+    def _get(self, url, params, auth, timeout):
+        return self.session.get(url, params=params, auth=auth, timeout=timeout)
+
+    def close(self):
+        """Stop the request threads and close the HTTP session."""
+        self.executor.shutdown(wait=False)
+        self.session.close()
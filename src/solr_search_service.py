@@ -1,12 +1,21 @@
 import os
 import re
+from contextlib import contextmanager
+from urllib.parse import quote, urlencode
 
 import requests
 from flask import json
 from qwc_services_core.permissions_reader import PermissionsReader
 from qwc_services_core.runtime_config import RuntimeConfig
 
+from admission_control import AdmissionControl, AdmissionRejected
+from search_cursor import decode_cursor, encode_cursor
+from search_deadline import request_deadline
+from search_metrics import SearchMetrics
 from search_resources import SearchResources
+from search_tokens import TokenPipeline
+from solr_resilience import CircuitBreaker, HedgedRequester
+from suggest_index import SuggestIndex
 
 FILTERWORD_CHARS = os.environ.get("FILTERWORD_CHARS", r"\w.")
 FILTERWORD_RE = re.compile(f"^([{FILTERWORD_CHARS}]+):\b*")
@@ -17,6 +26,9 @@ QUERY_PARTS = [
     '(search_3_stem:"{0}"^2 OR search_3_ngram:"{0}"^1)',
 ]
 
+# Default eDisMax query fields with the same boosts as QUERY_PARTS
+EDISMAX_QF = "search_1_stem^6 search_1_ngram^5 search_2_stem^4 search_2_ngram^3 search_3_stem^2 search_3_ngram^1"
+
 
 class SolrClient:
     """SolrClient class"""
@@ -35,6 +47,20 @@ class SolrClient:
         self.solr_service_url = config.get(
             "solr_service_url", "http://localhost:8983/solr/gdi/select"
         )
+        replica_urls = config.get("solr_replica_urls", [])
+
+        # Filter by tenant unless the collection is declared as dedicated,
+        # as other tenants may map their configs to the same collection
+        self.tenant_filter = not config.get("solr_dedicated_collection", False)
+
+        # Route tenant to its collection/core if the URL contains a {tenant} placeholder
+        if "{tenant}" in self.solr_service_url:
+            tenant_collections = config.get("solr_tenant_collections", {})
+            collection = tenant_collections.get(tenant, tenant)
+            self.solr_service_url = self.solr_service_url.replace(
+                "{tenant}", collection
+            )
+            replica_urls = [url.replace("{tenant}", collection) for url in replica_urls]
 
         self.solr_service_auth = config.get("solr_service_auth", None)
 
@@ -44,18 +70,136 @@ class SolrClient:
                 self.solr_service_auth.get("password"),
             )
 
+        self.metrics = SearchMetrics(tenant, "solr")
+        self.token_pipeline = TokenPipeline(config, self.metrics, logger)
+        self.requester = HedgedRequester(
+            requests.Session(),
+            [self.solr_service_url] + replica_urls,
+            config.get("solr_timeout", 10.0),
+            config.get("solr_hedge_percentile", 95.0),
+            config.get("solr_max_concurrent_requests", 16),
+            self.metrics,
+            logger,
+        )
+        self.breaker = CircuitBreaker(
+            config.get("solr_breaker_error_threshold", 0.5),
+            config.get("solr_breaker_window", 20),
+            config.get("solr_breaker_reset_timeout", 30.0),
+            self.metrics,
+            logger,
+        )
+
         self.word_split_re = re.compile(config.get("word_split_re", r'[\s,.:;"]+'))
         self.default_search_limit = config.get("search_result_limit", 50)
         self.search_result_sort = config.get(
             "search_result_sort", "score desc, sort asc"
         )
+        # Query mode: "standard" (expanded boolean query) or "edismax"
+        self.query_mode = config.get("solr_query_mode", "standard")
+        self.edismax_qf = config.get("solr_qf", EDISMAX_QF)
+        self.edismax_pf = config.get("solr_pf", "")
+        self.edismax_mm = config.get("solr_mm", "100%")
+        # Group results by facet and limit the number of results per facet
+        self.group_by_facet = config.get("solr_group_by_facet", False)
+        self.facet_search_limit = config.get("solr_facet_search_limit", 50)
+        # Location field for searches biased to the map center and extent
+        self.spatial_field = config.get("solr_spatial_field")
+        self.spatial_boost = config.get(
+            "solr_spatial_boost", "recip(geodist(),2,200,20)"
+        )
 
         permissions = PermissionsReader(tenant, logger)
         self.resources = SearchResources(config, permissions)
+        self.admission = AdmissionControl(
+            config, tenant, self.solr_service_url, self.metrics, logger
+        )
+        # In-memory prefix index for suggestions, exported from Solr
+        self.suggest_index = None
+        if config.get("solr_suggest", False):
+            self.suggest_index = SuggestIndex(
+                self.resources, self.suggest_entries, config, logger
+            )
+
+    @contextmanager
+    def connect(self):
+        """Context manager for batch searches, Solr requests share an HTTP session."""
+        yield None
+
+    def warmup(self):
+        """Open the HTTP session with a minimal Solr request."""
+        result = self.send_query("q=*:*&rows=0&wt=json")
+        if type(result) is tuple:
+            raise Exception("Solr request failed with status %s" % result[1])
+        if self.suggest_index:
+            self.suggest_index.warmup()
+
+    def close(self):
+        """Release the HTTP session and request threads of an evicted handler."""
+        self.admission.close()
+        self.requester.close()
+
+    def suggest_entries(self):
+        """Return (display, facet) tuples of all documents for the suggest index."""
+        entries = []
+        cursor_mark = "*"
+        while True:
+            params = (
+                "omitHeader=true&q=*:*&fl=display,facet&rows=10000&sort=id asc&"
+                + urlencode({"cursorMark": cursor_mark})
+            )
+            if self.tenant_filter:
+                params += "&fq=tenant:%s" % self.tenant
+            response = self.send_query(params)
+            if type(response) is tuple:
+                raise Exception("Solr request failed with status %s" % response[1])
+            for doc in response["response"]["docs"]:
+                entries.append((doc.get("display"), doc.get("facet")))
+            next_cursor_mark = response.get("nextCursorMark")
+            if not next_cursor_mark or next_cursor_mark == cursor_mark:
+                return entries
+            cursor_mark = next_cursor_mark
+
+    def search(
+        self,
+        identity,
+        searchtext,
+        filter,
+        limit,
+        cursor=None,
+        permissions=None,
+        conn=None,
+        spatial=None,
+    ):
+        """Search for searchtext and return the results.
+
+        :param obj identity: User identity
+        :param str searchtext: Search string with optional filter word
+        :param list(str) filter: Facets to search in, all if empty
+        :param int limit: Max number of results
+        :param str cursor: Continuation token for next results of a facet
+        :param tuple permissions: Permitted (solr_facets, dataproducts) if already resolved
+        :param conn: Unused, for compatibility with PgClient
+        :param obj spatial: Map center and extent from parse_spatial(), or None
+        """
+        try:
+            with self.admission.admit():
+                return self.run_search(
+                    identity, searchtext, filter, limit, cursor, permissions, spatial
+                )
+        except AdmissionRejected as e:
+            return e.response()
 
-    def search(self, identity, searchtext, filter, limit):
-        solr_facets = self.resources.solr_facets(identity)
-        (filterword, tokens) = self.tokenize(searchtext)
+    def run_search(
+        self, identity, searchtext, filter, limit, cursor, permissions, spatial=None
+    ):
+        """Search for searchtext after admission, see search()."""
+        if permissions is None:
+            with self.metrics.phase("perm"):
+                solr_facets = self.resources.solr_facets(identity)
+        else:
+            solr_facets = permissions[0]
+        with self.metrics.phase("tokenize"):
+            (filterword, tokens) = self.tokenize(searchtext)
         if not tokens:
             return {"results": [], "result_counts": []}
         filter_ids = filter
@@ -65,16 +209,82 @@ class SolrClient:
         if not limit:
             limit = self.default_search_limit
 
-        response = self.query(tokens, filterword, filter_ids, limit, solr_facets)
+        if cursor:
+            return self.search_cursor(tokens, cursor, limit, solr_facets, spatial)
+
+        response = self.query(
+            tokens, filterword, filter_ids, limit, solr_facets, spatial
+        )
 
         # Return Solr error response
         if type(response) is tuple:
             return response
 
         self.logger.debug(json.dumps(response, indent=2))
-        permitted_dataproducts = self.resources.dataproducts(identity)
+        if permissions is None:
+            with self.metrics.phase("perm"):
+                permitted_dataproducts = self.resources.dataproducts(identity)
+        else:
+            permitted_dataproducts = permissions[1]
+        with self.metrics.phase("build"):
+            result = self.build_results(
+                response, filterword, limit, solr_facets, permitted_dataproducts
+            )
+        if response.get("responseHeader", {}).get("partialResults"):
+            # Solr search stopped by timeAllowed
+            result["partial"] = True
+        return result
+
+    def search_cursor(self, tokens, cursor, limit, solr_facets, spatial=None):
+        """Return next page of feature results of a single facet.
+
+        :param list(str) tokens: Search words
+        :param str cursor: Continuation token from previous search results
+        :param int limit: Max number of results
+        :param obj solr_facets: Permitted facets
+        :param obj spatial: Map center and extent, or None
+        """
+        try:
+            (facet, position) = decode_cursor(cursor)
+            (cursor_mark, skip) = position
+        except (ValueError, TypeError) as e:
+            self.logger.info("Invalid cursor: %s" % e)
+            return ({"error": "Invalid cursor"}, 400)
+        if facet not in solr_facets or facet in [
+            "foreground",
+            "background",
+            "dataproduct",
+        ]:
+            return {"results": [], "result_counts": []}
+
+        response = self.query_cursor(tokens, facet, cursor_mark, skip + limit, spatial)
+        if type(response) is tuple:
+            return response
+
+        with self.metrics.phase("build"):
+            docs = response["response"]["docs"]
+            results = [
+                self.feature_result(doc, None, solr_facets) for doc in docs[skip:]
+            ]
+            result_count = {
+                "dataproduct_id": facet,
+                "filterword": solr_facets[facet][0]["filter_word"],
+                "count": response["response"]["numFound"],
+            }
+            next_cursor_mark = response.get("nextCursorMark")
+            if len(docs) == skip + limit and next_cursor_mark != cursor_mark:
+                result_count["cursor"] = encode_cursor(facet, [next_cursor_mark, 0])
+            return {"results": results, "result_counts": [result_count]}
+
+    def build_results(
+        self, response, filterword, limit, solr_facets, permitted_dataproducts
+    ):
+        if self.group_by_facet:
+            response = self.ungroup_response(response, limit)
         results = []
         num_solr_results_dp = 0
+        # Number of returned feature results per facet
+        num_facet_results = {}
         for doc in response["response"]["docs"]:
             if (
                 doc["facet"] == "foreground"
@@ -87,27 +297,134 @@ class SolrClient:
                     results.append(result)
             else:
                 results.append(self.feature_result(doc, filterword, solr_facets))
+                num_facet_results[doc["facet"]] = (
+                    num_facet_results.get(doc["facet"], 0) + 1
+                )
 
         result_counts = self.result_counts(
             response, filterword, num_solr_results_dp, solr_facets
         )
+        if self.group_by_facet:
+            for result_count in result_counts:
+                # Results limited per facet, report unknown count as for Postgres backend
+                if (
+                    result_count["count"] is not None
+                    and result_count["count"] >= self.facet_search_limit
+                ):
+                    result_count["count"] = -1
+
+        for result_count in result_counts:
+            facet = result_count["dataproduct_id"]
+            if facet in ["foreground", "background", "dataproduct"]:
+                continue
+            returned = num_facet_results.get(facet, 0)
+            if result_count["count"] == -1 or result_count["count"] > returned:
+                # Solr cursor from the start, skipping the returned results
+                result_count["cursor"] = encode_cursor(facet, ["*", returned])
 
         return {"results": results, "result_counts": result_counts}
 
-    def query(self, tokens, filterword, filter_ids, limit, solr_facets):
+    def query(self, tokens, filterword, filter_ids, limit, solr_facets, spatial=None):
         # https://lucene.apache.org/solr/guide/8_1/common-query-parameters.html
-        q = self.query_str(tokens)
-        fq = self.filter_query_str(filterword, filter_ids, solr_facets)
-        response = requests.get(
-            self.solr_service_url,
-            params="omitHeader=true&facet=true&facet.field=facet&sort="
+        if self.query_mode == "edismax":
+            q = self.edismax_query_str(tokens)
+        else:
+            q = self.query_str(tokens)
+        q = self.spatial_query_str(q, spatial)
+        facets = self.search_facets(filterword, filter_ids, solr_facets)
+        fq = self.filter_query_str(facets)
+        if self.group_by_facet:
+            # https://solr.apache.org/guide/solr/latest/query-guide/result-grouping.html
+            result_params = "group=true&group.field=facet&group.limit={}&group.sort={}&rows={}".format(
+                self.facet_search_limit, self.search_result_sort, len(facets)
+            )
+        else:
+            result_params = "{}&rows={}".format(self.facet_params_str(facets), limit)
+        self.logger.info("Search words: %s", ",".join(tokens))
+
+        return self.send_query(
+            "omitHeader=true&{}&sort=".format(result_params)
             + self.search_result_sort
-            + "&rows={}&{}&{}".format(limit, q, fq),
-            auth=self.solr_service_auth,
-            timeout=10,
+            + "&{}&{}".format(q, fq)
         )
+
+    def query_cursor(self, tokens, facet, cursor_mark, rows, spatial=None):
+        """Query results of a single facet with a Solr cursor.
+
+        :param list(str) tokens: Search words
+        :param str facet: Facet name
+        :param str cursor_mark: Solr cursor mark, * for the first page
+        :param int rows: Number of rows
+        :param obj spatial: Map center and extent, or None
+        """
+        # https://solr.apache.org/guide/solr/latest/query-guide/pagination-of-results.html#fetching-a-large-number-of-sorted-results-cursors
+        if self.query_mode == "edismax":
+            q = self.edismax_query_str(tokens)
+        else:
+            q = self.query_str(tokens)
+        q = self.spatial_query_str(q, spatial)
+        fq = self.filter_query_str([facet])
+        sort = self.search_result_sort
+        if not re.search(r"(^|,)\s*id\s", sort):
+            # Cursors require the unique key as tiebreaker in the sort
+            sort += ", id asc"
+        return self.send_query(
+            "omitHeader=true&rows={}&{}&sort=".format(
+                rows, urlencode({"cursorMark": cursor_mark})
+            )
+            + sort
+            + "&{}&{}".format(q, fq)
+        )
+
+    def send_query(self, params):
+        """Send Solr request and return the decoded response or an error tuple.
+
+        :param str params: Query string
+        """
+        request_timeout = None
+        deadline = request_deadline()
+        if deadline is not None:
+            request_timeout = deadline.remaining()
+            if request_timeout < 0.001:
+                return ({"error": "Search deadline exceeded"}, 504)
+            if "cursorMark=" not in params:
+                # Let Solr stop searching and return partial results in time
+                # (not supported with cursorMark)
+                params += "&timeAllowed=%d" % max(1, int(request_timeout * 1000))
+
+        if not self.breaker.allow_request():
+            self.metrics.inc("rejected")
+            self.logger.warning("Solr circuit breaker open, rejecting search request")
+            return (
+                {"error": "Search backend temporarily unavailable"},
+                503,
+                {"Retry-After": str(self.breaker.retry_after())},
+            )
+
+        try:
+            with self.metrics.phase("solr"):
+                response = self.requester.get(
+                    params, self.solr_service_auth, request_timeout
+                )
+        except requests.exceptions.RequestException as e:
+            timeout = isinstance(e, requests.exceptions.Timeout)
+            if not (
+                timeout
+                and request_timeout is not None
+                and request_timeout < self.requester.timeout
+            ):
+                # Do not count timeouts of short request deadlines as backend failures
+                self.breaker.record_failure()
+            self.logger.warning("Solr request failed: %s" % e)
+            if timeout:
+                return ({"error": "Search backend timeout"}, 504)
+            return ({"error": "Search backend not reachable"}, 502)
         self.logger.debug("Sending Solr query %s" % response.url)
-        self.logger.info("Search words: %s", ",".join(tokens))
+
+        if response.status_code >= 500:
+            self.breaker.record_failure()
+        else:
+            self.breaker.record_success()
 
         if response.status_code == 200:
             return json.loads(response.content)
@@ -128,25 +445,98 @@ class SolrClient:
         query = " OR ".join(lines)
         return "q=%s" % query
 
-    def filter_query_str(self, filterword, filter_ids, solr_facets):
+    def edismax_query_str(self, tokens):
+        # https://solr.apache.org/guide/solr/latest/query-guide/edismax-query-parser.html
+        if not self.edismax_pf:
+            # Without phrase boosts the word order is irrelevant, sort tokens
+            # for Solr query result cache hits across word orders
+            tokens = sorted(tokens)
+        query = " ".join(
+            map(lambda t: '"%s"' % t.replace("\\", "\\\\").replace('"', '\\"'), tokens)
+        )
+        params = {"defType": "edismax", "q": query, "qf": self.edismax_qf}
+        if self.edismax_pf:
+            params["pf"] = self.edismax_pf
+        params["mm"] = self.edismax_mm
+        return urlencode(params, quote_via=quote)
+
+    def spatial_query_str(self, q, spatial):
+        """Return query params boosting results near the map center and
+        filtering results outside the map extent.
+
+        Requires a location field configured as `solr_spatial_field`, and a
+        center and extent in WGS 84.
+
+        :param str q: Query params from query_str() or edismax_query_str()
+        :param obj spatial: Map center and extent, or None
+        """
+        if spatial is None or not self.spatial_field:
+            return q
+        if spatial["srid"] != 4326:
+            self.logger.info("Map center and extent ignored, CRS is not EPSG:4326")
+            return q
+        params = []
+        if spatial["center"]:
+            # https://solr.apache.org/guide/solr/latest/query-guide/spatial-search.html#boost-nearest-results
+            (lon, lat) = spatial["center"]
+            params.append(("sfield", self.spatial_field))
+            params.append(("pt", "%s,%s" % (lat, lon)))
+            if self.query_mode == "edismax":
+                params.append(("boost", self.spatial_boost))
+            else:
+                # multiply score of standard query by boost function
+                q = "sq=" + q[len("q=") :]
+                params.append(("q", "{!boost b=%s v=$sq}" % self.spatial_boost))
+        if spatial["extent"]:
+            (xmin, ymin, xmax, ymax) = spatial["extent"]
+            # keep documents without location, e.g. layers
+            params.append(
+                (
+                    "fq",
+                    "%s:[%s,%s TO %s,%s] OR (*:* -%s:*)"
+                    % (self.spatial_field, ymin, xmin, ymax, xmax, self.spatial_field),
+                )
+            )
+        return q + "&" + urlencode(params)
+
+    def search_facets(self, filterword, filter_ids, solr_facets):
+        """Return permitted facets to search in.
+
+        :param str filterword: Filter word from search text
+        :param list(str) filter_ids: Requested facets
+        :param obj solr_facets: Permitted facets
+        """
         if filterword:
-            facets = [self.filterword_to_facet(filterword, solr_facets)]
-        else:
-            # Remove facets without permissions
-            facets = list(filter(lambda f: solr_facets.get(f), filter_ids))
-            if len(facets) != len(filter_ids):
-                self.logger.info("Removed filter ids with missing permissions")
-                self.logger.info("Passed filter ids: %s" % filter_ids)
-                self.logger.info("Permitted filter ids: %s" % facets)
-            # Avoid empty fq
-            if len(facets) == 0:
-                facets = ["_"]
+            return [self.filterword_to_facet(filterword, solr_facets)]
+
+        # Remove facets without permissions
+        facets = list(filter(lambda f: solr_facets.get(f), filter_ids))
+        if len(facets) != len(filter_ids):
+            self.logger.info("Removed filter ids with missing permissions")
+            self.logger.info("Passed filter ids: %s" % filter_ids)
+            self.logger.info("Permitted filter ids: %s" % facets)
+        # Avoid empty fq
+        if len(facets) == 0:
+            facets = ["_"]
+        return facets
+
+    def filter_query_str(self, facets):
         facets = map(lambda f: "facet:%s" % f, facets)
         facet_query = " OR ".join(facets)
-        fq = "fq=tenant:%s" % self.tenant
+        filters = []
+        if self.tenant_filter:
+            filters.append("tenant:%s" % self.tenant)
         if facet_query:
-            fq += " AND (%s)" % facet_query
-        return fq
+            filters.append("(%s)" % facet_query)
+        return "fq=%s" % " AND ".join(filters)
+
+    def facet_params_str(self, facets):
+        # Count only the searched facets instead of every facet value in the index
+        # https://solr.apache.org/guide/solr/latest/query-guide/faceting.html#limiting-facet-with-certain-terms
+        return (
+            "facet=true&facet.field={!terms=%s}facet&facet.mincount=1&facet.limit=%d&facet.sort=count"
+            % (",".join(map(lambda f: f.replace(",", r"\,"), facets)), len(facets))
+        )
 
     def filterword_to_facet(self, filterword, solr_facets):
         for facet, entries in solr_facets.items():
@@ -273,11 +663,47 @@ class SolrClient:
                         )
         return result_counts
 
+    def ungroup_response(self, response, limit):
+        """Convert a response grouped by facet to an ungrouped response.
+
+        Documents are interleaved by their rank within their group, and feature
+        documents are limited to the search limit. Group sizes are returned as
+        facet counts.
+
+        :param obj response: Solr response with results grouped by facet
+        :param int limit: Max number of feature results
+        """
+        groups = response["grouped"]["facet"]["groups"]
+        facet_counts = []
+        doclists = []
+        for group in groups:
+            facet_counts += [group["groupValue"], group["doclist"]["numFound"]]
+            doclists.append(group["doclist"]["docs"])
+
+        docs = []
+        num_features = 0
+        for rank in range(max(map(len, doclists), default=0)):
+            for doclist in doclists:
+                if rank >= len(doclist):
+                    continue
+                doc = doclist[rank]
+                if doc["facet"] not in ["foreground", "background", "dataproduct"]:
+                    if num_features >= limit:
+                        continue
+                    num_features += 1
+                docs.append(doc)
+
+        return {
+            "response": {"docs": docs},
+            "facet_counts": {"facet_fields": {"facet": facet_counts}},
+        }
+
     def check_filterword(self, filterword, entry):
         return not filterword or (entry["filter_word"].lower() == filterword.lower())
 
     def split_words(self, searchtext):
-        return list(filter(None, re.split(self.word_split_re, searchtext)))
+        words = filter(None, re.split(self.word_split_re, searchtext))
+        return self.token_pipeline.process(words)[0]
 
     def join_word_parts(self, part, tokens):
         parts = map(lambda t: part.format(t), tokens)
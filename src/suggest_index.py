@@ -0,0 +1,188 @@
+import threading
+import time
+from array import array
+
+# Max number of suggestions per request
+MAX_LIMIT = 100
+
+
+class SuggestIndex:
+    """SuggestIndex class
+
+    In-memory prefix index of the display strings of search results, for
+    autocomplete suggestions without a backend query.
+
+    For each facet, the index keeps sorted arrays of (entry, offset) pairs,
+    one for each word start of a display string, ordered by the case folded
+    display string from the offset on. A prefix lookup is a binary search
+    followed by a scan of the matching word starts. The index is
+    rebuilt in a background thread once it is older than the refresh
+    interval, while the previous index keeps answering requests.
+    """
+
+    def __init__(self, resources, load_entries, config, logger):
+        """Constructor
+
+        :param SearchResources resources: Search resources for permissions
+        :param func load_entries: Function returning (display, facet) tuples
+        :param RuntimeConfig config: Config handler
+        :param Logger logger: Application logger
+        """
+        self.resources = resources
+        self.load_entries = load_entries
+        self.logger = logger
+
+        self.refresh_interval = config.get("suggest_refresh_interval", 3600)
+        self.default_limit = config.get("suggest_limit", 10)
+
+        # Tuple of dict with (entries, offsets) arrays per facet, display strings
+        # and case folded display strings
+        self.index = None
+        # Time of next refresh
+        self.next_refresh = 0
+        self.refreshing = False
+        self.lock = threading.Lock()
+
+    def suggest(self, identity, searchtext, searchfilter, limit):
+        """Return display strings starting with searchtext at a word start.
+
+        Returns None if the index is not yet available.
+
+        :param obj identity: User identity
+        :param str searchtext: Prefix to complete
+        :param list(str) searchfilter: Facets to search in, all if empty
+        :param int limit: Max number of suggestions, at most MAX_LIMIT
+        """
+        self.refresh_if_stale()
+        if self.index is None:
+            return None
+        # Current index, may be replaced by a refresh
+        (index, displays, folded) = self.index
+
+        prefix = self.fold(searchtext)
+        if not prefix:
+            return []
+        limit = min(limit or self.default_limit, MAX_LIMIT)
+
+        facets = self.resources.solr_facets(identity).keys()
+        if searchfilter:
+            facets = [facet for facet in searchfilter if facet in facets]
+
+        matches = []
+        for facet in facets:
+            if facet not in index:
+                continue
+            (entries, offsets) = index[facet]
+            # first word start not before the prefix
+            pos = 0
+            end = len(entries)
+            while pos < end:
+                mid = (pos + end) // 2
+                offset = offsets[mid]
+                if folded[entries[mid]][offset : offset + len(prefix)] < prefix:
+                    pos = mid + 1
+                else:
+                    end = mid
+            found = set()
+            while (
+                pos < len(entries)
+                and len(found) < limit
+                and folded[entries[pos]].startswith(prefix, offsets[pos])
+            ):
+                if entries[pos] not in found:
+                    found.add(entries[pos])
+                    key = folded[entries[pos]][offsets[pos] :]
+                    matches.append((key, entries[pos], facet))
+                pos += 1
+
+        suggestions = []
+        seen = set()
+        for key, entry, facet in sorted(matches):
+            # skip same display strings of other features
+            if (displays[entry], facet) in seen:
+                continue
+            seen.add((displays[entry], facet))
+            suggestions.append({"display": displays[entry], "dataproduct_id": facet})
+            if len(suggestions) >= limit:
+                break
+        return suggestions
+
+    def fold(self, text):
+        """Return case folded text with normalized whitespace.
+
+        :param str text: Text
+        """
+        return " ".join(text.casefold().split())
+
+    def warmup(self):
+        """Build the index if it is not yet available."""
+        if self.index is not None:
+            return
+        with self.lock:
+            if self.refreshing:
+                return
+            self.refreshing = True
+        self.refresh()
+
+    def refresh_if_stale(self):
+        """Start a background refresh if the index is missing or outdated."""
+        if time.time() < self.next_refresh:
+            return
+        with self.lock:
+            if self.refreshing:
+                return
+            self.refreshing = True
+        threading.Thread(target=self.refresh, daemon=True).start()
+
+    def refresh(self):
+        """Rebuild the index from the search backend.
+
+        Callers set refreshing under the lock, to avoid concurrent rebuilds.
+        """
+        start = time.time()
+        try:
+            self.index = self.build(self.load_entries())
+            self.next_refresh = time.time() + self.refresh_interval
+            self.logger.info(
+                "Built suggest index with %d entries in %.1fs"
+                % (len(self.index[1]), time.time() - start)
+            )
+        except Exception as e:
+            self.logger.error("Could not build suggest index: %s" % e)
+            self.next_refresh = time.time() + min(60, self.refresh_interval)
+        finally:
+            self.refreshing = False
+
+    def build(self, entries):
+        """Return index and display strings for (display, facet) tuples.
+
+        :param iterable entries: Tuples (display, facet)
+        """
+        facet_positions = {}
+        displays = []
+        folded = []
+        for display, facet in entries:
+            if not display or facet in ["foreground", "background"]:
+                # Layer results are not suggested
+                continue
+            entry = len(displays)
+            displays.append(display)
+            words = self.fold(display)
+            folded.append(words)
+            positions = facet_positions.setdefault(facet, [])
+            # Display string and each following word start
+            pos = 0
+            while pos >= 0:
+                positions.append((entry, pos))
+                pos = words.find(" ", pos)
+                if pos >= 0:
+                    pos += 1
+
+        index = {}
+        for facet, positions in facet_positions.items():
+            positions.sort(key=lambda position: folded[position[0]][position[1] :])
+            index[facet] = (
+                array("I", (entry for entry, offset in positions)),
+                array("I", (offset for entry, offset in positions)),
+            )
+        return (index, displays, folded)
@@ -0,0 +1,115 @@
+import os
+import threading
+import time
+
+from qwc_services_core.tenant_handler import TenantHandler
+
+# Delay in seconds before closing an evicted handler, for requests in flight
+CLOSE_DELAY = 60
+
+
+class EvictingTenantHandler(TenantHandler):
+    """EvictingTenantHandler class
+
+    TenantHandler which limits the number of cached tenant handlers per
+    handler name, evicting the least recently used handler, and evicts
+    handlers which were not used within the idle timeout. Evicted handlers
+    and handlers replaced after a config change are closed after a delay.
+    """
+
+    def __init__(self, logger):
+        """Constructor
+
+        :param Logger logger: Application logger
+        """
+        TenantHandler.__init__(self, logger)
+        # Max number of handlers per handler name, 0 for no limit
+        self.max_handlers = int(os.environ.get("TENANT_HANDLER_MAX", 0))
+        # Idle time in seconds before a handler is evicted, 0 to disable
+        self.idle_timeout = float(os.environ.get("TENANT_HANDLER_IDLE_TIMEOUT", 0))
+        # Time of next check for idle handlers
+        self.next_sweep = time.monotonic() + self.idle_timeout
+        self.lock = threading.RLock()
+
+    def handler(self, service_name, handler_name, tenant):
+        """Get service handler for tenant.
+
+        Return None if not yet registered or if config files have changed.
+        Handlers of tenants without config files are kept until evicted.
+
+        :param str service_name: Service name
+                                 (used for detecting config changes)
+        :param str handler_name: Handler name
+        :param str tenant: Tenant ID
+        """
+        with self.lock:
+            self.evict_idle()
+            entry = self.handler_cache.get(handler_name, {}).get(tenant)
+            if entry is None:
+                return None
+            # NOTE: TenantHandler.handler() also drops handlers if there are
+            #       no config files, which would rebuild them on every request
+            last_update = self.last_config_update(service_name, tenant)
+            if last_update and last_update >= entry["last_update"]:
+                # replaced after config change
+                del self.handler_cache[handler_name][tenant]
+                self.close_handler(handler_name, tenant, entry["handler"])
+                return None
+            entry["last_access"] = time.monotonic()
+            return entry["handler"]
+
+    def register_handler(self, handler_name, tenant, handler):
+        """Register service handler for tenant.
+
+        :param str handler_name: Handler name
+        :param str tenant: Tenant ID
+        :param obj handler: Service handler
+        """
+        with self.lock:
+            handlers = self.handler_cache.get(handler_name, {})
+            if self.max_handlers > 0:
+                while len(handlers) >= self.max_handlers:
+                    # evict least recently used handler
+                    lru_tenant = min(
+                        handlers, key=lambda t: handlers[t].get("last_access", 0)
+                    )
+                    self.evict(handler_name, lru_tenant)
+            TenantHandler.register_handler(self, handler_name, tenant, handler)
+            self.handler_cache[handler_name][tenant]["last_access"] = time.monotonic()
+            return handler
+
+    def evict_idle(self):
+        """Evict handlers not used within the idle timeout."""
+        if self.idle_timeout <= 0:
+            return
+        now = time.monotonic()
+        if now < self.next_sweep:
+            return
+        self.next_sweep = now + min(self.idle_timeout, 60)
+        for handler_name, handlers in list(self.handler_cache.items()):
+            for tenant, entry in list(handlers.items()):
+                if now - entry.get("last_access", now) > self.idle_timeout:
+                    self.evict(handler_name, tenant)
+
+    def evict(self, handler_name, tenant):
+        """Remove handler from cache and close it.
+
+        :param str handler_name: Handler name
+        :param str tenant: Tenant ID
+        """
+        entry = self.handler_cache[handler_name].pop(tenant)
+        self.logger.info("Evicting %s handler of tenant %s" % (handler_name, tenant))
+        self.close_handler(handler_name, tenant, entry["handler"])
+
+    def close_handler(self, handler_name, tenant, handler):
+        """Close handler after a delay, if it supports closing.
+
+        :param str handler_name: Handler name
+        :param str tenant: Tenant ID
+        :param obj handler: Service handler
+        """
+        if not hasattr(handler, "close"):
+            return
+        timer = threading.Timer(CLOSE_DELAY, handler.close)
+        timer.daemon = True
+        timer.start()
@@ -2,6 +2,20 @@ import unittest
 
 from tests.trgm_search_tests import *
 from tests.solr_search_tests import *
+from tests.solr_resilience_tests import *
+from tests.search_metrics_tests import *
+from tests.search_batch_tests import *
+from tests.search_warmup_tests import *
+from tests.search_tokens_tests import *
+from tests.admission_control_tests import *
+from tests.suggest_index_tests import *
+from tests.db_replicas_tests import *
+from tests.search_geom_tests import *
+from tests.thread_safety_tests import *
+from tests.tenant_handlers_tests import *
+from tests.query_log_tests import *
+from tests.search_deadline_tests import *
+from tests.search_cursor_tests import *
 
 
 if __name__ == "__main__":
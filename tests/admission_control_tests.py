@@ -0,0 +1,131 @@
+import threading
+import unittest
+
+import admission_control
+from admission_control import AdmissionControl, AdmissionRejected, ConcurrencyLimiter
+from search_metrics import SearchMetrics
+
+import server
+
+
+class AdmissionControlTestCase(unittest.TestCase):
+    """Test case for admission control"""
+
+    def test_limiter(self):
+        limiter = ConcurrencyLimiter(1, 1, 0.05, 0)
+        self.assertTrue(limiter.acquire())
+        # queued request times out
+        self.assertFalse(limiter.acquire())
+        # queued request is admitted once the slot is released
+        timer = threading.Timer(0.01, limiter.release, [0.01])
+        timer.start()
+        self.assertTrue(limiter.acquire())
+        timer.join()
+        limiter.release(0.01)
+        self.assertEqual(0, limiter.active)
+
+    def test_adaptive_limit(self):
+        limiter = ConcurrencyLimiter(10, 0, 0, 0.1)
+        for i in range(10):
+            limiter.acquire()
+            limiter.release(0.5)
+        self.assertLess(limiter.current_limit(), 10)
+        self.assertEqual(1, limiter.retry_after())
+        for i in range(500):
+            limiter.acquire()
+            limiter.release(0.01)
+        self.assertEqual(10, limiter.current_limit())
+
+    def test_admission(self):
+        metrics = SearchMetrics("test_tenant", "pg")
+        config = {
+            "admission_tenant_max_concurrent": 1,
+            "admission_backend_max_concurrent": 2,
+            "admission_queue_size": 0,
+        }
+        admission = AdmissionControl(
+            config, "test_tenant", "test_backend", metrics, server.app.logger
+        )
+        other = AdmissionControl(
+            config, "other_tenant", "test_backend", metrics, server.app.logger
+        )
+        self.assertIs(admission.backend_limiter, other.backend_limiter)
+        self.assertIsNot(admission.tenant_limiter, other.tenant_limiter)
+
+        with admission.admit():
+            with self.assertRaises(AdmissionRejected) as cm:
+                with admission.admit():
+                    pass
+            self.assertEqual(429, cm.exception.status)
+            data, status, headers = cm.exception.response()
+            self.assertEqual({"Retry-After": "1"}, headers)
+            with other.admit():
+                # backend limit reached
+                third = AdmissionControl(
+                    config, "third_tenant", "test_backend", metrics, server.app.logger
+                )
+                with self.assertRaises(AdmissionRejected) as cm:
+                    with third.admit():
+                        pass
+                self.assertEqual(503, cm.exception.status)
+                # tenant slot of rejected request is released
+                self.assertEqual(0, third.tenant_limiter.active)
+        self.assertEqual(0, admission.backend_limiter.active)
+        self.assertEqual(1, metrics.events["admission_rejected_tenant"])
+        self.assertEqual(1, metrics.events["admission_rejected_backend"])
+
+    def test_shared_tenant_limiter(self):
+        metrics = SearchMetrics("shared_tenant", "pg")
+        config = {"admission_tenant_max_concurrent": 1, "admission_queue_size": 0}
+        # e.g. search and geometry handlers of the same tenant
+        search = AdmissionControl(
+            config, "shared_tenant", "search_backend", metrics, server.app.logger
+        )
+        geom = AdmissionControl(
+            config, "shared_tenant", "geom_backend", metrics, server.app.logger
+        )
+        self.assertIs(search.tenant_limiter, geom.tenant_limiter)
+        with search.admit():
+            with self.assertRaises(AdmissionRejected) as cm:
+                with geom.admit():
+                    pass
+            self.assertEqual(429, cm.exception.status)
+
+        # changed tenant config replaces the limiter
+        config = {"admission_tenant_max_concurrent": 2}
+        changed = AdmissionControl(
+            config, "shared_tenant", "search_backend", metrics, server.app.logger
+        )
+        self.assertIsNot(search.tenant_limiter, changed.tenant_limiter)
+        self.assertEqual(2, changed.tenant_limiter.current_limit())
+
+    def test_conflicting_backend_config(self):
+        metrics = SearchMetrics("test_tenant", "pg")
+        config = {
+            "admission_backend_max_concurrent": 4,
+            "admission_queue_size": 2,
+            "admission_queue_timeout": 1,
+        }
+        first = AdmissionControl(
+            config, "first_tenant", "conflict_backend", metrics, server.app.logger
+        )
+        config = {
+            "admission_backend_max_concurrent": 8,
+            "admission_queue_size": 1,
+            "admission_queue_timeout": 2,
+            "admission_target_latency": 0.5,
+        }
+        second = AdmissionControl(
+            config, "second_tenant", "conflict_backend", metrics, server.app.logger
+        )
+        # strictest settings apply to both tenants
+        limiter = first.backend_limiter
+        self.assertIs(limiter, second.backend_limiter)
+        self.assertEqual((4, 1, 1, 0.5), limiter.settings())
+
+        # settings of a closed handler no longer apply
+        second.close()
+        self.assertEqual((4, 2, 1, 0.0), limiter.settings())
+        self.assertEqual(4, limiter.current_limit())
+        first.close()
+        self.assertNotIn("conflict_backend", admission_control.backend_limiters)
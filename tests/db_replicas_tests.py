@@ -0,0 +1,90 @@
+import logging
+import unittest
+
+from sqlalchemy.exc import OperationalError, TimeoutError
+
+from db_replicas import ReplicaRouter
+from search_metrics import SearchMetrics
+
+
+class FakeResult:
+    def __init__(self, value):
+        self.value = value
+
+    def scalar(self):
+        return self.value
+
+
+class FakeConnection:
+    def __init__(self, url, lag):
+        self.url = url
+        self.lag = lag
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        pass
+
+    def execute(self, sql):
+        return FakeResult(self.lag)
+
+
+class FakeEngine:
+    def __init__(self, url, lag):
+        self.url = url
+        self.lag = lag
+
+    def connect(self):
+        if self.lag is None:
+            raise OperationalError("connect", {}, Exception("connection refused"))
+        if self.lag == "timeout":
+            raise TimeoutError("QueuePool limit reached")
+        return FakeConnection(self.url, self.lag)
+
+
+class FakeDatabaseEngine:
+    def __init__(self, lags):
+        self.engines = {url: FakeEngine(url, lag) for url, lag in lags.items()}
+
+    def db_engine(self, url):
+        return self.engines[url]
+
+
+class ReplicaRouterTestCase(unittest.TestCase):
+    """Test case for read replica routing"""
+
+    def test_route(self):
+        db_engine = FakeDatabaseEngine(
+            {"primary": 0, "replica1": 1, "replica2": 1, "lagging": 120}
+        )
+        config = {"db_replicas": {"primary": ["replica1", "replica2", "lagging"]}}
+        router = ReplicaRouter(
+            db_engine,
+            config,
+            SearchMetrics("test_tenant", "pg"),
+            logging.getLogger(),
+        )
+        # no replica is used before the first health check
+        router.next_check = float("inf")
+        self.assertEqual("primary", router.route("primary"))
+        self.assertEqual("other", router.route("other"))
+
+        router.check()
+        self.assertEqual(["primary", "replica1", "replica2"], router.urls("primary"))
+        routed = set(router.route("primary") for i in range(6))
+        self.assertEqual({"replica1", "replica2"}, routed)
+
+        # fall back to the primary if connecting to the replicas fails
+        db_engine.engines["replica1"].lag = None
+        db_engine.engines["replica2"].lag = None
+        self.assertEqual("primary", router.connect("primary").url)
+        self.assertEqual("primary", router.connect("primary").url)
+        self.assertEqual(["primary"], router.urls("primary"))
+
+        # fall back to the primary if the replica pool is exhausted
+        db_engine.engines["replica1"].lag = 1
+        router.check()
+        db_engine.engines["replica1"].lag = "timeout"
+        self.assertEqual("primary", router.connect("primary").url)
+        self.assertEqual(["primary"], router.urls("primary"))
@@ -0,0 +1,76 @@
+import json
+import os
+import tempfile
+import unittest
+from unittest.mock import patch
+
+from query_log import QueryLog
+
+
+class QueryLogTestCase(unittest.TestCase):
+    """Test case for the query log"""
+
+    def setUp(self):
+        (fd, self.path) = tempfile.mkstemp(suffix=".jsonl")
+        os.close(fd)
+        self.addCleanup(os.remove, self.path)
+
+    def query_log(self, **env):
+        with patch.dict(os.environ, {"QUERY_LOG_FILE": self.path, **env}):
+            return QueryLog()
+
+    def entries(self):
+        with open(self.path, encoding="utf-8") as fh:
+            return [json.loads(line) for line in fh]
+
+    def test_anonymized(self):
+        query_log = self.query_log()
+        fts_params = {
+            "searchtext": "Hans Muster 12",
+            "filter": "test_dataset",
+            "limit": 10,
+            "cursor": "eyJmIjoiYSJ9",
+            "center": "7.44,46.95",
+            "extent": None,
+            "crs": "EPSG:4326",
+        }
+        query_log.record("fts", "default", fts_params, 200, 0.1)
+        query_log.record("fts", "default", fts_params, 200, 0.1)
+        geom_params = {
+            "dataset": "test_dataset",
+            "filter": '[["name", "=", "Hans Muster"]]',
+            "bbox": "2600000,1200000,2601000,1201000",
+            "crs": None,
+            "limit": None,
+        }
+        query_log.record("geom", "default", geom_params, 200, 0.1)
+
+        (fts, fts2, geom) = self.entries()
+        searchtext = fts["params"]["searchtext"]
+        self.assertEqual(3, len(searchtext.split()))
+        self.assertNotIn("Muster", searchtext)
+        # same words have the same hashes
+        self.assertEqual(searchtext, fts2["params"]["searchtext"])
+        self.assertEqual("test_dataset", fts["params"]["filter"])
+        self.assertEqual(10, fts["params"]["limit"])
+        for key in ["cursor", "center", "extent"]:
+            self.assertNotIn(key, fts["params"])
+
+        filterexpr = json.loads(geom["params"]["filter"])
+        self.assertEqual(["name", "="], filterexpr[0][:2])
+        self.assertNotIn("Muster", filterexpr[0][2])
+        self.assertNotIn("bbox", geom["params"])
+        self.assertEqual("test_dataset", geom["params"]["dataset"])
+
+    def test_raw(self):
+        query_log = self.query_log(QUERY_LOG_RAW="1")
+        params = {"searchtext": "Hans Muster 12", "center": "7.44,46.95"}
+        query_log.record("fts", "default", params, 200, 0.1)
+        query_log = self.query_log(QUERY_LOG_RAW="1", QUERY_LOG_MASK_DIGITS="0")
+        query_log.record("fts", "default", params, 200, 0.1)
+
+        (masked, raw) = self.entries()
+        self.assertEqual(
+            {"searchtext": "Hans Muster 00", "center": "7.44,46.95"}, masked["params"]
+        )
+        self.assertEqual(params, raw["params"])
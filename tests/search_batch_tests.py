@@ -0,0 +1,145 @@
+import threading
+import time
+import unittest
+from contextlib import contextmanager
+from unittest.mock import patch
+
+from flask import Response
+from flask.testing import FlaskClient
+
+from search_batch import SearchBatch
+
+import server
+
+
+class FakeResources:
+    batch_max_searches = 10
+    batch_concurrency = 2
+
+    def __init__(self):
+        self.calls = 0
+
+    def permitted(self, identity):
+        self.calls += 1
+        return ({"test_dataset": []}, [])
+
+
+class FakeConnection:
+    def __init__(self):
+        self.rollbacks = 0
+
+    def rollback(self):
+        self.rollbacks += 1
+
+
+class FakeMetrics:
+    def __init__(self):
+        self.requests = []
+
+    def request(self, endpoint, status, num_results=None):
+        self.requests.append((endpoint, status, num_results))
+
+
+class FakeHandler:
+    """Search handler returning the search text after a delay"""
+
+    def __init__(self):
+        self.resources = FakeResources()
+        self.metrics = FakeMetrics()
+        self.connections = []
+        self.lock = threading.Lock()
+
+    @contextmanager
+    def connect(self):
+        conn = FakeConnection()
+        with self.lock:
+            self.connections.append(conn)
+        yield conn
+
+    def search(
+        self,
+        identity,
+        searchtext,
+        filter,
+        limit,
+        cursor=None,
+        permissions=None,
+        conn=None,
+    ):
+        if searchtext == "error":
+            return ({"error": "Search backend timeout"}, 504)
+        if searchtext == "exception":
+            raise Exception("DB error")
+        # Finish later searches first
+        time.sleep(0.01 / (len(searchtext) + 1))
+        return {"results": [searchtext], "result_counts": [permissions, conn]}
+
+
+class JsonHandler(FakeHandler):
+    """Search handler with JSON serializable results"""
+
+    def search(self, *args, **kwargs):
+        result = FakeHandler.search(self, *args, **kwargs)
+        if type(result) is dict:
+            result["result_counts"] = []
+        return result
+
+
+class SearchBatchTestCase(unittest.TestCase):
+    """Test case for batch searches"""
+
+    def run_batch(self, handler, searchtexts, concurrency=4):
+        searches = [
+            {"searchtext": searchtext, "filter": [], "limit": None}
+            for searchtext in searchtexts
+        ]
+        batch = SearchBatch(handler, concurrency, server.app.logger)
+        return list(batch.run(None, searches))
+
+    def test_order(self):
+        handler = FakeHandler()
+        searchtexts = ["a" * i for i in range(20)]
+        results = self.run_batch(handler, searchtexts)
+        self.assertEqual(list(range(20)), [r["index"] for r in results])
+        self.assertEqual(searchtexts, [r["results"][0] for r in results])
+        # Permissions resolved once, one connection per worker
+        self.assertEqual(1, handler.resources.calls)
+        self.assertEqual(4, len(handler.connections))
+        for result in results:
+            self.assertIsNotNone(result["result_counts"][0])
+            self.assertIn(result["result_counts"][1], handler.connections)
+
+    def test_errors(self):
+        handler = FakeHandler()
+        results = self.run_batch(handler, ["a", "error", "exception", "b"], 1)
+        self.assertEqual([200, 504, 500, 200], [r["status"] for r in results])
+        self.assertEqual("Search backend timeout", results[1]["error"])
+        # Connection reset after failed search
+        self.assertEqual(1, handler.connections[0].rollbacks)
+
+    def test_endpoint(self):
+        handler = JsonHandler()
+        client = FlaskClient(server.app, Response)
+        with patch.object(server, "search_handler", lambda: handler):
+            response = client.post(
+                "/fts/batch/", json={"searches": ["a", "error", "b"], "limit": 5}
+            )
+            self.assertEqual(200, response.status_code)
+            lines = response.data.decode().splitlines()
+            self.assertEqual(3, len(lines))
+            # metrics recorded per finished search
+            self.assertEqual(
+                [("batch", 200, 1), ("batch", 504, None), ("batch", 200, 1)],
+                handler.metrics.requests,
+            )
+
+            for body in [
+                {"searches": ["a"], "filter": ["a"]},
+                {"searches": ["a"], "limit": {"max": 5}},
+                {"searches": [{"searchtext": "a", "filter": 1}]},
+                {"searches": [{"searchtext": "a", "limit": [5]}]},
+                {"searches": [{"searchtext": "a", "cursor": 5}]},
+            ]:
+                response = client.post("/fts/batch/", json=body)
+                self.assertEqual(400, response.status_code)
+        self.assertEqual(3, len(handler.metrics.requests))
@@ -0,0 +1,51 @@
+import base64
+import json
+import unittest
+
+from pg_search_service import PgClient
+from search_cursor import decode_cursor, encode_cursor
+
+import server
+
+
+def raw_cursor(data):
+    """Return token of arbitrary cursor JSON"""
+    return base64.urlsafe_b64encode(json.dumps(data).encode()).decode()
+
+
+class SearchCursorTestCase(unittest.TestCase):
+    """Test case for continuation tokens"""
+
+    def test_roundtrip(self):
+        token = encode_cursor("test_dataset", [0.5, 12])
+        self.assertEqual(("test_dataset", [0.5, 12]), decode_cursor(token))
+        token = encode_cursor("test_dataset", None)
+        self.assertEqual(("test_dataset", None), decode_cursor(token))
+
+    def test_malformed(self):
+        tokens = [
+            "not base64!",
+            base64.urlsafe_b64encode(b"no json").decode(),
+            raw_cursor(["test_dataset", [1, 2]]),
+            raw_cursor({"f": "test_dataset"}),
+            raw_cursor({"f": ["test_dataset"], "p": [1, 2]}),
+            raw_cursor({"f": None, "p": [1, 2]}),
+            raw_cursor({"f": "test_dataset", "p": 1}),
+            raw_cursor({"f": "test_dataset", "p": "*"}),
+            raw_cursor({"f": "test_dataset", "p": [1]}),
+            raw_cursor({"f": "test_dataset", "p": {"a": 1}}),
+        ]
+        for token in tokens:
+            with self.assertRaises(ValueError):
+                decode_cursor(token)
+
+    def test_invalid_cursor_response(self):
+        search = PgClient("default", server.app.logger)
+        for cursor in [
+            raw_cursor({"f": "test_dataset", "p": 1}),
+            raw_cursor({"f": ["test_dataset"], "p": [1, 2]}),
+        ]:
+            self.assertEqual(
+                ({"error": "Invalid cursor"}, 400),
+                search.search(None, "test", [], 10, cursor),
+            )
@@ -0,0 +1,36 @@
+import unittest
+
+from search_deadline import MAX_CLIENT_TIMEOUT, create_deadline
+
+import server
+
+
+class CreateDeadlineTestCase(unittest.TestCase):
+    """Test case for request deadlines"""
+
+    def deadline(self, header, default_timeout=0):
+        headers = {"X-Request-Timeout": header}
+        with server.app.test_request_context("/fts/", headers=headers):
+            return create_deadline(default_timeout)
+
+    def test_client_timeout(self):
+        self.assertEqual(2, self.deadline("2").timeout)
+        # client timeout can only shorten the configured timeout
+        self.assertEqual(1, self.deadline("2", 1).timeout)
+        self.assertEqual(0.5, self.deadline("0.5", 1).timeout)
+
+        for header in ["0", "-1", "abc"]:
+            self.assertIsNone(self.deadline(header))
+            self.assertEqual(1, self.deadline(header, 1).timeout)
+
+    def test_invalid_client_timeout(self):
+        # non-finite values are ignored
+        for header in ["inf", "-inf", "nan"]:
+            self.assertIsNone(self.deadline(header))
+            self.assertEqual(1, self.deadline(header, 1).timeout)
+
+        # huge values are limited
+        for header in ["1e12", "1e308"]:
+            deadline = self.deadline(header)
+            self.assertEqual(MAX_CLIENT_TIMEOUT, deadline.timeout)
+            self.assertLess(int(deadline.remaining() * 1000), 2**31 - 1)
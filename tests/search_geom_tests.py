@@ -0,0 +1,175 @@
+import logging
+import os
+import unittest
+from unittest.mock import patch
+
+from flask import Response
+from flask.testing import FlaskClient
+from sqlalchemy import create_engine
+
+from search_geom_service import SearchGeomService
+
+import server
+
+
+class FakeConnection:
+    """Connection recording executed queries"""
+
+    def __init__(self):
+        self.queries = []
+        self.dialect = type("Dialect", (), {"name": "sqlite"})
+        self.engine = None
+
+    def begin(self):
+        return self
+
+    def rollback(self):
+        pass
+
+    def close(self):
+        pass
+
+    def execute(self, sql, params=None):
+        self.queries.append((sql.text, params))
+        return self
+
+    def mappings(self):
+        return []
+
+
+class PostgresStandIn:
+    """SQLite connection posing as Postgres connection
+
+    Records statement timeouts instead of executing them. Geometry queries
+    fail, as PostGIS functions are missing.
+    """
+
+    def __init__(self, conn):
+        self.conn = conn
+        self.dialect = type("Dialect", (), {"name": "postgresql"})
+        self.engine = self
+        self.timeouts = []
+
+    def begin(self):
+        return self.conn.begin()
+
+    def close(self):
+        self.conn.close()
+
+    def execute(self, sql, params=None):
+        if sql.text.startswith("SET LOCAL statement_timeout"):
+            self.timeouts.append(params["timeout"])
+            return None
+        return self.conn.execute(sql, params)
+
+
+class SearchGeomTestCase(unittest.TestCase):
+    """Test case for geometry queries"""
+
+    def test_parse_bbox(self):
+        service = SearchGeomService("default", logging.getLogger())
+        (sql, params) = service._parse_bbox("2600000,1200000,2601000,1201000", None)
+        self.assertTrue(sql.startswith("ST_MakeEnvelope("))
+        self.assertEqual(2600000, params["bbox_xmin"])
+        self.assertEqual(1201000, params["bbox_ymax"])
+
+        (sql, params) = service._parse_bbox("7.4,46.9,7.5,47", "EPSG:4326")
+        self.assertTrue(sql.startswith("ST_Transform("))
+        self.assertEqual(4326, params["bbox_srid"])
+
+        for bbox, crs in [("1,2,3", None), ("a,2,3,4", None), ("3,2,1,4", None)]:
+            self.assertEqual((None, "Invalid bbox"), service._parse_bbox(bbox, crs))
+        self.assertEqual((None, "Invalid crs"), service._parse_bbox("1,2,3,4", "2056"))
+
+    def test_server_timing(self):
+        os.environ["SERVER_TIMING"] = "all"
+        server.tenant_handler.handler_cache = {}
+        try:
+            handler = server.search_geom_handler("default")
+            client = FlaskClient(server.app, Response)
+
+            handler._index = lambda *args: {
+                "type": "FeatureCollection",
+                "features": [],
+            }
+            response = client.get('/geom/test_dataset/?filter=[["id","=",1]]')
+            self.assertEqual(200, response.status_code)
+            self.assertIn("perm;dur=", response.headers["Server-Timing"])
+
+            # Error responses of invalid requests also include the header
+            response = client.get('/geom/test_dataset/?filter=[["id","~",1]]')
+            self.assertEqual(400, response.status_code)
+            self.assertIn("Invalid filter expression", response.json["message"])
+            self.assertIn("perm;dur=", response.headers["Server-Timing"])
+        finally:
+            del os.environ["SERVER_TIMING"]
+            server.tenant_handler.handler_cache = {}
+
+    def test_geom_query(self):
+        service = SearchGeomService("default", logging.getLogger())
+        conn = FakeConnection()
+        service.replicas.connect = lambda db_url: conn
+        filterexpr = service._parse_filter('[["id", "=", 1]]')
+        bbox = service._parse_bbox("2600000,1200000,2601000,1201000", None)
+        cfg = {"table_name": "public.test", "geometry_column": "geom"}
+
+        service._index(filterexpr[:2], cfg, "id", bbox, 10)
+        (sql, params) = conn.queries[-1]
+        self.assertIn(
+            '"geom" && ST_MakeEnvelope(:bbox_xmin, :bbox_ymin, :bbox_xmax, :bbox_ymax, '
+            "Find_SRID(COALESCE(:geom_schema, current_schema()), :geom_table, :geom_column))",
+            sql,
+        )
+        self.assertIn('WHERE ("id" = :v0) AND "geom" &&', sql)
+        self.assertTrue(sql.strip().endswith("LIMIT :limit"))
+        self.assertEqual(
+            ("public", "test", "geom", 10),
+            (
+                params["geom_schema"],
+                params["geom_table"],
+                params["geom_column"],
+                params["limit"],
+            ),
+        )
+
+        # Configured SRID, for views without a registered SRID
+        bbox = service._parse_bbox("7.4,46.9,7.5,47", "EPSG:4326")
+        cfg = {"table_name": "search_v", "srid": 2056}
+        service._index(filterexpr[:2], cfg, "id", bbox)
+        (sql, params) = conn.queries[-1]
+        self.assertIn(
+            '"geom" && ST_Transform(ST_MakeEnvelope(:bbox_xmin, :bbox_ymin, :bbox_xmax, :bbox_ymax, :bbox_srid), :geom_srid)',
+            sql,
+        )
+        self.assertNotIn("LIMIT", sql)
+        self.assertEqual((4326, 2056), (params["bbox_srid"], params["geom_srid"]))
+
+    def test_invalid_limit(self):
+        client = FlaskClient(server.app, Response)
+        for limit in ["0", "-1", "abc"]:
+            response = client.get("/geom/test_dataset/?limit=%s" % limit)
+            self.assertEqual(400, response.status_code)
+            self.assertEqual("Invalid limit", response.json["message"])
+
+    def test_deadline_exceeded(self):
+        server.tenant_handler.handler_cache = {}
+        engine = create_engine("sqlite://")
+        self.addCleanup(engine.dispose)
+        try:
+            handler = server.search_geom_handler("default")
+            conn = PostgresStandIn(engine.connect())
+            handler.replicas.connect = lambda db_url: conn
+            client = FlaskClient(server.app, Response)
+
+            with patch("search_geom_service.is_query_canceled", lambda e: True):
+                response = client.get(
+                    '/geom/test_dataset/?filter=[["id","=",1]]',
+                    headers={"X-Request-Timeout": "2"},
+                )
+            self.assertEqual(504, response.status_code)
+            self.assertEqual("Search deadline exceeded", response.json["message"])
+            # statement timeout of the remaining request time in ms
+            self.assertEqual(1, len(conn.timeouts))
+            self.assertTrue(1000 < conn.timeouts[0] <= 2000)
+        finally:
+            server.tenant_handler.handler_cache = {}
@@ -0,0 +1,52 @@
+import unittest
+
+from flask import Response
+from flask.testing import FlaskClient
+
+from search_metrics import RequestTimer, SearchMetrics
+
+import server
+
+
+class SearchMetricsTestCase(unittest.TestCase):
+    """Test case for search metrics"""
+
+    def setUp(self):
+        server.app.testing = True
+        self.app = FlaskClient(server.app, Response)
+
+    def test_metrics_endpoint(self):
+        metrics = SearchMetrics("test_tenant", "solr")
+        with metrics.phase("solr"):
+            pass
+        metrics.inc("hedged")
+        metrics.request("fts", 200, 3)
+
+        response = self.app.get("/metrics")
+        self.assertEqual(200, response.status_code)
+        data = response.data.decode()
+        self.assertIn(
+            'search_phase_duration_seconds_count{backend="solr",phase="solr",tenant="test_tenant"} 1.0',
+            data,
+        )
+        self.assertIn(
+            'search_backend_events_total{backend="solr",event="hedged",tenant="test_tenant"} 1.0',
+            data,
+        )
+        self.assertIn(
+            'search_requests_total{backend="solr",endpoint="fts",status="200",tenant="test_tenant"} 1.0',
+            data,
+        )
+
+    def test_request_timer(self):
+        metrics = SearchMetrics("test_tenant", "pg")
+        with server.app.test_request_context():
+            server.g.request_timer = RequestTimer()
+            with metrics.phase("perm"):
+                pass
+            with metrics.phase("db_feature"):
+                pass
+            with metrics.phase("perm"):
+                pass
+            header = server.g.request_timer.header()
+        self.assertRegex(header, r"^perm;dur=\d+\.\d\d, db_feature;dur=\d+\.\d\d$")
@@ -0,0 +1,47 @@
+import unittest
+
+from search_metrics import SearchMetrics
+from search_tokens import TokenPipeline
+
+import server
+
+
+class SearchTokensTestCase(unittest.TestCase):
+    """Test case for search token normalization"""
+
+    def pipeline(self, config):
+        metrics = SearchMetrics("test_tenant", "pg")
+        return TokenPipeline(config, metrics, server.app.logger), metrics
+
+    def test_defaults(self):
+        pipeline, metrics = self.pipeline({})
+        tokens, dropped = pipeline.process(["Bern", "bern", "ＢＥＲＮ", "Zürich"])
+        self.assertEqual(["Bern", "Zürich"], tokens)
+        self.assertEqual({"duplicate": ["bern", "ＢＥＲＮ"]}, dropped)
+        self.assertEqual(2, metrics.events["tokens_dropped_duplicate"])
+
+        tokens, dropped = pipeline.process([str(i) for i in range(100)])
+        self.assertEqual(20, len(tokens))
+        self.assertEqual(80, len(dropped["max_count"]))
+
+    def test_stages(self):
+        pipeline, metrics = self.pipeline(
+            {
+                "token_fold_diacritics": True,
+                "token_min_length": 2,
+                "token_stopwords": ["Strasse", "der"],
+                "token_max_count": 2,
+            }
+        )
+        tokens, dropped = pipeline.process(
+            ["Straße", "a", "DER", "Zürich", "Genève", "Strasse", "Bern"]
+        )
+        self.assertEqual(["Zurich", "Geneve"], tokens)
+        self.assertEqual(
+            {
+                "min_length": ["a"],
+                "stopword": ["Straße", "DER"],
+                "max_count": ["Strasse", "Bern"],
+            },
+            dropped,
+        )
@@ -0,0 +1,122 @@
+import os
+import unittest
+from unittest.mock import patch
+
+from flask import Response
+from flask.testing import FlaskClient
+
+import search_warmup
+from search_warmup import TenantWarmup
+
+import server
+
+
+class FakeHandler:
+    def __init__(self, tenant):
+        self.tenant = tenant
+        self.warm = False
+        self.searches = []
+        self.broken = tenant == "broken"
+
+    def warmup(self):
+        if self.broken:
+            raise Exception("DB not reachable")
+        self.warm = True
+
+    def search(self, identity, searchtext, searchfilter, limit):
+        self.searches.append(searchtext)
+        return {"results": [], "result_counts": []}
+
+
+class SearchWarmupTestCase(unittest.TestCase):
+    """Test case for tenant warm-up"""
+
+    def setUp(self):
+        server.app.testing = True
+        self.app = FlaskClient(server.app, Response)
+        self.handlers = {}
+
+    def factory(self, tenant):
+        return self.handlers.setdefault(tenant, FakeHandler(tenant))
+
+    def test_warmup(self):
+        env = {
+            "WARMUP_TENANTS": "default, broken",
+            "WARMUP_CANARY_QUERIES": "a,b",
+            "WARMUP_RETRY_INTERVAL": "0",
+        }
+        with patch.dict(os.environ, env):
+            warmup = TenantWarmup([self.factory], server.app.logger)
+        self.assertFalse(warmup.ready())
+        warmup.run()
+        self.assertTrue(warmup.ready())
+        self.assertTrue(self.handlers["default"].warm)
+        self.assertEqual(["a", "b"], self.handlers["default"].searches)
+        self.assertEqual("ok", warmup.results["default"])
+        self.assertIn("DB not reachable", warmup.results["broken"])
+
+    def test_all_tenants(self):
+        with patch.dict(os.environ, {"WARMUP_TENANTS": "*"}):
+            warmup = TenantWarmup([self.factory], server.app.logger)
+        self.assertEqual(["default"], warmup.tenants)
+
+    def test_ready(self):
+        with patch.dict(os.environ, {"WARMUP_TENANTS": "default"}):
+            warmup = TenantWarmup([self.factory], server.app.logger)
+        # do not start warm-up thread on request
+        warmup.pid = os.getpid()
+        with patch.object(server, "warmup", warmup):
+            response = self.app.get("/ready")
+            self.assertEqual(503, response.status_code)
+            self.assertEqual({"default": "pending"}, response.json["tenants"])
+            warmup.run()
+            response = self.app.get("/ready")
+            self.assertEqual(200, response.status_code)
+
+    def test_ready_failed(self):
+        env = {"WARMUP_TENANTS": "default, broken", "WARMUP_RETRY_INTERVAL": "0"}
+        with patch.dict(os.environ, env):
+            warmup = TenantWarmup([self.factory], server.app.logger)
+        warmup.pid = os.getpid()
+        warmup.run()
+        with patch.object(server, "warmup", warmup):
+            response = self.app.get("/ready")
+        self.assertEqual(503, response.status_code)
+        self.assertEqual("WARMUP_FAILED", response.json["status"])
+        self.assertEqual(["broken"], list(response.json["tenants"].keys()))
+        self.assertIn("DB not reachable", response.json["tenants"]["broken"])
+
+    def test_retry(self):
+        with patch.dict(os.environ, {"WARMUP_TENANTS": "default, broken"}):
+            warmup = TenantWarmup([self.factory], server.app.logger)
+        warmup.pid = os.getpid()
+        delays = []
+
+        def sleep(delay):
+            delays.append(delay)
+            with patch.object(server, "warmup", warmup):
+                response = self.app.get("/ready")
+            self.assertEqual(503, response.status_code)
+            if len(delays) == 3:
+                # DB reachable again
+                self.handlers["broken"].broken = False
+
+        with patch.object(search_warmup.time, "sleep", sleep):
+            warmup.run()
+        # retried with backoff until the tenant recovered
+        self.assertEqual([5, 10, 20], delays)
+        self.assertEqual("ok", warmup.results["broken"])
+        with patch.object(server, "warmup", warmup):
+            response = self.app.get("/ready")
+        self.assertEqual(200, response.status_code)
+
+    def test_start_per_process(self):
+        with patch.dict(os.environ, {"WARMUP_TENANTS": "default"}):
+            warmup = TenantWarmup([self.factory], server.app.logger)
+        with patch.object(search_warmup.threading, "Thread") as thread:
+            warmup.start()
+            warmup.start()
+            # started again in a forked process
+            warmup.pid = -1
+            warmup.start()
+        self.assertEqual(2, thread.call_count)
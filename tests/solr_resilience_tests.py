@@ -0,0 +1,143 @@
+import time
+import unittest
+
+import requests
+
+from search_metrics import SearchMetrics
+from solr_resilience import HEDGE_MIN_SAMPLES, CircuitBreaker, HedgedRequester
+
+import server
+
+
+class DummyResponse:
+    def __init__(self, url):
+        self.url = url
+        self.status_code = 200
+
+
+class DummySession:
+    """Session answering after a configurable delay per URL"""
+
+    def __init__(self, delays):
+        self.delays = delays
+        self.requested = []
+
+    def get(self, url, params=None, auth=None, timeout=None):
+        self.requested.append(url)
+        delay = self.delays.get(url, 0)
+        if delay is None:
+            raise requests.exceptions.ConnectionError("Connection refused")
+        time.sleep(delay)
+        return DummyResponse(url)
+
+
+class CircuitBreakerTestCase(unittest.TestCase):
+    """Test case for Solr circuit breaker"""
+
+    def setUp(self):
+        self.metrics = SearchMetrics("test", "solr")
+        self.breaker = CircuitBreaker(0.5, 4, 0.1, self.metrics, server.app.logger)
+
+    def test_open_and_reset(self):
+        self.breaker.record_success()
+        for i in range(2):
+            self.breaker.record_failure()
+        self.assertTrue(self.breaker.allow_request())
+        self.breaker.record_failure()
+        self.assertEqual(self.breaker.state, CircuitBreaker.OPEN)
+        self.assertFalse(self.breaker.allow_request())
+        self.assertEqual(self.metrics.events["breaker_open"], 1)
+
+        time.sleep(0.15)
+        # Single probe request
+        self.assertTrue(self.breaker.allow_request())
+        self.assertFalse(self.breaker.allow_request())
+        self.breaker.record_success()
+        self.assertEqual(self.breaker.state, CircuitBreaker.CLOSED)
+        self.assertTrue(self.breaker.allow_request())
+        self.assertEqual(self.metrics.events["breaker_half_open"], 1)
+        self.assertEqual(self.metrics.events["breaker_closed"], 1)
+
+    def test_failed_probe(self):
+        for i in range(4):
+            self.breaker.record_failure()
+        time.sleep(0.15)
+        self.assertTrue(self.breaker.allow_request())
+        self.breaker.record_failure()
+        self.assertEqual(self.breaker.state, CircuitBreaker.OPEN)
+        self.assertFalse(self.breaker.allow_request())
+
+    def test_disabled(self):
+        breaker = CircuitBreaker(0, 4, 0.1, self.metrics, server.app.logger)
+        for i in range(10):
+            breaker.record_failure()
+        self.assertTrue(breaker.allow_request())
+
+
+class HedgedRequesterTestCase(unittest.TestCase):
+    """Test case for hedged Solr requests"""
+
+    def requester(self, session, percentile=50, replicas=1):
+        self.metrics = SearchMetrics("test", "solr")
+        requester = HedgedRequester(
+            session,
+            ["http://primary"] + ["http://replica"] * replicas,
+            1.0,
+            percentile,
+            4,
+            self.metrics,
+            server.app.logger,
+        )
+        requester.latencies.extend([0.01] * HEDGE_MIN_SAMPLES)
+        return requester
+
+    def test_no_hedge_without_samples(self):
+        session = DummySession({"http://primary": 0.1})
+        requester = self.requester(session)
+        requester.latencies.clear()
+        self.assertEqual(requester.get("q=x", None).url, "http://primary")
+        self.assertEqual(session.requested, ["http://primary"])
+        self.assertEqual(self.metrics.events["hedged"], 0)
+
+    def test_hedge_wins(self):
+        session = DummySession({"http://primary": 0.5, "http://replica": 0})
+        requester = self.requester(session)
+        self.assertEqual(requester.get("q=x", None).url, "http://replica")
+        self.assertEqual(self.metrics.events["hedged"], 1)
+        self.assertEqual(self.metrics.events["hedge_wins"], 1)
+
+    def test_primary_fast(self):
+        session = DummySession({"http://primary": 0})
+        requester = self.requester(session)
+        self.assertEqual(requester.get("q=x", None).url, "http://primary")
+        self.assertEqual(self.metrics.events["hedged"], 0)
+
+    def test_request_error(self):
+        session = DummySession({"http://primary": None})
+        requester = self.requester(session, percentile=0)
+        with self.assertRaises(requests.exceptions.ConnectionError):
+            requester.get("q=x", None)
+
+    def test_no_hedge_without_replicas(self):
+        session = DummySession({"http://primary": 0.1})
+        requester = self.requester(session, replicas=0)
+        self.assertEqual(requester.get("q=x", None).url, "http://primary")
+        self.assertEqual(session.requested, ["http://primary"])
+        self.assertEqual(self.metrics.events["hedged"], 0)
+
+    def test_hedge_slots(self):
+        session = DummySession({"http://primary": 0.2, "http://replica": 0.5})
+        requester = self.requester(session)
+        # single hedge slot for 4 request threads, in use by another search
+        requester.hedge_slots.acquire()
+        self.assertEqual(requester.get("q=x", None).url, "http://primary")
+        self.assertEqual(session.requested, ["http://primary"])
+        self.assertEqual(self.metrics.events["hedged"], 0)
+
+        requester.hedge_slots.release()
+        self.assertEqual(requester.get("q=x", None).url, "http://primary")
+        self.assertEqual(self.metrics.events["hedged"], 1)
+        # slot is released when the abandoned hedged request has finished
+        self.assertFalse(requester.hedge_slots.acquire(blocking=False))
+        time.sleep(0.6)
+        self.assertTrue(requester.hedge_slots.acquire(blocking=False))
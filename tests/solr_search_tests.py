@@ -1,4 +1,10 @@
+import os
 import unittest
+
+from flask import g, json
+from search_cursor import decode_cursor
+from search_deadline import Deadline, create_deadline
+from search_spatial import parse_spatial
 from solr_search_service import SolrClient
 
 import server
@@ -57,3 +63,201 @@ class SolrSearchTestCase(unittest.TestCase):
             "OR =^:",
             'q=((search_1_stem:"OR"^6 OR search_1_ngram:"OR"^5) AND (search_1_stem:"=^"^6 OR search_1_ngram:"=^"^5)) OR ((search_2_stem:"OR"^4 OR search_2_ngram:"OR"^3) AND (search_2_stem:"=^"^4 OR search_2_ngram:"=^"^3)) OR ((search_3_stem:"OR"^2 OR search_3_ngram:"OR"^1) AND (search_3_stem:"=^"^2 OR search_3_ngram:"=^"^1))',
         )
+
+    def test_facet_queries(self):
+        solr_facets = self.search.resources.solr_facets(None)
+        facets = self.search.search_facets(None, ["test_dataset", "other"], solr_facets)
+        self.assertEqual(["test_dataset"], facets)
+        self.assertEqual(
+            "fq=tenant:default AND (facet:test_dataset)",
+            self.search.filter_query_str(facets),
+        )
+        self.assertEqual(
+            "facet=true&facet.field={!terms=test_dataset}facet&facet.mincount=1&facet.limit=1&facet.sort=count",
+            self.search.facet_params_str(facets),
+        )
+
+        facets = self.search.search_facets("Map", [], solr_facets)
+        self.assertEqual(["foreground"], facets)
+
+        facets = self.search.search_facets(None, ["other"], solr_facets)
+        self.assertEqual(
+            "fq=tenant:default AND (facet:_)", self.search.filter_query_str(facets)
+        )
+
+    def test_ungroup_response(self):
+        def doc(facet, id):
+            return {"facet": facet, "id": id}
+
+        response = {
+            "grouped": {
+                "facet": {
+                    "groups": [
+                        {
+                            "groupValue": "a",
+                            "doclist": {
+                                "numFound": 10,
+                                "docs": [doc("a", 1), doc("a", 2), doc("a", 3)],
+                            },
+                        },
+                        {
+                            "groupValue": "foreground",
+                            "doclist": {
+                                "numFound": 1,
+                                "docs": [doc("foreground", 4)],
+                            },
+                        },
+                        {
+                            "groupValue": "b",
+                            "doclist": {
+                                "numFound": 2,
+                                "docs": [doc("b", 5), doc("b", 6)],
+                            },
+                        },
+                    ]
+                }
+            }
+        }
+        ungrouped = self.search.ungroup_response(response, 4)
+        self.assertEqual(
+            [1, 4, 5, 2, 6], [d["id"] for d in ungrouped["response"]["docs"]]
+        )
+        self.assertEqual(
+            ["a", 10, "foreground", 1, "b", 2],
+            ungrouped["facet_counts"]["facet_fields"]["facet"],
+        )
+
+    def test_edismax_queries(self):
+        (filterword, tokens) = self.search.tokenize("grenz 4")
+        self.assertEqual(
+            "defType=edismax&q=%224%22%20%22grenz%22&qf=search_1_stem%5E6%20search_1_ngram%5E5%20search_2_stem%5E4%20search_2_ngram%5E3%20search_3_stem%5E2%20search_3_ngram%5E1&mm=100%25",
+            self.search.edismax_query_str(tokens),
+        )
+        # Same query for different word order
+        (filterword, tokens2) = self.search.tokenize("4 grenz")
+        self.assertEqual(
+            self.search.edismax_query_str(tokens),
+            self.search.edismax_query_str(tokens2),
+        )
+
+    def test_spatial_queries(self):
+        spatial = parse_spatial("7.44,46.95", "7.4,46.9,7.5,47.0", None)
+        self.assertEqual("q=x", self.search.spatial_query_str("q=x", spatial))
+
+        self.search.spatial_field = "geo_pt"
+        query = self.search.spatial_query_str("q=x", spatial)
+        self.assertEqual(
+            "sq=x&sfield=geo_pt&pt=46.95%2C7.44&q=%7B%21boost+b%3Drecip%28geodist%28%29%2C2%2C200%2C20%29+v%3D%24sq%7D"
+            "&fq=geo_pt%3A%5B46.9%2C7.4+TO+47.0%2C7.5%5D+OR+%28%2A%3A%2A+-geo_pt%3A%2A%29",
+            query,
+        )
+        self.search.query_mode = "edismax"
+        query = self.search.spatial_query_str("q=x", spatial)
+        self.assertTrue(query.startswith("q=x&sfield=geo_pt&pt=46.95%2C7.44&boost="))
+
+        # Solr locations are in WGS 84
+        spatial = parse_spatial("2600000,1200000", None, "EPSG:2056")
+        self.assertEqual("q=x", self.search.spatial_query_str("q=x", spatial))
+
+    def test_tenant_collections(self):
+        os.environ["SOLR_SERVICE_URL"] = "http://localhost:8983/solr/{tenant}/select"
+        try:
+            search = SolrClient("default", server.app.logger)
+            self.assertEqual(
+                "http://localhost:8983/solr/default/select", search.solr_service_url
+            )
+            # Collection may be shared by other tenants
+            self.assertEqual(
+                "fq=tenant:default AND (facet:a)", search.filter_query_str(["a"])
+            )
+
+            os.environ["SOLR_TENANT_COLLECTIONS"] = '{"default": "gdi"}'
+            search = SolrClient("default", server.app.logger)
+            self.assertEqual(
+                "http://localhost:8983/solr/gdi/select", search.solr_service_url
+            )
+            self.assertEqual(
+                "fq=tenant:default AND (facet:a)", search.filter_query_str(["a"])
+            )
+
+            # Collection declared as dedicated to the tenant
+            os.environ["SOLR_DEDICATED_COLLECTION"] = "true"
+            search = SolrClient("default", server.app.logger)
+            self.assertEqual("fq=(facet:a)", search.filter_query_str(["a"]))
+        finally:
+            del os.environ["SOLR_SERVICE_URL"]
+            os.environ.pop("SOLR_TENANT_COLLECTIONS", None)
+            os.environ.pop("SOLR_DEDICATED_COLLECTION", None)
+
+    def test_cursor(self):
+        def doc(id):
+            return {
+                "id": json.dumps(["test_dataset", str(id)]),
+                "facet": "test_dataset",
+                "display": "Feature %d" % id,
+                "idfield_meta": json.dumps(["id", "id:n"]),
+            }
+
+        solr_facets = self.search.resources.solr_facets(None)
+        response = {
+            "response": {"docs": [doc(1), doc(2)]},
+            "facet_counts": {"facet_fields": {"facet": ["test_dataset", 5]}},
+        }
+        results = self.search.build_results(response, None, 2, solr_facets, [])
+        cursor = results["result_counts"][0]["cursor"]
+        self.assertEqual(("test_dataset", ["*", 2]), decode_cursor(cursor))
+
+        # Next page skips the results returned by the first search
+        queries = []
+
+        def query_cursor(tokens, facet, cursor_mark, rows, spatial=None):
+            queries.append((facet, cursor_mark, rows))
+            return {
+                "response": {"numFound": 5, "docs": [doc(i) for i in range(1, 5)]},
+                "nextCursorMark": "AoE",
+            }
+
+        self.search.query_cursor = query_cursor
+        results = self.search.search(None, "feature", [], 2, cursor)
+        self.assertEqual([("test_dataset", "*", 4)], queries)
+        self.assertEqual(
+            [3, 4], [r["feature"]["feature_id"] for r in results["results"]]
+        )
+        self.assertEqual(
+            ("test_dataset", ["AoE", 0]),
+            decode_cursor(results["result_counts"][0]["cursor"]),
+        )
+
+        self.assertEqual(400, self.search.search(None, "feature", [], 2, "x")[1])
+
+    def test_deadline(self):
+        requests = []
+
+        class FakeResponse:
+            status_code = 200
+            url = "http://solr"
+            content = json.dumps(
+                {
+                    "responseHeader": {"partialResults": True},
+                    "response": {"numFound": 0, "docs": []},
+                    "facet_counts": {"facet_fields": {"facet": []}},
+                }
+            )
+
+        def get(params, auth, request_timeout=None):
+            requests.append((params, request_timeout))
+            return FakeResponse()
+
+        self.search.requester.get = get
+        headers = {"X-Request-Timeout": "0.5"}
+        with server.app.test_request_context("/fts/", headers=headers):
+            g.deadline = create_deadline(self.search.resources.request_timeout)
+            results = self.search.search(None, "feature", [], 2)
+            self.assertTrue(results["partial"])
+            (params, request_timeout) = requests[0]
+            self.assertLessEqual(request_timeout, 0.5)
+            self.assertRegex(params, r"&timeAllowed=\d+$")
+
+            g.deadline = Deadline(0)
+            self.assertEqual(504, self.search.search(None, "feature", [], 2)[1])
+            self.assertEqual(1, len(requests))
@@ -0,0 +1,100 @@
+import unittest
+from unittest.mock import patch
+
+import suggest_index
+from suggest_index import MAX_LIMIT, SuggestIndex
+
+import server
+
+
+class FakeResources:
+    def solr_facets(self, identity):
+        if identity == "admin":
+            return {"addresses": [], "parcels": []}
+        return {"addresses": []}
+
+
+class SuggestIndexTestCase(unittest.TestCase):
+    """Test case for suggest index"""
+
+    def setUp(self):
+        entries = [
+            ("Bahnhofstrasse 12, Solothurn", "addresses"),
+            ("Bahnhofstrasse 12, Solothurn", "addresses"),
+            ("Bahnhofplatz 1, Olten", "addresses"),
+            ("Baselstrasse 3, Solothurn", "addresses"),
+            ("Grundstück 1234 Solothurn", "parcels"),
+            ("Ortsplan", "foreground"),
+        ]
+        self.index = SuggestIndex(
+            FakeResources(), lambda: entries, {}, server.app.logger
+        )
+
+    def suggest(self, searchtext, identity=None, searchfilter=[], limit=None):
+        suggestions = self.index.suggest(identity, searchtext, searchfilter, limit)
+        return [suggestion["display"] for suggestion in suggestions]
+
+    def test_suggest(self):
+        self.index.warmup()
+
+        self.assertEqual(
+            ["Bahnhofplatz 1, Olten", "Bahnhofstrasse 12, Solothurn"],
+            self.suggest("BAHNHOF"),
+        )
+        self.assertEqual(["Bahnhofplatz 1, Olten"], self.suggest("bahn", limit=1))
+        # Word starts
+        self.assertEqual(
+            ["Bahnhofstrasse 12, Solothurn", "Baselstrasse 3, Solothurn"],
+            self.suggest("solo"),
+        )
+        self.assertEqual(["Bahnhofstrasse 12, Solothurn"], self.suggest("12,  sol"))
+        self.assertEqual([], self.suggest("hof"))
+        self.assertEqual([], self.suggest(""))
+
+        # Permissions and filter
+        self.assertEqual([], self.suggest("grund"))
+        self.assertEqual(["Grundstück 1234 Solothurn"], self.suggest("grund", "admin"))
+        self.assertEqual(
+            ["Grundstück 1234 Solothurn"],
+            self.suggest("solo", "admin", ["parcels"]),
+        )
+        # Layers are not suggested
+        self.assertEqual([], self.suggest("orts", "admin"))
+
+    def test_compact_index(self):
+        self.index.warmup()
+        (index, displays, folded) = self.index.index
+        # word start offsets instead of copies of the display suffixes
+        (entries, offsets) = index["addresses"]
+        self.assertEqual(len(entries), len(offsets))
+        keys = [folded[entry][offset:] for entry, offset in zip(entries, offsets)]
+        self.assertEqual(sorted(keys), keys)
+        self.assertEqual(["1, olten", "12, solothurn", "12, solothurn"], keys[:3])
+
+    def test_limit(self):
+        entries = [("Strasse %d" % i, "addresses") for i in range(MAX_LIMIT + 10)]
+        index = SuggestIndex(FakeResources(), lambda: entries, {}, server.app.logger)
+        index.warmup()
+        suggestions = index.suggest(None, "str", [], 1000000)
+        self.assertEqual(MAX_LIMIT, len(suggestions))
+
+    def test_warmup_single_build(self):
+        loads = []
+
+        def load_entries():
+            loads.append(1)
+            # request during warm-up does not start another build
+            with patch.object(suggest_index.threading, "Thread") as thread:
+                self.assertIsNone(index.suggest(None, "bahn", [], None))
+                index.warmup()
+            thread.assert_not_called()
+            return [("Bahnhofplatz 1, Olten", "addresses")]
+
+        index = SuggestIndex(FakeResources(), load_entries, {}, server.app.logger)
+        index.warmup()
+        self.assertEqual(1, len(loads))
+        self.assertFalse(index.refreshing)
+        self.assertEqual(
+            ["Bahnhofplatz 1, Olten"],
+            [s["display"] for s in index.suggest(None, "bahn", [], None)],
+        )
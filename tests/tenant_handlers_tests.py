@@ -0,0 +1,171 @@
+import datetime
+import logging
+import unittest
+from unittest.mock import patch
+
+import db_engines
+import tenant_handlers
+from db_engines import SharedDatabaseEngine, shared_engines
+from tenant_handlers import EvictingTenantHandler
+
+
+class FakeHandler:
+    def __init__(self):
+        self.closed = False
+
+    def close(self):
+        self.closed = True
+
+
+class FakeTimer:
+    """Runs the function immediately instead of after a delay"""
+
+    def __init__(self, delay, function):
+        self.function = function
+
+    def start(self):
+        self.function()
+
+
+class TenantHandlersTestCase(unittest.TestCase):
+    def setUp(self):
+        self.tenant_handler = EvictingTenantHandler(logging.getLogger())
+        # config files are never changed
+        self.tenant_handler.last_config_update = lambda service_name, tenant: None
+        patcher = patch.object(tenant_handlers.threading, "Timer", FakeTimer)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def register(self, tenant):
+        return self.tenant_handler.register_handler("fts", tenant, FakeHandler())
+
+    def cached(self, tenant):
+        return tenant in self.tenant_handler.handler_cache["fts"]
+
+    def test_lru_eviction(self):
+        self.tenant_handler.max_handlers = 2
+        with patch.object(tenant_handlers.time, "monotonic") as monotonic:
+            monotonic.return_value = 1
+            first = self.register("first")
+            monotonic.return_value = 2
+            second = self.register("second")
+            monotonic.return_value = 3
+            # use first tenant, second is now least recently used
+            self.tenant_handler.handler_cache["fts"]["first"]["last_access"] = 3
+            monotonic.return_value = 4
+            third = self.register("third")
+
+        self.assertTrue(self.cached("first"))
+        self.assertFalse(self.cached("second"))
+        self.assertTrue(self.cached("third"))
+        self.assertFalse(first.closed)
+        self.assertTrue(second.closed)
+        self.assertFalse(third.closed)
+
+    def test_without_config_files(self):
+        # handler is kept if there are no config files
+        handler = self.register("tenant")
+        self.assertIs(handler, self.tenant_handler.handler("search", "fts", "tenant"))
+        self.assertIs(handler, self.tenant_handler.handler("search", "fts", "tenant"))
+        self.assertFalse(handler.closed)
+
+    def test_config_change(self):
+        handler = self.register("tenant")
+        last_update = datetime.datetime.now(datetime.timezone.utc)
+        self.tenant_handler.last_config_update = lambda service_name, tenant: (
+            last_update - datetime.timedelta(seconds=10)
+        )
+        self.assertIs(handler, self.tenant_handler.handler("search", "fts", "tenant"))
+
+        # handler is replaced and closed after config change
+        self.tenant_handler.last_config_update = lambda service_name, tenant: (
+            last_update + datetime.timedelta(seconds=10)
+        )
+        self.assertIsNone(self.tenant_handler.handler("search", "fts", "tenant"))
+        self.assertFalse(self.cached("tenant"))
+        self.assertTrue(handler.closed)
+
+    def test_idle_eviction(self):
+        self.tenant_handler.idle_timeout = 60
+        with patch.object(tenant_handlers.time, "monotonic") as monotonic:
+            monotonic.return_value = 100
+            self.tenant_handler.next_sweep = 160
+            idle = self.register("idle")
+            active = self.register("active")
+            monotonic.return_value = 150
+            self.tenant_handler.handler_cache["fts"]["active"]["last_access"] = 150
+
+            monotonic.return_value = 170
+            self.tenant_handler.evict_idle()
+
+        self.assertFalse(self.cached("idle"))
+        self.assertTrue(self.cached("active"))
+        self.assertTrue(idle.closed)
+        self.assertFalse(active.closed)
+
+
+class SharedDatabaseEngineTestCase(unittest.TestCase):
+    def test_shared_engines(self):
+        db_url = "sqlite:///file:shared_engine_test?mode=memory&uri=true"
+        first = SharedDatabaseEngine()
+        second = SharedDatabaseEngine()
+        engine = first.db_engine(db_url)
+        self.assertIs(engine, second.db_engine(db_url))
+        self.assertIs(engine, first.db_engine(db_url))
+
+        # engine is kept while it is used by another handler
+        first.release()
+        self.assertIs(engine, second.db_engine(db_url))
+        self.assertEqual(1, len([k for k in shared_engines if k[0] == db_url]))
+
+        second.release()
+        self.assertEqual(0, len([k for k in shared_engines if k[0] == db_url]))
+
+        third = SharedDatabaseEngine()
+        self.assertIsNot(engine, third.db_engine(db_url))
+        third.release()
+
+    def test_in_flight_request(self):
+        db_url = "sqlite:///file:in_flight_test?mode=memory&uri=true"
+        fanout_url = "sqlite:///file:in_flight_fanout_test?mode=memory&uri=true"
+
+        class PendingTimer:
+            """Records timers instead of starting them"""
+
+            timers = []
+
+            def __init__(self, delay, function):
+                self.function = function
+                self.daemon = False
+                PendingTimer.timers.append(self)
+
+            def start(self):
+                pass
+
+        handler = FakeHandler()
+        handler.db_engine = SharedDatabaseEngine()
+        handler.close = handler.db_engine.release
+        handler.db_engine.db_engine(db_url)
+
+        tenant_handler = EvictingTenantHandler(logging.getLogger())
+        tenant_handler.register_handler("fts", "tenant", handler)
+        with patch.object(tenant_handlers.threading, "Timer", PendingTimer):
+            tenant_handler.evict("fts", "tenant")
+            # request in flight during the close delay
+            engine = handler.db_engine.db_engine(fanout_url)
+            (close_timer,) = PendingTimer.timers
+            close_timer.function()
+            # engines acquired during the close delay are released
+            self.assertEqual(0, len([k for k in shared_engines if k[0] == db_url]))
+            self.assertEqual(0, len([k for k in shared_engines if k[0] == fanout_url]))
+
+            # request still in flight after the handler was released
+            self.assertIsNot(engine, handler.db_engine.db_engine(fanout_url))
+            self.assertIsNotNone(handler.db_engine.db_engine(db_url))
+            self.assertEqual(1, len([k for k in shared_engines if k[0] == db_url]))
+
+        # engines acquired after release are released after a delay
+        (close_timer, release_timer) = PendingTimer.timers
+        release_timer.function()
+        self.assertEqual(0, len([k for k in shared_engines if k[0] == db_url]))
+        self.assertEqual(0, len([k for k in shared_engines if k[0] == fanout_url]))
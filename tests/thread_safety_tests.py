@@ -0,0 +1,224 @@
+import re
+import time
+import unittest
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
+from unittest.mock import patch
+
+from flask import Response, json
+from flask.testing import FlaskClient
+
+from admission_control import AdmissionControl
+from pg_search_service import PgClient
+from search_geom_service import SearchGeomService
+from solr_search_service import SolrClient
+
+import server
+
+# Admission settings queueing the concurrent requests instead of rejecting them
+ADMISSION_CONFIG = {
+    "admission_tenant_max_concurrent": 4,
+    "admission_backend_max_concurrent": 8,
+    "admission_queue_size": 64,
+    "admission_queue_timeout": 10,
+}
+
+
+class FakeResult:
+    def __init__(self, rows):
+        self.rows = rows
+
+    def mappings(self):
+        return self
+
+    def __iter__(self):
+        return iter(self.rows)
+
+    def all(self):
+        return self.rows
+
+
+class FakeConnection:
+    """Connection returning a feature with the selected ID column"""
+
+    dialect = type("Dialect", (), {"name": "sqlite"})
+    engine = None
+
+    def begin(self):
+        return self
+
+    def rollback(self):
+        pass
+
+    def close(self):
+        pass
+
+    def execute(self, sql, params):
+        # let other threads run between query and result assembly
+        time.sleep(0.001)
+        column = re.search(r'SELECT "(\w+)"', sql.text).group(1)
+        return FakeResult(
+            [{column: params["v0"], "json_geom": None, "srid": 2056, "bbox_": None}]
+        )
+
+
+class FakeSearchConnection:
+    """Connection returning a feature with the search term as display"""
+
+    dialect = type("Dialect", (), {"name": "sqlite"})
+
+    def __init__(self):
+        self.engine = self
+
+    def execute(self, sql, params):
+        # let other threads run between query and result assembly
+        time.sleep(0.001)
+        return FakeResult(
+            [
+                {
+                    "display": params["term"],
+                    "facet_id": "test_dataset",
+                    "feature_id": 1,
+                    "id_field_name": "id",
+                    "id_in_quotes": False,
+                    "bbox": None,
+                    "srid": 2056,
+                }
+            ]
+        )
+
+
+class FakeSolrResponse:
+    status_code = 200
+    url = "http://solr"
+
+    def __init__(self, term):
+        self.content = json.dumps(
+            {
+                "response": {
+                    "numFound": 1,
+                    "docs": [
+                        {
+                            "id": json.dumps(["test_dataset", "1"]),
+                            "display": term,
+                            "facet": "test_dataset",
+                            "idfield_meta": json.dumps(["id", "id:n"]),
+                            "bbox": json.dumps([2600000, 1200000, 2600100, 1200100]),
+                            "srid": 2056,
+                        }
+                    ],
+                },
+                "facet_counts": {"facet_fields": {"facet": ["test_dataset", 1]}},
+            }
+        )
+
+
+class ThreadSafetyTestCase(unittest.TestCase):
+    """Test case for concurrent requests in threaded workers"""
+
+    def test_concurrent_geom_queries(self):
+        service = SearchGeomService("default", server.app.logger)
+        service.replicas.connect = lambda db_url: FakeConnection()
+        facets = {
+            "dataset_%d" % i: [{"search_id_col": "id_%d" % i, "db_url": "sqlite://"}]
+            for i in range(4)
+        }
+
+        def query(i):
+            dataset = "dataset_%d" % (i % 4)
+            with server.app.test_request_context("/geom/%s/" % dataset):
+                result = service.query(None, dataset, '[["attr", "=", %d]]' % i)
+            return (i, result["feature_collection"]["features"][0]["id"])
+
+        with patch.object(service.resources, "solr_facets", return_value=facets):
+            with ThreadPoolExecutor(max_workers=16) as executor:
+                results = list(executor.map(query, range(400)))
+        for i, feature_id in results:
+            self.assertEqual(i, feature_id)
+
+    def test_concurrent_handler_registration(self):
+        server.tenant_handler.handler_cache = {}
+
+        def create_service(tenant, logger):
+            # slow handler creation
+            time.sleep(0.01)
+            return SearchGeomService(tenant, logger)
+
+        with patch.object(
+            server, "SearchGeomService", side_effect=create_service
+        ) as factory:
+            with ThreadPoolExecutor(max_workers=16) as executor:
+                handlers = list(
+                    executor.map(
+                        lambda i: server.search_geom_handler("default"), range(64)
+                    )
+                )
+        self.assertEqual(1, factory.call_count)
+        self.assertEqual(1, len(set(map(id, handlers))))
+
+    def test_concurrent_pg_searches(self):
+        search = PgClient("default", server.app.logger)
+        search.render_queries = lambda *args, **kwargs: (None, "feature_query")
+        search.resources.server_timing = "all"
+        search.admission = AdmissionControl(
+            ADMISSION_CONFIG, "stress", "pg_stress", search.metrics, server.app.logger
+        )
+
+        @contextmanager
+        def connect(db_url=None):
+            yield FakeSearchConnection()
+
+        search.connect = connect
+        server.tenant_handler.handler_cache = {}
+        server.tenant_handler.register_handler("fts", "default", search)
+        client = FlaskClient(server.app, Response)
+
+        def request(i):
+            response = client.get("/fts/?searchtext=word%d" % i)
+            return (i, response)
+
+        try:
+            with ThreadPoolExecutor(max_workers=16) as executor:
+                responses = list(executor.map(request, range(200)))
+        finally:
+            server.tenant_handler.handler_cache = {}
+
+        for i, response in responses:
+            self.assertEqual(200, response.status_code)
+            # tokens, results and phase timings of this request only
+            displays = [r["feature"]["display"] for r in response.json["results"]]
+            self.assertEqual(["word%d" % i], displays)
+            phases = [
+                phase.split(";")[0]
+                for phase in response.headers["Server-Timing"].split(", ")
+            ]
+            self.assertEqual(1, phases.count("db_feature"))
+        self.assertEqual(0, search.admission.tenant_limiter.active)
+        self.assertEqual(0, search.admission.backend_limiter.active)
+        self.assertEqual(0, search.metrics.events["admission_rejected_tenant"])
+
+    def test_concurrent_solr_searches(self):
+        search = SolrClient("default", server.app.logger)
+        search.admission = AdmissionControl(
+            ADMISSION_CONFIG, "stress", "solr_stress", search.metrics, server.app.logger
+        )
+
+        def get(params, auth, request_timeout=None):
+            time.sleep(0.001)
+            term = re.search(r'search_1_stem:"(\w+)"', params).group(1)
+            return FakeSolrResponse(term)
+
+        search.requester.get = get
+
+        def query(i):
+            with server.app.test_request_context("/fts/"):
+                result = search.search(None, "word%d" % i, [], 10)
+            return (i, result)
+
+        with ThreadPoolExecutor(max_workers=16) as executor:
+            results = list(executor.map(query, range(200)))
+        for i, result in results:
+            displays = [r["feature"]["display"] for r in result["results"]]
+            self.assertEqual(["word%d" % i], displays)
+        self.assertEqual(0, search.admission.tenant_limiter.active)
+        self.assertEqual(0, search.admission.backend_limiter.active)
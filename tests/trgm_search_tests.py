@@ -1,11 +1,20 @@
 import json
 import os
 import unittest
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
+from unittest.mock import patch
 
 from flask import Response, json
 from flask.testing import FlaskClient
 from flask_jwt_extended import JWTManager, create_access_token
+from sqlalchemy import create_engine
+from sqlalchemy.exc import DBAPIError
+from sqlalchemy.sql import text as sql_text
 
+from pg_search_service import PgClient
+from search_cursor import decode_cursor
+from search_deadline import Deadline
 import server
 
 JWTManager(server.app)
@@ -210,6 +219,7 @@ class ApiTestCase(unittest.TestCase):
 
         self.assertEqual(len(data["result_counts"]), 1)
         self.assertEqual(data["result_counts"][0]["count"], -1)
+        self.assertFalse(data["result_counts"][0]["exact"])
         self.assertEqual(data["result_counts"][0]["filterword"], "Test")
 
     def test_search_templates(self):
@@ -288,3 +298,280 @@ class ApiTestCase(unittest.TestCase):
         self.assertEqual(len(dataproducts), 1)
         dataproduct = dataproducts[0]["dataproduct"]
         self.assertEqual(dataproduct["display"], "searchstring'$")
+
+
+class TruncatedQueryTestCase(unittest.TestCase):
+    """Test case for feature results truncated and counted in SQL"""
+
+    def test_truncated_query(self):
+        search = PgClient("default", server.app.logger)
+        search.facet_search_limit = 3
+        feature_query = " UNION ALL ".join(
+            [
+                "SELECT * FROM (SELECT '%s %d' AS display, %d AS feature_id, '%s' AS facet_id, "
+                "'id' AS id_field_name, 1 AS id_in_quotes, NULL AS bbox, 'EPSG:2056' AS srid)"
+                % (facet, i, i, facet)
+                for facet, count in [("a", 5), ("b", 1), ("c", 4)]
+                for i in range(count)
+            ]
+        )
+        with create_engine("sqlite://").connect() as conn:
+            rows = conn.execute(sql_text(feature_query)).mappings().all()
+            truncated_rows = {}
+            for limit in [1, 4, 10]:
+                params = {"result_limit": limit, "facet_result_limit": 3}
+                truncated_rows[limit] = (
+                    conn.execute(
+                        sql_text(search.truncated_query(feature_query)), params
+                    )
+                    .mappings()
+                    .all()
+                )
+
+        # First rows within the limits and first row of each facet
+        self.assertEqual(
+            ["a 0", "a 1", "a 2", "b 0", "c 0"],
+            [row["display"] for row in truncated_rows[4]],
+        )
+        self.assertEqual(
+            {"a": 5, "b": 1, "c": 4}, search.facet_result_counts(truncated_rows[4])
+        )
+        for limit in [1, 4, 10]:
+            self.assertEqual(
+                search.build_results([], rows, [], ["a", "b", "c"], limit),
+                search.build_results(
+                    [], truncated_rows[limit], [], ["a", "b", "c"], limit
+                ),
+            )
+
+    def test_sort_key_order(self):
+        search = PgClient("default", server.app.logger)
+        # Results returned out of sort order
+        feature_query = " UNION ALL ".join(
+            [
+                "SELECT * FROM (SELECT '%s %d' AS display, %d AS feature_id, '%s' AS facet_id, "
+                "'id' AS id_field_name, 1 AS id_in_quotes, NULL AS bbox, 'EPSG:2056' AS srid, "
+                "%d AS sort_key)" % (facet, sort_key, feature_id, facet, sort_key)
+                for facet, sort_key, feature_id in [
+                    ("a", 3, 1),
+                    ("b", 1, 4),
+                    ("a", 1, 3),
+                    ("a", 1, 2),
+                    ("b", 2, 1),
+                ]
+            ]
+        )
+        query = search.truncated_query(feature_query)
+        self.assertIn("row_number() OVER (ORDER BY sort_key, feature_id)", query)
+        with create_engine("sqlite://").connect() as conn:
+            params = {"result_limit": 3, "facet_result_limit": 2}
+            rows = conn.execute(sql_text(query), params).mappings().all()
+
+        # Results within the limits in order of (sort_key, feature_id)
+        self.assertEqual(
+            [("a", 1, 2), ("a", 1, 3), ("b", 1, 4)],
+            [(row["facet_id"], row["sort_key"], row["feature_id"]) for row in rows],
+        )
+
+        # Order of the feature query without sort_key
+        query = search.truncated_query("SELECT 1 AS feature_id, 'a' AS facet_id")
+        self.assertIn("row_number() OVER () AS result_row_", query)
+
+
+class FanoutTestCase(unittest.TestCase):
+    """Test case for feature queries fanned out to multiple DBs"""
+
+    def setUp(self):
+        self.search = PgClient("default", server.app.logger)
+        self.search.facets = {
+            "a": {"name": "a", "db_url": "db1"},
+            "b": {"name": "b", "db_url": "db2"},
+            "c": {"name": "c", "db_url": "db3"},
+        }
+        self.search.fanout_executor = ThreadPoolExecutor(max_workers=3)
+        self.addCleanup(self.search.fanout_executor.shutdown)
+
+        # Ordered feature results per DB, db2 has no results
+        self.db_rows = {
+            "db1": [self.row("a", 1, 1), self.row("a", 4, 2), self.row("a", 5, 3)],
+            "db2": [],
+            "db3": [self.row("c", 2, 1), self.row("c", 3, 2)],
+        }
+        shards = {"a": "db1", "b": "db2", "c": "db3"}
+
+        def search_features(conn, searchtext, tokens, facets, *args, **kwargs):
+            cursor_position = args[1]
+            rows = [
+                row
+                for row in self.db_rows[shards[facets[0]]]
+                if cursor_position is None
+                or [row["sort_key"], row["feature_id"]] > cursor_position
+            ]
+            return (rows, {}, False)
+
+        @contextmanager
+        def connect(db_url=None):
+            yield None
+
+        self.search.search_features = search_features
+        self.search.connect = connect
+        self.search.render_queries = lambda *args: (None, "feature_query")
+
+    def row(self, facet, sort_key, feature_id):
+        return {
+            "display": "%s %d" % (facet, sort_key),
+            "feature_id": feature_id,
+            "facet_id": facet,
+            "id_field_name": "id",
+            "id_in_quotes": 1,
+            "bbox": None,
+            "srid": "EPSG:2056",
+            "sort_key": sort_key,
+        }
+
+    def fanout(self, facets, cursor_position, limit):
+        db_facets = self.search.db_facets(facets)
+        (rows, facet_counts, partial) = self.search.search_features_fanout(
+            None, "x", ["x"], db_facets, cursor_position, None
+        )
+        return self.search.build_results([], rows, [], facets, limit, facet_counts)
+
+    def test_merge(self):
+        result = self.fanout(["a", "b", "c"], None, 3)
+
+        # Results of all DBs in sort order, truncated to the limit
+        self.assertEqual(
+            ["a 1", "c 2", "c 3"],
+            [r["feature"]["display"] for r in result["results"]],
+        )
+        counts = {r["dataproduct_id"]: r for r in result["result_counts"]}
+        self.assertEqual(3, counts["a"]["count"])
+        self.assertNotIn("cursor", counts["c"])
+        self.assertNotIn("b", counts)
+
+        # Continue after last returned result of facet a
+        (facet, position) = decode_cursor(counts["a"]["cursor"])
+        self.assertEqual(("a", [1, 1]), (facet, position))
+        result = self.fanout([facet], position, 3)
+        self.assertEqual(
+            ["a 4", "a 5"], [r["feature"]["display"] for r in result["results"]]
+        )
+
+    def test_single_db(self):
+        # Facets in a single DB other than the default DB need no executor
+        self.search.fanout_executor = None
+        result = self.fanout(["c"], None, 3)
+        self.assertEqual(
+            ["c 2", "c 3"], [r["feature"]["display"] for r in result["results"]]
+        )
+
+
+class PostgresStandIn:
+    """SQLite connection posing as Postgres connection
+
+    Records statement timeouts instead of executing them, and fails queries
+    listed in canceled, as if cancelled by the statement timeout.
+    """
+
+    def __init__(self, conn):
+        self.conn = conn
+        self.dialect = type("Dialect", (), {"name": "postgresql"})
+        self.engine = self
+        self.canceled = []
+        self.timeouts = []
+        self.rollbacks = 0
+
+    def execute(self, sql, params=None):
+        if sql.text.startswith("SET LOCAL statement_timeout"):
+            self.timeouts.append(params["timeout"])
+            return None
+        if sql.text in self.canceled:
+            # raises sqlalchemy.exc.OperationalError
+            sql = sql_text("SELECT * FROM canceled_query")
+        return self.conn.execute(sql, params)
+
+    def rollback(self):
+        self.rollbacks += 1
+        self.conn.rollback()
+
+
+class DeadlineTestCase(unittest.TestCase):
+    """Test case for queries cancelled at the request deadline"""
+
+    LAYER_QUERY = (
+        "SELECT 'layer' AS dataproduct_id, 'Layer' AS display, NULL AS dset_info, "
+        "NULL AS sublayers, 'foreground' AS stacktype"
+    )
+    FEATURE_QUERY = (
+        "SELECT 'Feature' AS display, 1 AS feature_id, 'ds' AS facet_id, "
+        "'id' AS id_field_name, 1 AS id_in_quotes, NULL AS bbox, 'EPSG:2056' AS srid"
+    )
+
+    def setUp(self):
+        self.search = PgClient("default", server.app.logger)
+        self.search.layer_timeout_share = 0.3
+        self.search.render_queries = lambda *args, **kwargs: (
+            self.LAYER_QUERY,
+            self.FEATURE_QUERY,
+        )
+        engine = create_engine("sqlite://")
+        self.conn = PostgresStandIn(engine.connect())
+        self.addCleanup(engine.dispose)
+        self.addCleanup(self.conn.conn.close)
+        patcher = patch("pg_search_service.is_query_canceled", lambda e: True)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def search_with_deadline(self, timeout):
+        permissions = ({"foreground": {}, "ds": {}}, ["layer"])
+        with server.app.test_request_context():
+            server.g.deadline = Deadline(timeout)
+            return self.search.search(
+                None, "x", [], 10, permissions=permissions, conn=self.conn
+            )
+
+    def test_statement_timeout(self):
+        rows = self.search.execute_query(
+            self.conn, "feature_query", self.FEATURE_QUERY, {}, 2
+        )
+        self.assertEqual(1, len(rows))
+        # SET LOCAL statement_timeout in ms, reset by ending the transaction
+        self.assertEqual([2000], self.conn.timeouts)
+        self.assertEqual(1, self.conn.rollbacks)
+
+        # no statement timeout without deadline
+        self.search.execute_query(self.conn, "feature_query", self.FEATURE_QUERY, {})
+        self.assertEqual([2000], self.conn.timeouts)
+
+    def test_layer_feature_split(self):
+        result = self.search_with_deadline(10)
+        self.assertEqual(2, len(result["results"]))
+        self.assertNotIn("partial", result)
+
+        # layer query gets its share of the remaining time, the feature query
+        # the time left after the layer query
+        (layer_timeout, feature_timeout) = self.conn.timeouts
+        self.assertAlmostEqual(3000, layer_timeout, delta=100)
+        self.assertAlmostEqual(10000, feature_timeout, delta=100)
+
+    def test_partial_results(self):
+        # feature results of cancelled layer query
+        self.conn.canceled = [self.LAYER_QUERY]
+        result = self.search_with_deadline(10)
+        self.assertTrue(result["partial"])
+        self.assertEqual(
+            ["Feature"], [r["feature"]["display"] for r in result["results"]]
+        )
+
+        # layer results of cancelled feature query
+        self.conn.canceled = [self.FEATURE_QUERY]
+        result = self.search_with_deadline(10)
+        self.assertTrue(result["partial"])
+        self.assertEqual(
+            ["Layer"], [r["dataproduct"]["display"] for r in result["results"]]
+        )
+
+        # other DB errors are not masked
+        with patch("pg_search_service.is_query_canceled", lambda e: False):
+            with self.assertRaises(DBAPIError):
+                self.search_with_deadline(10)